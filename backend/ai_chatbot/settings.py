@@ -87,6 +87,9 @@ DATABASES = {
         'PASSWORD': "Your Database Password Here",
         'HOST': 'localhost',
         'PORT': '3306',
+        # keep connections across requests; reuse is checked first so a dropped connection is replaced
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
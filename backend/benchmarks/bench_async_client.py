@@ -0,0 +1,78 @@
+"""
+Throughput of the FastAPI generation path against a local stub server.
+
+Fires a fixed number of generateContent calls at increasing concurrency
+levels, once through AsyncGeminiClient and once through the blocking
+GeminiClient called from the event loop (the old behaviour of main.py).
+With a non-blocking client throughput should grow with concurrency; the
+blocking client stays flat at roughly 1 / upstream_latency.
+
+Run from backend/:
+    python -m benchmarks.bench_async_client [--delay 0.05] [--requests 512]
+"""
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+
+from chatbot.gemini_client import AsyncGeminiClient, GeminiClient  # noqa: E402
+from benchmarks.stub_gemini import StubGemini, start_in_thread  # noqa: E402
+
+PAYLOAD = {"contents": [{"parts": [{"text": "What is photosynthesis?"}]}]}
+CONCURRENCY_LEVELS = (1, 4, 16, 64, 256)
+
+
+async def run_async(base_url: str, concurrency: int, total: int) -> float:
+    client = AsyncGeminiClient("benchmark", base_url=base_url, max_concurrency=concurrency)
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(client.generate_content("gemini-stub-flash", PAYLOAD) for _ in range(total)))
+        return total / (time.perf_counter() - start)
+    finally:
+        await client.aclose()
+
+
+async def run_blocking(base_url: str, concurrency: int, total: int) -> float:
+    client = GeminiClient("benchmark", base_url=base_url, pool_size=concurrency, http2=False)
+
+    async def one():
+        # what `async def` + requests.post did: the loop is blocked for the whole call
+        return client.generate_content("gemini-stub-flash", PAYLOAD)
+
+    sem = asyncio.Semaphore(concurrency)
+
+    async def bounded():
+        async with sem:
+            return await one()
+
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(bounded() for _ in range(total)))
+        return total / (time.perf_counter() - start)
+    finally:
+        client.close()
+
+
+async def main(delay: float, total: int):
+    stub = await StubGemini(delay).start()
+    # the blocking client needs a server on another loop, otherwise it would deadlock this one
+    threaded_stub = start_in_thread(delay)
+    blocking_total = max(1, min(total, int(2 / delay)))
+    print(f"stub latency {delay * 1000:.0f} ms, {total} requests per level "
+          f"({blocking_total} for the blocking client)")
+    print(f"{'concurrency':>11} | {'async req/s':>11} | {'blocking req/s':>14}")
+    for concurrency in CONCURRENCY_LEVELS:
+        async_rps = await run_async(stub.base_url, concurrency, total)
+        blocking_rps = await run_blocking(threaded_stub.base_url, concurrency, blocking_total)
+        print(f"{concurrency:>11} | {async_rps:>11.1f} | {blocking_rps:>14.1f}")
+    await stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--delay", type=float, default=0.05, help="stub upstream latency in seconds")
+    parser.add_argument("--requests", type=int, default=512, help="requests per concurrency level")
+    args = parser.parse_args()
+    asyncio.run(main(args.delay, args.requests))
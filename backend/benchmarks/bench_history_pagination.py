@@ -0,0 +1,120 @@
+"""
+History page latency on a multi-million-row chat_messages table.
+
+Builds a throwaway SQLite database with the project's migrations and fills it
+with --rows messages. One "heavy" session gets --heavy of them and the rest
+are spread over many small sessions. It then times, for the heavy session:
+
+  * keyset pages (chatbot.history.message_page) at increasing depths,
+  * the same pages with OFFSET, for comparison,
+  * the newest page with the composite index dropped (the pre-0003 schema).
+
+Run from backend/:
+    python -m benchmarks.bench_history_pagination [--rows 2000000] [--heavy 200000]
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ai_chatbot.settings")
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+DEPTHS = (0, 1_000, 10_000, 100_000)
+
+
+def setup_database(path: str):
+    settings.DATABASES["default"]["NAME"] = path
+    django.setup()
+    from django.core.management import call_command
+    call_command("migrate", "chatbot", verbosity=0)
+
+
+def fill(rows: int, heavy: int):
+    from django.db import connection, transaction
+
+    rng = random.Random(1)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    light_sessions = max(1, (rows - heavy) // 100)
+
+    def generate():
+        for i in range(heavy):
+            yield ("power-user", "heavy", "user" if i % 2 == 0 else "ai", f"message {i}", start + timedelta(seconds=i))
+        for i in range(rows - heavy):
+            session = rng.randrange(light_sessions)
+            yield (f"user{session % 5000}", f"s{session}", "user", f"message {i}",
+                   start + timedelta(seconds=rng.randrange(10_000_000)))
+
+    sql = "INSERT INTO chat_messages (user_id, session_id, sender, text, timestamp) VALUES (%s, %s, %s, %s, %s)"
+    t = time.perf_counter()
+    batch = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        for row in generate():
+            batch.append(row)
+            if len(batch) == 50_000:
+                cursor.executemany(sql, batch)
+                batch.clear()
+        if batch:
+            cursor.executemany(sql, batch)
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    print(f"inserted {rows:,} rows in {time.perf_counter() - t:.1f}s")
+
+
+def timed(fn, repeat: int = 20) -> float:
+    samples = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    return statistics.median(samples) * 1000
+
+
+def cursor_at_depth(depth: int) -> str | None:
+    """Cursor positioned `depth` messages back from the newest message of the heavy session."""
+    from chatbot.history import encode_cursor
+    from chatbot.models import ChatMessage
+
+    if depth == 0:
+        return None
+    row = (ChatMessage.objects.filter(user_id="power-user", session_id="heavy")
+           .order_by("-timestamp", "-id").values_list("timestamp", "id")[depth - 1])
+    return encode_cursor(*row)
+
+
+def main(rows: int, heavy: int, limit: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_database(os.path.join(tmp, "bench.sqlite3"))
+        from django.db import connection
+        from chatbot.history import message_page
+        from chatbot.models import ChatMessage
+
+        fill(rows, heavy)
+        heavy_rows = ChatMessage.objects.filter(user_id="power-user", session_id="heavy").order_by("-timestamp", "-id")
+
+        print(f"\npage of {limit} from a {heavy:,}-message session (median of 20)")
+        print(f"{'depth':>9}  {'keyset':>10}  {'OFFSET':>10}")
+        for depth in (d for d in DEPTHS if d < heavy):
+            cursor = cursor_at_depth(depth)
+            keyset = timed(lambda: message_page("power-user", "heavy", before=cursor, limit=limit))
+            offset = timed(lambda: list(heavy_rows.values_list("id", "text", "sender", "timestamp")[depth:depth + limit]))
+            print(f"{depth:>9,}  {keyset:>7.2f} ms  {offset:>7.2f} ms")
+
+        with connection.cursor() as c:
+            c.execute("DROP INDEX chat_msg_session_ts_idx")
+        no_index = timed(lambda: message_page("power-user", "heavy", limit=limit), repeat=3)
+        print(f"\nnewest page without the composite index: {no_index:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--heavy", type=int, default=200_000)
+    parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+    main(args.rows, args.heavy, args.limit)
@@ -0,0 +1,167 @@
+"""
+Full-text search latency over a multi-million-row chat_messages table.
+
+Builds a throwaway SQLite database with the project's migrations, FTS5 index
+and triggers included. It fills it with --rows messages drawn from a
+Zipf-distributed vocabulary and spread over --users users. One "power user"
+gets --heavy of the messages. It then times chatbot.search.search_messages
+for terms across the frequency range, from rare words to one that appears
+in nearly every message, and for multi-term, prefix and phrase queries. Each
+runs for both a typical user and the power user. For comparison it also
+times the LIKE scan a client would otherwise need, and reports the
+write-time cost of the index triggers.
+
+Run from backend/:
+    python -m benchmarks.bench_search [--rows 2000000] [--users 5000] [--heavy 100000]
+"""
+import argparse
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ai_chatbot.settings")
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+VOCABULARY = 20_000
+
+
+def setup_database(path: str):
+    settings.DATABASES["default"]["NAME"] = path
+    django.setup()
+    from django.core.management import call_command
+    call_command("migrate", "chatbot", verbosity=0)
+
+
+def make_words(rng: random.Random) -> list:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < VOCABULARY:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 10))))
+    return sorted(words, key=lambda w: rng.random())
+
+
+def fill(rows: int, users: int, heavy: int, words: list, rng: random.Random):
+    from django.db import connection, transaction
+
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def generate():
+        for i in range(rows):
+            user = "power-user" if i < heavy else f"user{rng.randrange(users)}"
+            text = " ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(12, 40)))
+            yield (user, f"s{i % 7}", "user" if i % 2 == 0 else "ai", text, start + timedelta(seconds=i))
+
+    sql = "INSERT INTO chat_messages (user_id, session_id, sender, text, timestamp) VALUES (%s, %s, %s, %s, %s)"
+    t = time.perf_counter()
+    batch = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        for row in generate():
+            batch.append(row)
+            if len(batch) == 50_000:
+                cursor.executemany(sql, batch)
+                batch.clear()
+        if batch:
+            cursor.executemany(sql, batch)
+    elapsed = time.perf_counter() - t
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('optimize')")
+        cursor.execute("ANALYZE")
+    print(f"inserted {rows:,} rows (FTS triggers on) in {elapsed:.1f}s, {elapsed / rows * 1e6:.0f} us/row")
+
+
+def trigger_overhead(words: list, rng: random.Random, n: int = 2000) -> tuple:
+    """Per-row insert cost (autocommit, one row per transaction) with and without the FTS triggers."""
+    from django.db import connection
+    from chatbot.search import SCHEMA
+
+    def insert_rows() -> float:
+        t = time.perf_counter()
+        with connection.cursor() as cursor:
+            for i in range(n):
+                cursor.execute(
+                    "INSERT INTO chat_messages (user_id, session_id, sender, text, timestamp) VALUES (%s, %s, %s, %s, %s)",
+                    ["bench-writer", "w", "user", " ".join(rng.choices(words[:2000], k=25)), datetime.now(timezone.utc)],
+                )
+        return (time.perf_counter() - t) / n * 1e6
+
+    with_triggers = insert_rows()
+    with connection.cursor() as cursor:
+        for name in ("chat_messages_fts_ai", "chat_messages_fts_ad", "chat_messages_fts_au"):
+            cursor.execute(f"DROP TRIGGER {name}")
+    without = insert_rows()
+    with connection.cursor() as cursor:
+        for sql in SCHEMA[1:]:
+            cursor.execute(sql)
+    return with_triggers, without
+
+
+def timed(fn, repeat: int = 20) -> float:
+    samples = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    return statistics.median(samples) * 1000
+
+
+def main(rows: int, users: int, heavy: int):
+    rng = random.Random(7)
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_database(os.path.join(tmp, "bench.sqlite3"))
+        from django.db import connection
+        from chatbot.models import ChatMessage
+        from chatbot.search import build_match, search_messages
+
+        words = make_words(rng)
+        fill(rows, users, heavy, words, rng)
+
+        def share(query: str) -> str:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM chat_messages_fts WHERE chat_messages_fts MATCH %s",
+                               [f"text : ({build_match(query)})"])
+                return f"{cursor.fetchone()[0] / rows:.2%}"
+
+        mid = words[300]
+        queries = {
+            "rare term": words[15_000],
+            "moderate term": mid,
+            "frequent term": words[20],
+            "two terms": f"{mid} {words[40]}",
+            "prefix": mid[:4] + "*",
+            "phrase": f'"{words[3]} {words[5]}"',
+            "stop-word-like": words[0],
+        }
+
+        print("\nsearch_messages, top 20 (median of 20 runs)")
+        print(f"{'query':<15} {'% of msgs':>9}  {'typical user':>12}  {'power user':>11}  {'power user, session + dates':>28}")
+        since, until = datetime(2024, 1, 1, tzinfo=timezone.utc), datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+        for label, query in queries.items():
+            typical = timed(lambda: search_messages(query, "user42"))
+            power = timed(lambda: search_messages(query, "power-user"))
+            filtered = timed(lambda: search_messages(query, "power-user", session_id="s3", since=since, until=until))
+            print(f"{label:<15} {share(query):>9}  {typical:>9.2f} ms  {power:>8.2f} ms  {filtered:>25.2f} ms")
+
+        like = timed(lambda: list(ChatMessage.objects.filter(user_id="power-user", text__icontains=mid)
+                                  .values_list("id", "text")[:20]), repeat=3)
+        like_all = timed(lambda: list(ChatMessage.objects.filter(user_id="power-user", text__icontains=words[15_000])
+                                      .values_list("id")), repeat=3)
+        print(f"\nLIKE '%term%' over the power user's {heavy:,} messages: first 20 {like:.1f} ms, all matches {like_all:.1f} ms")
+
+        with_triggers, without = trigger_overhead(words, rng)
+        print(f"single-row insert: {with_triggers:.0f} us with FTS triggers, {without:.0f} us without")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--heavy", type=int, default=100_000)
+    args = parser.parse_args()
+    main(args.rows, args.users, args.heavy)
@@ -0,0 +1,86 @@
+"""
+Lookup latency of the semantic cache at 100k cached prompts.
+
+Fills one SemanticIndex with synthetic tutor prompts, then times lookups for
+paraphrased hits and for unseen prompts. Embedding and index search are
+reported separately, along with a brute-force scan of the full float32 matrix
+for comparison.
+
+Run from backend/:
+    python -m benchmarks.bench_semantic_cache [--entries 100000] [--queries 2000]
+"""
+import argparse
+import random
+import string
+import time
+
+import numpy as np
+
+from chatbot.semantic_cache import HashedNgramEmbedder, SemanticIndex
+
+PARAPHRASE_PREFIXES = ("what is", "explain", "can you explain", "tell me about", "describe", "please define")
+
+
+def make_vocabulary(size: int, rng: random.Random) -> list:
+    return ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 11))) for _ in range(size)]
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def report(label: str, samples: list):
+    us = [s * 1e6 for s in samples]
+    print(f"{label:<28} p50 {percentile(us, 50):8.1f} us   p99 {percentile(us, 99):8.1f} us")
+
+
+def main(entries: int, queries: int):
+    rng = random.Random(42)
+    vocabulary = make_vocabulary(20000, rng)
+    embedder = HashedNgramEmbedder()
+    index = SemanticIndex(capacity=entries)
+
+    topics = [" ".join(rng.choices(vocabulary, k=rng.randint(2, 6))) for _ in range(entries)]
+    start = time.perf_counter()
+    for i, topic in enumerate(topics):
+        index.add(embedder.embed(f"what is {topic}"), i)
+    print(f"filled {len(index)} entries in {time.perf_counter() - start:.1f}s")
+
+    hit_queries = [f"{rng.choice(PARAPHRASE_PREFIXES)} {rng.choice(topics)}" for _ in range(queries)]
+    miss_queries = [" ".join(rng.choices(vocabulary, k=rng.randint(2, 6))) for _ in range(queries)]
+
+    for label, prompts in (("paraphrase (hit)", hit_queries), ("unseen prompt (miss)", miss_queries)):
+        vectors = []
+        embed_times = []
+        for prompt in prompts:
+            t = time.perf_counter()
+            vectors.append(embedder.embed(prompt))
+            embed_times.append(time.perf_counter() - t)
+        search_times = []
+        hits = 0
+        for vec in vectors:
+            t = time.perf_counter()
+            slot, score = index.search(vec)
+            search_times.append(time.perf_counter() - t)
+            hits += slot is not None and score >= 0.92
+        print(f"\n{label}: {hits}/{len(prompts)} above threshold")
+        report("  embed", embed_times)
+        report("  LSH + cosine search", search_times)
+
+    matrix = index._vectors[:len(index)]
+    scan_times = []
+    for vec in vectors[:200]:
+        t = time.perf_counter()
+        int(np.argmax(matrix @ vec))
+        scan_times.append(time.perf_counter() - t)
+    print()
+    report("full matrix scan (reference)", scan_times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+    main(args.entries, args.queries)
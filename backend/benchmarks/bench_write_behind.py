@@ -0,0 +1,112 @@
+"""
+Chat message write throughput and reply latency: synchronous vs write-behind.
+
+Builds a throwaway SQLite database with the project's migrations. Then
+--threads concurrent "users" each run --turns chat turns against it. A turn
+saves the question, waits --llm-ms to stand in for the model call, and saves
+the answer, just as chatbot_reply does. This runs once per mode:
+
+  sync              record_message, two autocommit transactions per turn (the default)
+  write-behind      WriteBehindQueue, durability=memory
+  ... +journal      WriteBehindQueue, durability=journal
+  ... +fsync        WriteBehindQueue, durability=fsync
+
+For each mode it prints messages committed per second, with the final flush
+included, and p50/p99 of both a single save call and a whole turn.
+
+Run from backend/:
+    python -m benchmarks.bench_write_behind [--threads 16] [--turns 100] [--llm-ms 20]
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ai_chatbot.settings")
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+
+def setup_database(path: str):
+    settings.DATABASES["default"]["NAME"] = path
+    django.setup()
+    from django.core.management import call_command
+    call_command("migrate", "chatbot", verbosity=0)
+
+
+def percentile(samples: list, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+
+def run(label: str, save, flush, threads: int, turns: int, llm_seconds: float):
+    from django.db import connection
+    from chatbot.models import ChatMessage
+
+    ChatMessage.objects.all().delete()
+    saves, replies, errors = [], [], []
+    lock = threading.Lock()
+
+    def user(n: int):
+        local_saves, local_replies = [], []
+        try:
+            for turn in range(turns):
+                started = time.perf_counter()
+                for sender in ("user", "ai"):
+                    t = time.perf_counter()
+                    try:
+                        save(f"user{n}", f"s{n % 4}", sender, f"turn {turn} from {sender} " * 10)
+                    except Exception as e:
+                        errors.append(e)
+                    local_saves.append(time.perf_counter() - t)
+                    if sender == "user":
+                        time.sleep(llm_seconds)
+                local_replies.append(time.perf_counter() - started)
+        finally:
+            connection.close()
+        with lock:
+            saves.extend(local_saves)
+            replies.extend(local_replies)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=user, args=(n,)) for n in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    flush()
+    elapsed = time.perf_counter() - started
+    stored = ChatMessage.objects.count()
+    print(f"{label:<22} {stored / elapsed:>9,.0f}/s  {percentile(saves, 0.5):>7.2f}  {percentile(saves, 0.99):>7.2f}"
+          f"  {percentile(replies, 0.5):>7.1f}  {percentile(replies, 0.99):>7.1f}  {stored:>7,}  {len(errors)}")
+
+
+def main(threads: int, turns: int, llm_ms: float, batch: int, interval: float):
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_database(os.path.join(tmp, "bench.sqlite3"))
+        from chatbot.sessions import record_message, record_messages
+        from chatbot.write_behind import WriteBehindQueue
+
+        print(f"{threads} threads x {turns} turns, {llm_ms:.0f} ms simulated model call per turn")
+        print(f"{'mode':<22} {'msgs/s':>11}  {'save p50':>7}  {'p99 ms':>7}  {'turn p50':>7}  {'p99 ms':>7}  {'stored':>7}  errors")
+        run("sync", record_message, lambda: None, threads, turns, llm_ms / 1000)
+        for durability in ("memory", "journal", "fsync"):
+            writer = WriteBehindQueue(record_messages, batch_size=batch, interval=interval, durability=durability,
+                                      journal_dir=tmp)
+            label = "write-behind" if durability == "memory" else f"write-behind +{durability}"
+            run(label, writer.enqueue, writer.flush, threads, turns, llm_ms / 1000)
+            writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--turns", type=int, default=100)
+    parser.add_argument("--llm-ms", type=float, default=20)
+    parser.add_argument("--batch", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.05)
+    args = parser.parse_args()
+    main(args.threads, args.turns, args.llm_ms, args.batch, args.interval)
@@ -0,0 +1,165 @@
+"""
+Minimal local stand-in for the Gemini REST API, used by the benchmarks.
+
+Speaks HTTP/1.1 with keep-alive on 127.0.0.1 and answers every
+generateContent call after a fixed delay (streamGenerateContent as a few
+SSE chunks spread over the same delay), so client-side behaviour can be
+measured without touching the real API or spending quota.
+
+It also implements enough of cachedContents (create, PATCH ttl, expiry) to
+exercise context caching: a generateContent call that names an unknown or
+expired cache answers 404, like the real API.
+"""
+import asyncio
+import itertools
+import json
+import threading
+import time
+
+REPLY = {
+    "candidates": [{"content": {"role": "model", "parts": [{"text": "Stub reply."}]}}],
+    "usageMetadata": {"promptTokenCount": 8, "candidatesTokenCount": 3, "totalTokenCount": 11},
+}
+MODELS = {"models": [
+    {"name": "models/gemini-stub-flash", "supportedGenerationMethods": ["generateContent", "createCachedContent"],
+     "inputTokenLimit": 32768, "outputTokenLimit": 8192},
+    {"name": "models/gemini-stub-pro", "supportedGenerationMethods": ["generateContent"],
+     "inputTokenLimit": 32768, "outputTokenLimit": 8192},
+]}
+UNAVAILABLE = {"error": {"code": 503, "message": "The model is overloaded.", "status": "UNAVAILABLE"}}
+CACHE_NOT_FOUND = {"error": {"code": 404, "message": "CachedContent not found (or permission denied)",
+                             "status": "NOT_FOUND"}}
+CACHE_CONFLICT = {"error": {"code": 400, "status": "INVALID_ARGUMENT",
+                            "message": "CachedContent can not be used with GenerateContent request setting "
+                                       "system_instruction, tools or tool_config."}}
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 503: "Service Unavailable"}
+
+
+class StubGemini:
+    """Asyncio HTTP server that answers ListModels immediately and generateContent after `delay` seconds."""
+
+    def __init__(self, delay: float = 0.05, host: str = "127.0.0.1"):
+        self.delay = delay
+        self.host = host
+        self.port = None
+        self.requests = 0
+        self.failing = set()  # model ids that answer 503
+        self.delays = {}  # model id -> generateContent delay overriding `delay`
+        self.last_body = None  # raw body of the most recent POST
+        self.cached_contents = {}  # name -> {"model", "expire_at", "systemInstruction"}
+        self._cache_ids = itertools.count(1)
+        self._server = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1beta"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, 0, backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    if name.lower() == "content-length":
+                        length = int(value.strip())
+                if length:
+                    self.last_body = await reader.readexactly(length)
+                self.requests += 1
+                request = json.loads(self.last_body) if length and method in ("POST", "PATCH") else {}
+                if "/cachedContents" in path:
+                    status, reply = self._cached_content(method, path, request)
+                elif method == "POST" and any(f"/{model}:" in path for model in self.failing):
+                    status, reply = 503, UNAVAILABLE
+                elif method == "POST" and request.get("cachedContent") and not self._cache_alive(request["cachedContent"]):
+                    status, reply = 404, CACHE_NOT_FOUND
+                elif method == "POST" and request.get("cachedContent") and request.get("systemInstruction"):
+                    status, reply = 400, CACHE_CONFLICT
+                elif method == "POST" and ":streamGenerateContent" in path:
+                    await self._stream(writer)
+                    continue
+                elif method == "POST":
+                    model = path.split("/models/", 1)[-1].split(":", 1)[0]
+                    await asyncio.sleep(self.delays.get(model, self.delay))
+                    status, reply = 200, REPLY
+                else:
+                    status, reply = 200, MODELS
+                body = json.dumps(reply).encode()
+                head = (f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n"
+                        f"Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n")
+                writer.write(head.encode() + (b"" if method == "HEAD" else body))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _cache_alive(self, name: str) -> bool:
+        entry = self.cached_contents.get(name)
+        return entry is not None and entry["expire_at"] > time.time()
+
+    def _cached_content(self, method: str, path: str, request: dict):
+        """POST cachedContents creates an entry; PATCH cachedContents/{id}?updateMask=ttl extends it."""
+        if method == "POST":
+            name = f"cachedContents/stub{next(self._cache_ids)}"
+            self.cached_contents[name] = {
+                "model": request.get("model"),
+                "expire_at": time.time() + float(request.get("ttl", "3600s").rstrip("s")),
+                "systemInstruction": request.get("systemInstruction"),
+            }
+        else:
+            name = "cachedContents/" + path.split("/cachedContents/", 1)[-1].split("?", 1)[0]
+            if not self._cache_alive(name):
+                return 404, CACHE_NOT_FOUND
+            if method == "PATCH":
+                self.cached_contents[name]["expire_at"] = time.time() + float(request["ttl"].rstrip("s"))
+        entry = self.cached_contents[name]
+        expire = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(entry["expire_at"]))
+        return 200, {"name": name, "model": entry["model"], "expireTime": expire}
+
+    async def _stream(self, writer, chunks: int = 4):
+        """Answer streamGenerateContent?alt=sse with `chunks` SSE events spread over `delay`."""
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                     b"Transfer-Encoding: chunked\r\nConnection: keep-alive\r\n\r\n")
+        for i in range(chunks):
+            await asyncio.sleep(self.delay / chunks)
+            part = {"candidates": [{"content": {"role": "model", "parts": [{"text": f"part{i} "}]}}]}
+            if i == chunks - 1:
+                part["usageMetadata"] = REPLY["usageMetadata"]  # the real API reports usage on the final chunk
+            event = f"data: {json.dumps(part)}\r\n\r\n".encode()
+            writer.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+def start_in_thread(delay: float = 0.05) -> StubGemini:
+    """Run a StubGemini on a private event loop in a daemon thread (for synchronous benchmarks)."""
+    loop = asyncio.new_event_loop()
+    stub = StubGemini(delay)
+    ready = threading.Event()
+
+    def _run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(stub.start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=_run, daemon=True).start()
+    ready.wait()
+    return stub
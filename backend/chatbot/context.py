@@ -0,0 +1,207 @@
+# chatbot/context.py
+"""
+Multi-turn context assembly for generateContent.
+
+Each (user_id, session_id) keeps a ring buffer of its most recent messages
+in an in-process LRU. A turn reads its history from that buffer and only goes
+to the database on a miss: the first turn a worker sees for a session, or a
+session evicted from the LRU.
+
+Another worker may serve the next turn of the same session, so the buffer
+can fall behind the database. Each buffer remembers the id of the newest
+message it holds. Before a cached buffer is used, that id is checked against
+the session's newest message in the database (one indexed lookup). If they
+differ, the buffer is reloaded. Messages this worker wrote itself move the
+remembered id along with them. A message still queued by the write-behind
+writer has no id yet. Until its batch is written, the newest message that
+has reached the database stands in for it. The assembler turns the history into Gemini's
+native `contents` array, with "user" and "model" roles. It keeps the newest
+turns that fit a token budget, and the new question is always included.
+
+Consecutive messages from the same side are merged, for example when an AI
+reply failed to save. The array must also start with a user turn.
+
+Long sessions are folded into a rolling summary by chatbot/summarizer.py. The
+buffer then holds only the messages after the summary, and the summary goes
+in front of them as context.
+
+Configuration (environment):
+  GEMINI_CONTEXT_ENABLED     0 to send only the latest prompt (default 1)
+  GEMINI_CONTEXT_SESSIONS    sessions kept in memory per process (default 1000)
+  GEMINI_CONTEXT_WINDOW      messages kept per session (default 40)
+  GEMINI_CONTEXT_FRACTION    share of the model's inputTokenLimit history may use (default 0.25)
+  GEMINI_CONTEXT_MAX_TOKENS  hard cap on the context budget in tokens (default 8192)
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+
+from .tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_ENABLED = os.getenv("GEMINI_CONTEXT_ENABLED", "1").lower() not in ("0", "false", "no")
+CONTEXT_SESSIONS = int(os.getenv("GEMINI_CONTEXT_SESSIONS", "1000"))
+CONTEXT_WINDOW = int(os.getenv("GEMINI_CONTEXT_WINDOW", "40"))
+CONTEXT_FRACTION = float(os.getenv("GEMINI_CONTEXT_FRACTION", "0.25"))
+CONTEXT_MAX_TOKENS = int(os.getenv("GEMINI_CONTEXT_MAX_TOKENS", "8192"))
+
+DEFAULT_INPUT_TOKEN_LIMIT = 30720
+ROLES = {"user": "user", "ai": "model"}
+SUMMARY_PREFIX = "Summary of our conversation so far:\n"
+
+
+def token_budget(input_token_limit: int | None, fraction: float = CONTEXT_FRACTION,
+                 max_tokens: int = CONTEXT_MAX_TOKENS) -> int:
+    """Context budget for a model whose ListModels entry reports `input_token_limit`."""
+    return min(max_tokens, int((input_token_limit or DEFAULT_INPUT_TOKEN_LIMIT) * fraction))
+
+
+def contents_tokens(contents: list) -> int:
+    return sum(estimate_tokens(part.get("text", "")) for turn in contents for part in turn["parts"])
+
+
+class _SessionWindow:
+    __slots__ = ("summary", "ring", "last_id", "pending")
+
+    def __init__(self, summary: str, ring: deque, last_id: int | None):
+        self.summary = summary
+        self.ring = ring
+        self.last_id = last_id
+        self.pending = deque()  # ChatMessages appended here, oldest first, until each has been given an id
+
+    def newest_id(self) -> int | None:
+        """Id of the newest message in the ring that has reached the database."""
+        while self.pending and self.pending[0].id is not None:
+            self.last_id = self.pending.popleft().id
+        return self.last_id
+
+
+class ContextAssembler:
+    """
+    Per-session ring buffers of (sender, text, tokens) in an LRU.
+    `load_history(user_id, session_id, limit)` returns (summary, rows): the session's rolling summary ('' if none)
+    and the newest `limit` messages after it as (sender, text), oldest first.
+    `latest_id(user_id, session_id)` returns the id of the session's newest visible message (None if it has none).
+    """
+
+    def __init__(self, load_history, latest_id, capacity: int = CONTEXT_SESSIONS, window: int = CONTEXT_WINDOW):
+        self.load_history = load_history
+        self.latest_id = latest_id
+        self.capacity = capacity
+        self.window = window
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _window(self, user_id: str, session_id: str) -> _SessionWindow:
+        key = (user_id, session_id)
+        # read before the history, so a message landing in between makes the next check reload
+        latest = self.latest_id(user_id, session_id)
+        with self._lock:
+            window = self._sessions.get(key)
+            if window is not None:
+                if window.newest_id() == latest:
+                    self._sessions.move_to_end(key)
+                    self.hits += 1
+                    return window
+                del self._sessions[key]  # another worker wrote to (or cleared) the session
+                self.stale += 1
+            self.misses += 1
+        summary, rows = self.load_history(user_id, session_id, self.window)
+        ring = deque(((sender, text, estimate_tokens(text)) for sender, text in rows), maxlen=self.window)
+        window = _SessionWindow(summary, ring, latest)
+        with self._lock:
+            # another thread may have backfilled meanwhile; keep whichever is already cached
+            window = self._sessions.setdefault(key, window)
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self.capacity:
+                self._sessions.popitem(last=False)
+            return window
+
+    def history(self, user_id: str, session_id: str, budget: int) -> list:
+        """`contents` entries for the summary plus the newest messages whose estimated tokens fit in `budget`."""
+        window = self._window(user_id, session_id)
+        with self._lock:
+            summary = window.summary
+            messages = list(window.ring)
+        picked, used = [], 0
+        if summary:
+            summary = SUMMARY_PREFIX + summary
+            used = estimate_tokens(summary)
+        for sender, text, tokens in reversed(messages):
+            if used + tokens > budget:
+                break
+            picked.append((sender, text))
+            used += tokens
+        if summary and used <= budget:
+            picked.append(("user", summary))
+        picked.reverse()
+
+        contents = []
+        for sender, text in picked:
+            role = ROLES.get(sender, "user")
+            if contents and contents[-1]["role"] == role:
+                contents[-1]["parts"].append({"text": text})
+            else:
+                contents.append({"role": role, "parts": [{"text": text}]})
+        while contents and contents[0]["role"] != "user":
+            contents.pop(0)
+        return contents
+
+    def build_contents(self, user_id: str, session_id: str, prompt: str, budget: int) -> tuple:
+        """Return (history, contents): prior turns within the budget, and those turns plus `prompt` as the user turn."""
+        history = self.history(user_id, session_id, max(0, budget - estimate_tokens(prompt)))
+        contents = [dict(turn, parts=list(turn["parts"])) for turn in history]
+        if contents and contents[-1]["role"] == "user":
+            contents[-1]["parts"].append({"text": prompt})
+        else:
+            contents.append({"role": "user", "parts": [{"text": prompt}]})
+        return history, contents
+
+    def append(self, user_id: str, session_id: str, sender: str, text: str, message=None):
+        """
+        Record a message that was just written; sessions not in memory are backfilled from the DB later.
+        `message` is the saved (or queued) ChatMessage, None if saving failed.
+        """
+        with self._lock:
+            window = self._sessions.get((user_id, session_id))
+            if window is not None:
+                window.ring.append((sender, text, estimate_tokens(text)))
+                if message is not None:
+                    window.pending.append(message)
+
+    def unsummarized(self, user_id: str, session_id: str) -> int:
+        """Messages held for a cached session beyond its summary (0 if the session is not in memory)."""
+        with self._lock:
+            window = self._sessions.get((user_id, session_id))
+            return len(window.ring) if window is not None else 0
+
+    def invalidate(self, user_id: str, session_id: str):
+        with self._lock:
+            self._sessions.pop((user_id, session_id), None)
+
+    def invalidate_user(self, user_id: str):
+        with self._lock:
+            for key in [key for key in self._sessions if key[0] == user_id]:
+                del self._sessions[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "sessions": len(self._sessions),
+                "capacity": self.capacity,
+                "window": self.window,
+                "hits": self.hits,
+                "db_backfills": self.misses,
+                "stale_reloads": self.stale,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+def build_context_assembler(load_history, latest_id) -> ContextAssembler | None:
+    return ContextAssembler(load_history, latest_id) if CONTEXT_ENABLED else None
@@ -0,0 +1,213 @@
+# chatbot/db_health.py
+"""
+Database health tracking without a SELECT 1 per request.
+
+Every view used to run SELECT 1 before doing real work, which is one extra DB
+round trip per request. Now connectivity is inferred from real traffic:
+
+  * An execute wrapper goes on every new DB connection through the
+    connection_created signal. It sees the outcome of each query. A query
+    that succeeds marks the database up. One that fails with
+    OperationalError or InterfaceError makes the database suspect. Lock
+    contention ("database is locked" on SQLite, lock wait timeouts and
+    deadlocks elsewhere) is left out: it means the database is busy, not
+    gone.
+  * Views report DB errors they catch (record_failure). This covers failures
+    to connect, which happen before any query reaches the wrapper.
+  * A suspect database is probed with SELECT 1 straight away, and only a
+    failed probe marks it down. OperationalError also covers errors that
+    belong to one query: on SQLite, "no such table", a malformed statement,
+    "disk I/O error" or "database or disk is full". Without the probe, any
+    of these in one view would make every view answer 503 until the next
+    probe.
+  * A background thread probes with SELECT 1 only when nothing else has
+    touched the database for `probe_interval`. While the database is down it
+    probes every `retry_interval` instead, and the first success brings it
+    back up.
+
+Views call available(), which only reads the cached status. They answer 503
+with Retry-After straight away while the database is known to be down,
+instead of queueing on connection timeouts. Persistent connections
+(CONN_MAX_AGE with CONN_HEALTH_CHECKS, see settings.py) remove the
+per-request connection setup.
+
+Configuration (environment):
+  GEMINI_DB_HEALTH          0 to disable tracking; views then never fail fast (default 1)
+  GEMINI_DB_PROBE_INTERVAL  seconds of DB silence before a background probe (default 30)
+  GEMINI_DB_RETRY_INTERVAL  probe period while the database is down (default 5)
+"""
+import logging
+import os
+import threading
+import time
+
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.db.utils import InterfaceError, OperationalError
+
+logger = logging.getLogger(__name__)
+
+DB_HEALTH_ENABLED = os.getenv("GEMINI_DB_HEALTH", "1").lower() not in ("0", "false", "no")
+DB_PROBE_INTERVAL = float(os.getenv("GEMINI_DB_PROBE_INTERVAL", "30"))
+DB_RETRY_INTERVAL = float(os.getenv("GEMINI_DB_RETRY_INTERVAL", "5"))
+
+CONNECTIVITY_ERRORS = (OperationalError, InterfaceError)
+LOCK_CONTENTION_MESSAGES = ("database is locked", "database table is locked", "lock wait timeout", "deadlock")
+
+
+def is_lock_contention(exc: BaseException) -> bool:
+    """A write that lost a lock race; retrying later succeeds once the other writer commits."""
+    return isinstance(exc, OperationalError) and any(m in str(exc).lower() for m in LOCK_CONTENTION_MESSAGES)
+
+
+def is_connectivity_error(exc: BaseException) -> bool:
+    return isinstance(exc, CONNECTIVITY_ERRORS) and not is_lock_contention(exc)
+
+
+class DatabaseHealth:
+    """Cached up/down status of the default database, fed by real queries and a background probe."""
+
+    def __init__(self, probe_interval: float = DB_PROBE_INTERVAL, retry_interval: float = DB_RETRY_INTERVAL,
+                 alias: str = "default"):
+        self.probe_interval = probe_interval
+        self.retry_interval = retry_interval
+        self.alias = alias
+        self.up = True
+        self.message = "No database errors seen"
+        self.last_success = 0.0
+        self.last_failure = 0.0
+        self.down_since = None
+        self.failures = 0
+        self.unconfirmed = 0
+        self.probes = 0
+        self._suspect = False
+        self.fast_failed = 0
+        self._thread = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    # -- signals from real traffic --
+
+    def record_success(self):
+        self.last_success = time.monotonic()
+        if not self.up:
+            with self._lock:
+                if not self.up:
+                    outage = time.monotonic() - self.down_since
+                    self.up, self.down_since = True, None
+                    self.message = "Database connection successful"
+                    logger.info(f"Database is reachable again after {outage:.1f}s")
+
+    def record_failure(self, exc: BaseException, confirmed: bool = False) -> bool:
+        """
+        Note a possible connectivity error; returns whether `exc` is one. The database is marked down only when
+        `confirmed` (a failed probe); otherwise the probe thread is asked to check now.
+        """
+        if not is_connectivity_error(exc):
+            return False
+        if not confirmed:
+            if self.up:
+                self._suspect = True
+                if self._thread is None:
+                    self.start()
+                self._wake.set()
+            return True
+        with self._lock:
+            self.failures += 1
+            self.last_failure = time.monotonic()
+            self.message = f"Database connection failed: {exc}"
+            self._suspect = False
+            if self.up:
+                self.up, self.down_since = False, self.last_failure
+                logger.error(f"Database marked down: {exc}")
+        return True
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        try:
+            result = execute(sql, params, many, context)
+        except CONNECTIVITY_ERRORS as e:
+            self.record_failure(e)
+            raise
+        self.record_success()
+        return result
+
+    def install(self, sender=None, connection=None, **kwargs):
+        """connection_created receiver: attach the execute wrapper once per connection wrapper."""
+        if connection is not None and connection.alias == self.alias and self.execute_wrapper not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self.execute_wrapper)
+
+    # -- view side --
+
+    def available(self) -> bool:
+        """Cached status; starts the probe thread on first use."""
+        if self._thread is None:
+            self.start()
+        if not self.up:
+            self.fast_failed += 1
+        return self.up
+
+    def retry_after(self) -> float:
+        return self.retry_interval
+
+    # -- background probe --
+
+    def probe(self) -> bool:
+        self.probes += 1
+        try:
+            with connections[self.alias].cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except Exception as e:
+            if not self.record_failure(e, confirmed=True):
+                logger.warning(f"Database probe failed unexpectedly: {e}")
+            return False
+        finally:
+            connections[self.alias].close_if_unusable_or_obsolete()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-health-probe", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            interval = self.probe_interval if self.up else self.retry_interval
+            if self._wake.wait(interval):
+                self._wake.clear()
+                if self._suspect:
+                    self._suspect = False
+                    if self.probe():
+                        with self._lock:
+                            self.unconfirmed += 1
+                        logger.warning("Database error not confirmed by a probe; treating it as a failed query")
+                continue
+            if not self.up or time.monotonic() - self.last_success >= self.probe_interval:
+                self.probe()
+
+    def status(self) -> tuple:
+        """(connected, message) as reported by the health endpoint."""
+        return self.up, self.message
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "up": self.up,
+            "down_for_seconds": round(now - self.down_since, 1) if self.down_since else None,
+            "last_success_seconds_ago": round(now - self.last_success, 1) if self.last_success else None,
+            "connectivity_failures": self.failures,
+            "unconfirmed_failures": self.unconfirmed,
+            "probes": self.probes,
+            "fast_failed_requests": self.fast_failed,
+            "conn_max_age": connection.settings_dict.get("CONN_MAX_AGE"),
+        }
+
+
+def build_db_health() -> DatabaseHealth | None:
+    if not DB_HEALTH_ENABLED:
+        return None
+    health = DatabaseHealth()
+    connection_created.connect(health.install, weak=False, dispatch_uid="chatbot.db_health")
+    # this thread's connection may already be open (e.g. from startup checks)
+    health.install(connection=connections[health.alias])
+    return health
@@ -0,0 +1,119 @@
+# chatbot/export.py
+"""
+Streaming export of chat messages as NDJSON or as one JSON document.
+
+Rows are read with values_list().iterator(chunk_size), so no ChatMessage
+instances are built and only one chunk of rows is in memory at a time.
+Serialized rows are then packed into writes of about BUFFER_BYTES each. The
+first bytes of a 50k-message session go out after one chunk, and worker memory
+stays flat however large the export is. The history export endpoint
+(StreamingHttpResponse) and the export_history management command use the same
+generators.
+
+Formats:
+  ndjson  one JSON object per line
+  json    {"messages": [ ... ]}, streamed in pieces
+
+Configuration (environment):
+  GEMINI_EXPORT_CHUNK_SIZE  rows fetched per database round trip (default 2000)
+"""
+import json
+import os
+from datetime import datetime, timezone as dt_timezone
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import ChatMessage
+from .purge import hide_cleared
+
+EXPORT_CHUNK_SIZE = int(os.getenv("GEMINI_EXPORT_CHUNK_SIZE", "2000"))
+
+FORMATS = {"ndjson": "application/x-ndjson", "json": "application/json"}
+FIELDS = ('id', 'user_id', 'session_id', 'sender', 'text', 'timestamp')
+BUFFER_BYTES = 64 * 1024
+
+
+class InvalidExportRequest(ValueError):
+    """An export filter or format could not be parsed."""
+
+
+def parse_bound(value: str | None, end: bool = False) -> datetime | None:
+    """ISO date or datetime; a bare date covers that whole day (midnight, or end of day when `end`)."""
+    if not value:
+        return None
+    try:
+        parsed = parse_datetime(value)
+        day = parse_date(value) if parsed is None else None
+    except ValueError as e:
+        raise InvalidExportRequest(f"Invalid date {value!r}") from e
+    if parsed is None:
+        if day is None:
+            raise InvalidExportRequest(f"Invalid date {value!r}")
+        parsed = datetime.combine(day, datetime.max.time() if end else datetime.min.time())
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, dt_timezone.utc)
+    return parsed
+
+
+def export_rows(user_id: str | None = None, session_id: str | None = None, since: datetime | None = None,
+                until: datetime | None = None, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """Iterator of FIELDS tuples ordered by user, session, (timestamp, id); cleared messages are left out."""
+    rows = hide_cleared(ChatMessage.objects.all())
+    if user_id is not None:
+        rows = rows.filter(user_id=user_id)
+    if session_id is not None:
+        rows = rows.filter(session_id=session_id)
+    if since is not None:
+        rows = rows.filter(timestamp__gte=since)
+    if until is not None:
+        rows = rows.filter(timestamp__lte=until)
+    rows = rows.order_by('user_id', 'session_id', 'timestamp', 'id')
+    return rows.values_list(*FIELDS).iterator(chunk_size=chunk_size)
+
+
+def _record(row: tuple) -> str:
+    message_id, user_id, session_id, sender, text, stamp = row
+    return json.dumps({
+        'id': message_id,
+        'user_id': user_id,
+        'session_id': session_id,
+        'sender': sender,
+        'text': text,
+        'timestamp': stamp.isoformat(),
+    }, ensure_ascii=False)
+
+
+def _buffered(pieces):
+    """Join small strings into ~BUFFER_BYTES UTF-8 chunks."""
+    buffer, size = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= BUFFER_BYTES:
+            yield "".join(buffer).encode("utf-8")
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+def ndjson_chunks(rows):
+    return _buffered(_record(row) + "\n" for row in rows)
+
+
+def json_chunks(rows):
+    def pieces():
+        yield '{"messages": ['
+        separator = ""
+        for row in rows:
+            yield separator + _record(row)
+            separator = ","
+        yield "]}\n"
+
+    return _buffered(pieces())
+
+
+def export_chunks(fmt: str, rows):
+    if fmt not in FORMATS:
+        raise InvalidExportRequest(f"Unknown export format {fmt!r}; use one of {', '.join(FORMATS)}")
+    return ndjson_chunks(rows) if fmt == "ndjson" else json_chunks(rows)
@@ -0,0 +1,372 @@
+# chatbot/failover.py
+"""
+Ranked model failover with a circuit breaker per model.
+
+choose_model() scores every model returned by ListModels. FailoverChain keeps
+that whole ranking, not just the winner. A generation call goes to the
+best-ranked model whose breaker admits traffic. If that model answers with a
+429, a 5xx or a connection error, the call moves to the next model, so
+users do not get a 502 just because the top model is having a bad minute.
+
+Streamed replies go through open_stream()/open_stream_async(). The caller's
+start function reads the first chunk eagerly, so a model that fails to start
+is skipped just as in call(). Once chunks flow the stream is committed to
+that model, and its outcome is recorded when the stream ends: success,
+a failure (an error mid-stream) or neutral (the client went away).
+
+Breaker states:
+  closed     normal; outcomes are tracked over a sliding time window
+  open       error rate in the window crossed the threshold; the model is skipped
+             until the cooldown elapses (no request waits on it)
+  half_open  cooldown elapsed; one probe request is let through, success closes
+             the breaker, failure re-opens it for another cooldown
+
+Configuration (environment):
+  GEMINI_FAILOVER_DEPTH          models kept in the chain (default 3)
+  GEMINI_BREAKER_WINDOW          seconds of history used for the error rate (default 60)
+  GEMINI_BREAKER_FAILURE_RATE    error rate that opens the breaker (default 0.5)
+  GEMINI_BREAKER_MIN_REQUESTS    calls in the window before the rate is trusted (default 5)
+  GEMINI_BREAKER_COOLDOWN        seconds a breaker stays open (default 30)
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+FAILOVER_DEPTH = int(os.getenv("GEMINI_FAILOVER_DEPTH", "3"))
+BREAKER_WINDOW = float(os.getenv("GEMINI_BREAKER_WINDOW", "60"))
+BREAKER_FAILURE_RATE = float(os.getenv("GEMINI_BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_MIN_REQUESTS = int(os.getenv("GEMINI_BREAKER_MIN_REQUESTS", "5"))
+BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class NoHealthyModelError(RuntimeError):
+    """Every model in the chain has an open breaker; retry after `retry_after` seconds."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"All models are temporarily unavailable; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def is_failover_error(exc: Exception) -> bool:
+    """429, 5xx, timeouts and connection errors say the model is unhealthy; other 4xx are the caller's fault."""
+    if isinstance(exc, requests.HTTPError):
+        status = exc.response.status_code if exc.response is not None else None
+        return status is None or status == 429 or status >= 500
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker driven by the error rate over a sliding window."""
+
+    def __init__(self, name: str, window: float = BREAKER_WINDOW, failure_rate: float = BREAKER_FAILURE_RATE,
+                 min_requests: int = BREAKER_MIN_REQUESTS, cooldown: float = BREAKER_COOLDOWN):
+        self.name = name
+        self.window = window
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._outcomes = deque()  # (timestamp, ok)
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float):
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._outcomes.popleft()
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self.opened_at = now
+        self.times_opened += 1
+        self._probe_in_flight = False
+        logger.warning(f"Circuit breaker for {self.name} opened")
+
+    def retry_after(self, now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.opened_at + self.cooldown - now) if self.state == OPEN else 0.0
+
+    def allow(self) -> bool:
+        """True if a request may be sent to this model now."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now < self.opened_at + self.cooldown:
+                    return False
+                self.state = HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == HALF_OPEN:
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == HALF_OPEN:
+                logger.info(f"Circuit breaker for {self.name} closed after successful probe")
+                self.state = CLOSED
+                self._outcomes.clear()
+                self._probe_in_flight = False
+            self._outcomes.append((now, True))
+            self._prune(now)
+
+    def record_failure(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == HALF_OPEN:
+                self._open(now)
+                return
+            self._outcomes.append((now, False))
+            self._prune(now)
+            failures = sum(1 for _, ok in self._outcomes if not ok)
+            if len(self._outcomes) >= self.min_requests and failures / len(self._outcomes) >= self.failure_rate:
+                self._open(now)
+
+    def record_neutral(self):
+        """Outcome that says nothing about model health (e.g. a 400); frees a half-open probe slot."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            failures = sum(1 for _, ok in self._outcomes if not ok)
+            total = len(self._outcomes)
+            return {
+                "model": self.name,
+                "state": self.state,
+                "window_requests": total,
+                "window_error_rate": round(failures / total, 4) if total else 0.0,
+                "retry_after": round(self.retry_after(now), 1),
+                "times_opened": self.times_opened,
+            }
+
+
+class FailoverChain:
+    """Ordered list of models, each guarded by its own CircuitBreaker."""
+
+    def __init__(self, models: list | None = None, router=None, **breaker_kwargs):
+        self.router = router
+        self._breaker_kwargs = breaker_kwargs
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self.models = []
+        self.set_models(models or [])
+
+    def set_models(self, models: list):
+        """Replace the ranking; breakers of models that stay in the chain keep their state."""
+        with self._lock:
+            self.models = list(dict.fromkeys(m for m in models if m))
+            for model_id in self.models:
+                if model_id not in self._breakers:
+                    self._breakers[model_id] = CircuitBreaker(model_id, **self._breaker_kwargs)
+
+    def breaker(self, model_id: str) -> CircuitBreaker:
+        with self._lock:
+            if model_id not in self._breakers:
+                self._breakers[model_id] = CircuitBreaker(model_id, **self._breaker_kwargs)
+            return self._breakers[model_id]
+
+    def order(self) -> list:
+        """Models to try for the next request, best first (the router may reorder the static ranking)."""
+        if self.router is not None:
+            return self.router.order(self.models)
+        return list(self.models)
+
+    def alternate(self, model_id: str) -> str:
+        """Next model after `model_id` in the ranking whose breaker is closed; `model_id` itself if none."""
+        models = list(self.models)
+        start = models.index(model_id) + 1 if model_id in models else 0
+        for candidate in models[start:] + models[:start]:
+            if candidate != model_id and self.breaker(candidate).state == CLOSED:
+                return candidate
+        return model_id
+
+    def _observe(self, model_id: str, started: float, ok: bool):
+        if self.router is not None:
+            self.router.observe(model_id, time.monotonic() - started, ok)
+
+    def _unavailable(self, order: list) -> NoHealthyModelError:
+        waits = [self.breaker(m).retry_after() for m in order]
+        return NoHealthyModelError(min(waits) if waits else BREAKER_COOLDOWN)
+
+    def call(self, fn, served=None):
+        """
+        Run fn(model_id) on the first healthy model that succeeds; return (model_id, result).
+        `served(result)` names the model that actually answered when it can differ (a hedged call);
+        if another model answered, this one's outcome is neutral and the hedger records both.
+        """
+        order = self.order()
+        last_error = None
+        for model_id in order:
+            breaker = self.breaker(model_id)
+            if not breaker.allow():
+                continue
+            started = time.monotonic()
+            try:
+                result = fn(model_id)
+            except Exception as e:
+                if not is_failover_error(e):
+                    breaker.record_neutral()
+                    raise
+                breaker.record_failure()
+                self._observe(model_id, started, ok=False)
+                logger.warning(f"Model {model_id} failed ({e}); trying next model in chain")
+                last_error = e
+                continue
+            except BaseException:
+                breaker.record_neutral()
+                raise
+            if served is not None and served(result) != model_id:
+                breaker.record_neutral()
+                return model_id, result
+            breaker.record_success()
+            self._observe(model_id, started, ok=True)
+            return model_id, result
+        if last_error is not None:
+            raise last_error
+        raise self._unavailable(order)
+
+    async def call_async(self, coro_fn, served=None):
+        """asyncio version of call(): await coro_fn(model_id) down the chain."""
+        order = self.order()
+        last_error = None
+        for model_id in order:
+            breaker = self.breaker(model_id)
+            if not breaker.allow():
+                continue
+            started = time.monotonic()
+            try:
+                result = await coro_fn(model_id)
+            except Exception as e:
+                if not is_failover_error(e):
+                    breaker.record_neutral()
+                    raise
+                breaker.record_failure()
+                self._observe(model_id, started, ok=False)
+                logger.warning(f"Model {model_id} failed ({e}); trying next model in chain")
+                last_error = e
+                continue
+            except BaseException:
+                breaker.record_neutral()
+                raise
+            if served is not None and served(result) != model_id:
+                breaker.record_neutral()
+                return model_id, result
+            breaker.record_success()
+            self._observe(model_id, started, ok=True)
+            return model_id, result
+        if last_error is not None:
+            raise last_error
+        raise self._unavailable(order)
+
+    def snapshot(self) -> list:
+        return [self.breaker(model_id).snapshot() for model_id in self.models]
+
+    def open_stream(self, start):
+        """
+        Start a stream on the first healthy model; returns (model_id, chunks).
+        start(model_id) must pull the first chunk (prompts.start_stream) so that a failing model raises here.
+        """
+        order = self.order()
+        last_error = None
+        for model_id in order:
+            breaker = self.breaker(model_id)
+            if not breaker.allow():
+                continue
+            started = time.monotonic()
+            try:
+                chunks = start(model_id)
+            except Exception as e:
+                if not is_failover_error(e):
+                    breaker.record_neutral()
+                    raise
+                breaker.record_failure()
+                self._observe(model_id, started, ok=False)
+                logger.warning(f"Model {model_id} failed to start a stream ({e}); trying next model in chain")
+                last_error = e
+                continue
+            except BaseException:
+                breaker.record_neutral()
+                raise
+            return model_id, self._tracked(model_id, started, chunks)
+        if last_error is not None:
+            raise last_error
+        raise self._unavailable(order)
+
+    def _tracked(self, model_id: str, started: float, chunks):
+        breaker = self.breaker(model_id)
+        try:
+            yield from chunks
+        except Exception as e:
+            if is_failover_error(e):
+                breaker.record_failure()
+                self._observe(model_id, started, ok=False)
+            else:
+                breaker.record_neutral()
+            raise
+        except BaseException:
+            breaker.record_neutral()  # closed early: the client went away, which says nothing about the model
+            raise
+        breaker.record_success()
+        self._observe(model_id, started, ok=True)
+
+    async def open_stream_async(self, start):
+        """asyncio version of open_stream(): `start` is async and returns an async iterator (prompts.start_stream_async)."""
+        order = self.order()
+        last_error = None
+        for model_id in order:
+            breaker = self.breaker(model_id)
+            if not breaker.allow():
+                continue
+            started = time.monotonic()
+            try:
+                chunks = await start(model_id)
+            except Exception as e:
+                if not is_failover_error(e):
+                    breaker.record_neutral()
+                    raise
+                breaker.record_failure()
+                self._observe(model_id, started, ok=False)
+                logger.warning(f"Model {model_id} failed to start a stream ({e}); trying next model in chain")
+                last_error = e
+                continue
+            except BaseException:
+                breaker.record_neutral()
+                raise
+            return model_id, self._tracked_async(model_id, started, chunks)
+        if last_error is not None:
+            raise last_error
+        raise self._unavailable(order)
+
+    async def _tracked_async(self, model_id: str, started: float, chunks):
+        breaker = self.breaker(model_id)
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            if is_failover_error(e):
+                breaker.record_failure()
+                self._observe(model_id, started, ok=False)
+            else:
+                breaker.record_neutral()
+            raise
+        except BaseException:
+            breaker.record_neutral()
+            raise
+        breaker.record_success()
+        self._observe(model_id, started, ok=True)
@@ -0,0 +1,329 @@
+# chatbot/gemini_client.py
+"""
+Pooled HTTP client for the Google Generative Language REST API.
+
+A single GeminiClient per worker process owns a keep-alive connection pool, so
+chat turns reuse warm TCP/TLS connections instead of paying a fresh handshake
+on every call. When httpx with the `h2` extra is installed the client talks
+HTTP/2 and multiplexes concurrent calls over one connection; otherwise it
+falls back to a pooled requests.Session.
+
+Configuration (environment):
+  GEMINI_API_BASE             API root (default the public v1beta endpoint)
+  GEMINI_POOL_SIZE            max pooled connections per worker (default 10)
+  GEMINI_PREWARM_CONNECTIONS  connections opened at startup (default 1)
+  GEMINI_HTTP2                set to 0 to force HTTP/1.1 (default 1)
+  GEMINI_MAX_CONCURRENCY      in-flight calls per AsyncGeminiClient (default 256)
+  GEMINI_CONNECT_TIMEOUT      connect timeout in seconds (default 5)
+
+AsyncGeminiClient is the asyncio counterpart used by the FastAPI service: it
+never blocks the event loop and bounds in-flight upstream calls with a
+semaphore. It is built on aiohttp, whose connection pool stays cheap with
+hundreds of concurrent requests (HTTP/1.1 keep-alive only).
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import h2  # noqa: F401  (httpx needs it for http2=True)
+    HAVE_H2 = True
+except ImportError:
+    HAVE_H2 = False
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", "10"))
+PREWARM_CONNECTIONS = int(os.getenv("GEMINI_PREWARM_CONNECTIONS", "1"))
+HTTP2_ENABLED = os.getenv("GEMINI_HTTP2", "1").lower() not in ("0", "false", "no")
+MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "256"))
+CONNECT_TIMEOUT = float(os.getenv("GEMINI_CONNECT_TIMEOUT", "5"))
+
+LIST_TIMEOUT = 15
+GENERATE_TIMEOUT = 30
+
+
+class GeminiHTTPError(requests.HTTPError):
+    """HTTP error status from the Gemini API (subclass of requests.HTTPError so existing handlers keep working)."""
+
+
+def parse_sse_line(line) -> dict | None:
+    """Return the JSON payload of an SSE `data:` line, or None for blank/comment/other lines."""
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    line = line.strip()
+    if not line.startswith("data:"):
+        return None
+    data = line[len("data:"):].strip()
+    if not data or data == "[DONE]":
+        return None
+    return json.loads(data)
+
+
+def extract_chunk_text(chunk: dict) -> str:
+    """Text delta carried by one streamGenerateContent chunk ('' for metadata-only chunks)."""
+    texts = []
+    for candidate in chunk.get("candidates") or []:
+        content = candidate.get("content") if isinstance(candidate, dict) else None
+        if isinstance(content, dict):
+            for part in content.get("parts") or []:
+                if isinstance(part, dict) and isinstance(part.get("text"), str):
+                    texts.append(part["text"])
+        break
+    return "".join(texts)
+
+
+def format_sse(data: dict, event: str | None = None) -> str:
+    """Serialize one server-sent event for clients of the streaming endpoints."""
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data)}\n\n"
+
+
+def clean_model_id(model_id: str) -> str:
+    """Strip the 'models/' resource prefix returned by ListModels."""
+    if model_id.startswith("models/"):
+        return model_id[len("models/"):]
+    return model_id
+
+
+class GeminiClient:
+    """Keep-alive client for generativelanguage.googleapis.com shared by all generation paths."""
+
+    def __init__(self, api_key: str, base_url: str = GOOGLE_BASE, pool_size: int = POOL_SIZE,
+                 http2: bool = HTTP2_ENABLED):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.http2 = bool(http2 and httpx is not None and HAVE_H2)
+        self._headers = {"Content-Type": "application/json", "x-goog-api-key": api_key}
+        if self.http2:
+            self._http = httpx.Client(
+                http2=True,
+                headers=self._headers,
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            )
+        else:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update(self._headers)
+            self._http = session
+        logger.info(f"Gemini client ready (pool_size={pool_size}, http2={self.http2})")
+
+    def _request(self, method: str, path: str, timeout: float, **kwargs):
+        """Send a request through the pool and raise GeminiHTTPError on 4xx/5xx."""
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        if self.http2:
+            try:
+                resp = self._http.request(method, url, timeout=timeout, **kwargs)
+            except httpx.TimeoutException as e:
+                raise requests.Timeout(str(e)) from e
+            except httpx.TransportError as e:
+                raise requests.ConnectionError(str(e)) from e
+        else:
+            resp = self._http.request(method, url, timeout=timeout, **kwargs)
+        if resp.status_code >= 400:
+            raise GeminiHTTPError(f"{resp.status_code} Error for {method} {path}", response=resp)
+        return resp
+
+    def list_models(self) -> list:
+        """Call ListModels and return the raw 'models' array (or empty list)."""
+        resp = self._request("GET", "models", timeout=LIST_TIMEOUT)
+        return resp.json().get("models", [])
+
+    def generate_content(self, model_id: str, payload: dict, timeout: float = GENERATE_TIMEOUT) -> dict:
+        """Call :generateContent for a model and return the parsed JSON."""
+        path = f"models/{clean_model_id(model_id)}:generateContent"
+        return self._request("POST", path, timeout=timeout, json=payload).json()
+
+    def create_cached_content(self, body: dict, timeout: float = LIST_TIMEOUT) -> dict:
+        """POST cachedContents; returns the CachedContent resource ('name', 'expireTime', ...)."""
+        return self._request("POST", "cachedContents", timeout=timeout, json=body).json()
+
+    def update_cached_content_ttl(self, name: str, ttl_seconds: float, timeout: float = LIST_TIMEOUT) -> dict:
+        """Extend a CachedContent's lifetime to `ttl_seconds` from now."""
+        path = f"{name}?updateMask=ttl"
+        return self._request("PATCH", path, timeout=timeout, json={"ttl": f"{int(ttl_seconds)}s"}).json()
+
+    def stream_generate_content(self, model_id: str, payload: dict, timeout: float = GENERATE_TIMEOUT):
+        """Call :streamGenerateContent?alt=sse and yield each parsed JSON chunk as it arrives."""
+        path = f"models/{clean_model_id(model_id)}:streamGenerateContent?alt=sse"
+        url = f"{self.base_url}/{path}"
+        if self.http2:
+            try:
+                with self._http.stream("POST", url, json=payload, timeout=timeout) as resp:
+                    if resp.status_code >= 400:
+                        resp.read()
+                        raise GeminiHTTPError(f"{resp.status_code} Error for POST {path}", response=resp)
+                    for line in resp.iter_lines():
+                        chunk = parse_sse_line(line)
+                        if chunk is not None:
+                            yield chunk
+            except httpx.TimeoutException as e:
+                raise requests.Timeout(str(e)) from e
+            except httpx.TransportError as e:
+                raise requests.ConnectionError(str(e)) from e
+            return
+        with self._http.post(url, json=payload, timeout=timeout, stream=True) as resp:
+            if resp.status_code >= 400:
+                resp.content  # read the error body before the with block closes the response
+                raise GeminiHTTPError(f"{resp.status_code} Error for POST {path}", response=resp)
+            for line in resp.iter_lines(decode_unicode=True):
+                chunk = parse_sse_line(line) if line else None
+                if chunk is not None:
+                    yield chunk
+
+    def warm(self, connections: int = PREWARM_CONNECTIONS):
+        """Open `connections` pooled connections up front so the first chat turns skip the handshake."""
+        connections = max(0, min(connections, self.pool_size))
+
+        def _touch():
+            try:
+                self._http.request("HEAD", f"{self.base_url}/models", timeout=LIST_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Gemini connection pre-warm failed: {e}")
+
+        threads = [threading.Thread(target=_touch, daemon=True) for _ in range(connections)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def close(self):
+        self._http.close()
+
+
+class _BufferedResponse:
+    """Fully read aiohttp response exposing the parts of the requests.Response API our handlers use."""
+
+    def __init__(self, status_code: int, headers, body: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = body
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncGeminiClient:
+    """Non-blocking Gemini client for asyncio services, with a bounded number of in-flight calls."""
+
+    def __init__(self, api_key: str, base_url: str = GOOGLE_BASE, max_concurrency: int = MAX_CONCURRENCY):
+        if aiohttp is None:
+            raise RuntimeError("AsyncGeminiClient requires aiohttp (pip install aiohttp).")
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._http = aiohttp.ClientSession(
+            headers={"Content-Type": "application/json", "x-goog-api-key": api_key},
+            connector=aiohttp.TCPConnector(limit=max_concurrency, keepalive_timeout=60),
+        )
+        logger.info(f"Async Gemini client ready (max_concurrency={max_concurrency})")
+
+    @property
+    def in_flight(self) -> int:
+        return self.max_concurrency - self._semaphore._value
+
+    async def _request(self, method: str, path: str, timeout: float, **kwargs) -> _BufferedResponse:
+        """Send a request once a concurrency slot is free; raise GeminiHTTPError on 4xx/5xx."""
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        client_timeout = aiohttp.ClientTimeout(total=timeout, connect=CONNECT_TIMEOUT)
+        async with self._semaphore:
+            try:
+                async with self._http.request(method, url, timeout=client_timeout, **kwargs) as raw:
+                    resp = _BufferedResponse(raw.status, raw.headers, await raw.read())
+            except asyncio.TimeoutError as e:
+                raise requests.Timeout(f"Timed out after {timeout}s: {method} {path}") from e
+            except aiohttp.ClientError as e:
+                raise requests.ConnectionError(str(e)) from e
+        if resp.status_code >= 400:
+            raise GeminiHTTPError(f"{resp.status_code} Error for {method} {path}", response=resp)
+        return resp
+
+    async def list_models(self) -> list:
+        """Call ListModels and return the raw 'models' array (or empty list)."""
+        resp = await self._request("GET", "models", timeout=LIST_TIMEOUT)
+        return resp.json().get("models", [])
+
+    async def generate_content(self, model_id: str, payload: dict, timeout: float = GENERATE_TIMEOUT) -> dict:
+        """Call :generateContent for a model and return the parsed JSON."""
+        path = f"models/{clean_model_id(model_id)}:generateContent"
+        resp = await self._request("POST", path, timeout=timeout, json=payload)
+        return resp.json()
+
+    async def stream_generate_content(self, model_id: str, payload: dict, timeout: float = GENERATE_TIMEOUT):
+        """Call :streamGenerateContent?alt=sse and yield each parsed JSON chunk as it arrives."""
+        path = f"models/{clean_model_id(model_id)}:streamGenerateContent?alt=sse"
+        url = f"{self.base_url}/{path}"
+        client_timeout = aiohttp.ClientTimeout(total=timeout, connect=CONNECT_TIMEOUT)
+        async with self._semaphore:
+            try:
+                async with self._http.post(url, json=payload, timeout=client_timeout) as raw:
+                    if raw.status >= 400:
+                        resp = _BufferedResponse(raw.status, raw.headers, await raw.read())
+                        raise GeminiHTTPError(f"{raw.status} Error for POST {path}", response=resp)
+                    async for line in raw.content:
+                        chunk = parse_sse_line(line)
+                        if chunk is not None:
+                            yield chunk
+            except asyncio.TimeoutError as e:
+                raise requests.Timeout(f"Timed out after {timeout}s: POST {path}") from e
+            except aiohttp.ClientError as e:
+                raise requests.ConnectionError(str(e)) from e
+
+    async def warm(self, connections: int = PREWARM_CONNECTIONS):
+        """Open `connections` pooled connections concurrently before serving traffic."""
+        async def _touch():
+            try:
+                async with self._http.head(f"{self.base_url}/models",
+                                           timeout=aiohttp.ClientTimeout(total=LIST_TIMEOUT)):
+                    pass
+            except Exception as e:
+                logger.warning(f"Gemini connection pre-warm failed: {e}")
+
+        await asyncio.gather(*(_touch() for _ in range(max(0, min(connections, self.max_concurrency)))))
+
+    async def aclose(self):
+        await self._http.close()
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client(api_key: str | None = None) -> GeminiClient:
+    """Return this process's shared GeminiClient, creating it on first use (and again after a fork)."""
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            key = api_key or os.getenv("GOOGLE_API_KEY")
+            if not key:
+                raise RuntimeError("Set GOOGLE_API_KEY in your environment (.env) before running.")
+            _client = GeminiClient(key)
+            _client_pid = os.getpid()
+        return _client
@@ -0,0 +1,252 @@
+# chatbot/hedging.py
+"""
+Hedged generateContent requests to cut the latency tail.
+
+Most generation calls finish well under the 30s timeout, but a few percent
+take several times the median. With hedging on, a call that has not answered
+after the observed p95 latency of its model (from the LatencyRouter in
+chatbot/router.py) gets a second, identical request. The hedge goes to the
+next healthy model in the chain, or to the same model if there is none. The
+first successful response wins. The loser is cancelled: asyncio tasks are
+cancelled outright. Blocking calls cannot be interrupted, so their result is
+discarded when they finish.
+
+A blocking call runs inline when no hedge is possible: the router has no
+samples for the model yet, or the budget is empty. Otherwise the primary and
+the hedge each get their own thread, so a request never queues behind others
+for a worker, and queueing time cannot trigger extra hedges.
+
+Outcomes go to the model that produced them. Given served=Hedger.served, the
+chain records the primary model only when the primary answered. The hedger
+records the hedge's outcome on the alternate's breaker and router stats, and
+records a losing primary's outcome when that call finishes.
+
+Every hedge is an extra billed request, so hedges are limited by a token
+bucket. Each request earns `budget` tokens and each hedge spends one, which
+keeps hedges at about `budget` of all requests plus a small burst.
+
+Configuration (environment):
+  GEMINI_HEDGING             1 to enable hedging (default 0)
+  GEMINI_HEDGE_PERCENTILE    latency percentile used as the hedge delay (default 95)
+  GEMINI_HEDGE_MIN_DELAY     lower bound on the hedge delay in seconds (default 0.5)
+  GEMINI_HEDGE_BUDGET        maximum fraction of requests that may be hedged (default 0.05)
+  GEMINI_HEDGE_TARGET        "alternate" (next model in the chain) or "same" (default alternate)
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+from .failover import is_failover_error
+
+logger = logging.getLogger(__name__)
+
+HEDGING_ENABLED = os.getenv("GEMINI_HEDGING", "0").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY = float(os.getenv("GEMINI_HEDGE_MIN_DELAY", "0.5"))
+HEDGE_BUDGET = float(os.getenv("GEMINI_HEDGE_BUDGET", "0.05"))
+HEDGE_TARGET = os.getenv("GEMINI_HEDGE_TARGET", "alternate").lower()
+
+BUDGET_BURST = 10.0
+
+
+class HedgeBudget:
+    """Token bucket that caps hedges at `fraction` of requests (plus `burst`)."""
+
+    def __init__(self, fraction: float = HEDGE_BUDGET, burst: float = BUDGET_BURST):
+        self.fraction = fraction
+        self.burst = burst
+        self._tokens = burst
+        self._lock = threading.Lock()
+
+    def earn(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.fraction)
+
+    def available(self) -> bool:
+        with self._lock:
+            return self._tokens >= 1.0
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+            return False
+
+
+class Hedger:
+    """Runs a generation call and, if it is slower than the model's observed percentile, a hedge next to it."""
+
+    def __init__(self, router, chain=None, percentile: float = HEDGE_PERCENTILE, min_delay: float = HEDGE_MIN_DELAY,
+                 budget: float = HEDGE_BUDGET, target: str = HEDGE_TARGET):
+        self.router = router
+        self.chain = chain
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.target = target
+        self.budget = HedgeBudget(budget)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+        self._lock = threading.Lock()
+
+    def delay(self, model_id: str) -> float | None:
+        """Seconds to wait before hedging a call to `model_id`; None until the router has enough samples."""
+        observed = self.router.percentile(model_id, self.percentile)
+        return None if observed is None else max(self.min_delay, observed)
+
+    def hedge_model(self, model_id: str) -> str:
+        if self.target == "alternate" and self.chain is not None:
+            return self.chain.alternate(model_id)
+        return model_id
+
+    def _count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _start(self, model_id: str) -> float | None:
+        self._count("requests")
+        self.budget.earn()
+        return self.delay(model_id)
+
+    def _may_hedge(self) -> bool:
+        if self.budget.try_spend():
+            self._count("hedged")
+            return True
+        self._count("budget_denied")
+        return False
+
+    @staticmethod
+    def served(result) -> str:
+        return result[0]
+
+    def _won(self, model_id: str, hedge_model: str):
+        self._count("hedge_wins")
+        logger.info(f"Hedged request to {hedge_model} beat {model_id}")
+
+    def _record(self, model_id: str, started: float, future):
+        """Breaker and router outcome of a request the chain does not see (a hedge, or a primary that lost)."""
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None and not is_failover_error(error):
+            if self.chain is not None:
+                self.chain.breaker(model_id).record_neutral()
+            return
+        if self.chain is not None:
+            breaker = self.chain.breaker(model_id)
+            breaker.record_success() if error is None else breaker.record_failure()
+        self.router.observe(model_id, time.monotonic() - started, ok=error is None)
+
+    def _tracked(self, future, model_id: str, started: float):
+        future.add_done_callback(lambda f: self._record(model_id, started, f))
+
+    def call(self, fn, model_id: str):
+        """
+        Run fn(model_id) with an optional hedge fn(other_model); return (served_model, result).
+        Pass served=Hedger.served to FailoverChain.call so a hedge's answer is not credited to model_id.
+        """
+        delay = self._start(model_id)
+        if delay is None or not self.budget.available():
+            return model_id, fn(model_id)  # no hedge possible: no thread needed
+        started = time.monotonic()
+        primary = _spawn(fn, model_id)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._may_hedge():
+            return model_id, primary.result()
+
+        hedge_model = self.hedge_model(model_id)
+        hedge = _spawn(fn, hedge_model)
+        self._tracked(hedge, hedge_model, time.monotonic())
+        pending = {primary, hedge}
+        first_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # running threads can't be stopped; the loser's result is dropped
+                    if future is hedge:
+                        self._won(model_id, hedge_model)
+                        self._tracked(primary, model_id, started)
+                        return hedge_model, future.result()
+                    return model_id, future.result()
+                if first_error is None or future is primary:
+                    first_error = future.exception()
+        raise first_error
+
+    async def call_async(self, coro_fn, model_id: str):
+        """asyncio version of call(); the losing request is cancelled."""
+        delay = self._start(model_id)
+        if delay is None:
+            return model_id, await coro_fn(model_id)
+        primary = asyncio.ensure_future(coro_fn(model_id))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or not self._may_hedge():
+                return model_id, await primary
+        except BaseException:
+            primary.cancel()
+            raise
+
+        hedge_model = self.hedge_model(model_id)
+        hedge = asyncio.ensure_future(coro_fn(hedge_model))
+        self._tracked(hedge, hedge_model, time.monotonic())
+        pending = {primary, hedge}
+        first_error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._won(model_id, hedge_model)
+                            return hedge_model, task.result()
+                        return model_id, task.result()
+                    if first_error is None or task is primary:
+                        first_error = task.exception()
+            raise first_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "budget_denied": self.budget_denied,
+                "hedge_rate": round(self.hedged / self.requests, 4) if self.requests else 0.0,
+                "budget_fraction": self.budget.fraction,
+                "percentile": self.percentile,
+            }
+
+
+def _spawn(fn, *args) -> Future:
+    """Run fn(*args) on a thread of its own, so it never waits for a worker behind other requests."""
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="gemini-hedge", daemon=True).start()
+    return future
+
+
+def build_hedger(router, chain=None) -> Hedger | None:
+    """Hedger when GEMINI_HEDGING=1; it needs the latency router for its delays."""
+    if not HEDGING_ENABLED:
+        return None
+    if router is None:
+        logger.warning("GEMINI_HEDGING needs GEMINI_ROUTER_ENABLED for latency percentiles; hedging disabled")
+        return None
+    return Hedger(router, chain)
@@ -0,0 +1,102 @@
+# chatbot/history.py
+"""
+Keyset (cursor) pagination over a session's chat messages.
+
+Messages are ordered by (timestamp, id). A cursor is an opaque token that
+encodes one message's position in that order. A page is the `limit` messages
+immediately before or after a cursor. Without a cursor it is the newest
+`limit` messages, which is what a chat window shows first. Pages are always
+returned oldest first.
+
+Each page is a single range scan on the chat_msg_session_ts_idx index
+(user_id, session_id, timestamp, id), with one extra row fetched to learn
+whether more exist. So a page costs the same at the start of a
+million-message session as at the end, unlike OFFSET, which rereads every
+row it skips. Messages hidden by a clear are bounded out by the same seek
+(purge.visible_messages).
+
+Configuration (environment):
+  GEMINI_HISTORY_PAGE_SIZE      messages per page when no limit is given (default 50)
+  GEMINI_HISTORY_MAX_PAGE_SIZE  largest limit a client may ask for (default 200)
+"""
+import base64
+import os
+from datetime import datetime
+
+from .purge import visible_messages
+
+HISTORY_PAGE_SIZE = int(os.getenv("GEMINI_HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("GEMINI_HISTORY_MAX_PAGE_SIZE", "200"))
+
+FIELDS = ('id', 'text', 'sender', 'timestamp')
+
+
+class InvalidCursor(ValueError):
+    """A before/after/limit parameter could not be parsed."""
+
+
+def encode_cursor(timestamp: datetime, message_id: int) -> str:
+    raw = f"{timestamp.isoformat()}|{message_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Return (timestamp, id) from a cursor made by encode_cursor()."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        stamp, message_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(stamp), int(message_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid cursor {cursor!r}") from e
+
+
+def parse_limit(value: str | None) -> int:
+    if value in (None, ""):
+        return HISTORY_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError as e:
+        raise InvalidCursor(f"Invalid limit {value!r}") from e
+    if limit < 1:
+        raise InvalidCursor("limit must be at least 1")
+    return min(limit, HISTORY_MAX_PAGE_SIZE)
+
+
+def message_page(user_id: str, session_id: str, before: str | None = None, after: str | None = None,
+                 limit: int = HISTORY_PAGE_SIZE) -> dict:
+    """
+    One page of a session's messages, oldest first. `before`/`after` are cursors; with neither, the newest
+    page is returned. The reply's cursors.before fetches the older page and cursors.after the newer one.
+    """
+    if before and after:
+        raise InvalidCursor("Pass either before or after, not both")
+    rows = visible_messages(user_id, session_id)
+    # (timestamp, id) > cursor, written as a bounded timestamp range so the index seek uses it
+    if after:
+        stamp, message_id = decode_cursor(after)
+        rows = rows.filter(timestamp__gte=stamp).exclude(timestamp=stamp, id__lte=message_id).order_by('timestamp', 'id')
+    else:
+        if before:
+            stamp, message_id = decode_cursor(before)
+            rows = rows.filter(timestamp__lte=stamp).exclude(timestamp=stamp, id__gte=message_id)
+        rows = rows.order_by('-timestamp', '-id')
+    page = list(rows.values_list(*FIELDS)[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    if not after:
+        page.reverse()
+
+    messages = [
+        {'id': str(message_id), 'text': text, 'sender': sender, 'timestamp': stamp.isoformat()}
+        for message_id, text, sender, stamp in page
+    ]
+    return {
+        "messages": messages,
+        "count": len(messages),
+        # more messages exist past this page in the direction requested (older, or newer for `after`)
+        "has_more": has_more,
+        "cursors": {
+            "before": encode_cursor(page[0][3], page[0][0]) if page else before,
+            "after": encode_cursor(page[-1][3], page[-1][0]) if page else after,
+        },
+    }
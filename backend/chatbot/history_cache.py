@@ -0,0 +1,144 @@
+# chatbot/history_cache.py
+"""
+Read-through cache of serialized chat history pages.
+
+The React client polls get_chat_history. Without the cache every poll reruns
+the page query and serializes the same JSON again, even when nothing has
+changed. Every message write and every clear bumps ChatSession.version in
+the same transaction as the change (chatbot/sessions.py). So a poll does one
+lookup of the version on the unique (user_id, session_id) index. It gets the
+cached body if it was built at that version, and rebuilds it otherwise.
+Invalidation is therefore exact: no TTL guessing, and no scans for keys to
+delete. Because the version is read before the page is built, a cached page is
+never older than the version it is filed under.
+
+Two tiers:
+  memory  in-process LRU bounded by GEMINI_HISTORY_CACHE_MAX_BYTES of
+          payload. A page holds one entry per (session, cursor, limit), and a
+          new version replaces the old entry in place.
+  django  optional second tier in a configured Django cache
+          (GEMINI_HISTORY_CACHE_ALIAS), shared by workers when that cache
+          is. Its keys include the version, so stale entries are never read
+          and expire after GEMINI_HISTORY_CACHE_TTL.
+
+Configuration (environment):
+  GEMINI_HISTORY_CACHE            0 to disable the cache (default 1)
+  GEMINI_HISTORY_CACHE_MAX_BYTES  payload bytes kept in the memory tier (default 32 MiB)
+  GEMINI_HISTORY_CACHE_ALIAS      Django cache alias for the second tier (default unset: memory only)
+  GEMINI_HISTORY_CACHE_TTL        seconds entries live in the Django tier (default 600)
+"""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+HISTORY_CACHE_ENABLED = os.getenv("GEMINI_HISTORY_CACHE", "1").lower() not in ("0", "false", "no")
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("GEMINI_HISTORY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+HISTORY_CACHE_ALIAS = os.getenv("GEMINI_HISTORY_CACHE_ALIAS", "")
+HISTORY_CACHE_TTL = float(os.getenv("GEMINI_HISTORY_CACHE_TTL", "600"))
+
+KEY_PREFIX = "gemini:hist:"
+ENTRY_OVERHEAD = 200  # rough bytes for the key tuple, OrderedDict slot and bytes header
+
+
+class HistoryCache:
+    """Version-keyed history pages: an in-process LRU, optionally backed by a Django cache."""
+
+    def __init__(self, max_bytes: int = HISTORY_CACHE_MAX_BYTES, alias: str = HISTORY_CACHE_ALIAS,
+                 ttl: float = HISTORY_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.alias = alias
+        self.ttl = ttl
+        self.memory_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()  # (user_id, session_id, params) -> (version, body)
+        self._lock = threading.Lock()
+
+    @property
+    def _shared(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def _shared_key(self, key: tuple, version: int) -> str:
+        # user and session ids are free text, so hash them into a key every cache backend accepts
+        digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        return f"{KEY_PREFIX}{digest}:{version}"
+
+    def get_or_build(self, user_id: str, session_id: str, version: int, params: tuple, build) -> bytes:
+        """The cached body for this page at `version`, or build() (bytes) stored under it."""
+        key = (user_id, session_id, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            if entry is not None:
+                self.stale += 1
+
+        body = None
+        if self.alias:
+            try:
+                body = self._shared.get(self._shared_key(key, version))
+            except Exception as e:
+                logger.warning(f"History cache read failed: {e}")
+        if body is not None:
+            with self._lock:
+                self.shared_hits += 1
+        else:
+            body = build()
+            with self._lock:
+                self.misses += 1
+            if self.alias:
+                try:
+                    self._shared.set(self._shared_key(key, version), body, timeout=self.ttl)
+                except Exception as e:
+                    logger.warning(f"History cache write failed: {e}")
+        self._store(key, version, body)
+        return body
+
+    def _store(self, key: tuple, version: int, body: bytes):
+        size = len(body) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None:
+                if old[0] > version:
+                    return  # a concurrent request already stored a newer page
+                self.bytes -= len(old[1]) + ENTRY_OVERHEAD
+            self._entries[key] = (version, body)
+            self._entries.move_to_end(key)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= len(evicted) + ENTRY_OVERHEAD
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.shared_hits
+            lookups = hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "memory_hits": self.memory_hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "stale_replaced": self.stale,
+                "evictions": self.evictions,
+                "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+                "shared_alias": self.alias or None,
+            }
+
+
+def build_history_cache() -> HistoryCache | None:
+    return HistoryCache() if HISTORY_CACHE_ENABLED else None
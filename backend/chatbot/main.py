@@ -50,12 +50,27 @@
 # filename: main.py
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
+import asyncio
 import os
 import requests
 import logging
 
+from chatbot.gemini_client import AsyncGeminiClient, extract_chunk_text, format_sse
+from chatbot.response_cache import build_response_cache, is_cacheable, make_cache_key
+from chatbot.singleflight import AsyncSingleFlight
+from chatbot.failover import FAILOVER_DEPTH, FailoverChain, NoHealthyModelError
+from chatbot.router import build_router
+from chatbot.hedging import Hedger, build_hedger
+from chatbot.rate_limit import RateLimitExceeded, build_rate_limiter
+from chatbot.tokens import TOKENS, contents_units, usage_tokens
+from chatbot.scheduler import INTERACTIVE, PROBE, OverloadedError, build_scheduler
+from chatbot.retry import Deadline, RetryPolicy, RetryStats, call_with_retry_async
+from chatbot.model_catalog import ModelCatalog
+from chatbot.prompts import start_stream_async
+
 load_dotenv()
 API_KEY = os.getenv("GOOGLE_API_KEY")  # ensure this is set
 # Optional: set a fallback model name (only used if ListModels doesn't find anything appropriate)
@@ -78,25 +93,44 @@ app.add_middleware(
 
 class Message(BaseModel):
     prompt: str
+    user_id: str = "anonymous"
 
 # Globals populated on startup
 SELECTED_MODEL_ID: str | None = None
 AVAILABLE_MODELS: list = []
+GEMINI: AsyncGeminiClient | None = None
+# Shared on-disk ListModels snapshot (see chatbot/model_catalog.py)
+MODEL_CATALOG = ModelCatalog()
+CATALOG_APPLIED_AT = 0.0
+CATALOG_TASK: asyncio.Task | None = None
+# Ranked models with a circuit breaker each; the latency router reorders them per request
+MODEL_ROUTER = build_router()
+MODEL_CHAIN = FailoverChain(router=MODEL_ROUTER)
+# Backoff/deadline policy applied around the failover chain
+RETRY_POLICY = RetryPolicy()
+RETRY_STATS = RetryStats()
+# Opt-in hedging of slow generateContent calls (None unless GEMINI_HEDGING=1)
+HEDGER = build_hedger(MODEL_ROUTER, MODEL_CHAIN)
+# Exact-match generateContent cache (in-process here: this service has no Django cache)
+RESPONSE_CACHE = build_response_cache(django_available=False)
+# Coalesces concurrent identical generateContent requests
+GENERATION_FLIGHT = AsyncSingleFlight()
+# Global + per-user RPM/TPM buckets in front of Gemini (None when GEMINI_RATE_LIMIT_BACKEND=off)
+RATE_LIMITER = build_rate_limiter()
+# Bounded, prioritised admission of upstream calls (None when GEMINI_SCHEDULER=0)
+SCHEDULER = build_scheduler()
 
-GOOGLE_BASE = "https://generativelanguage.googleapis.com/v1beta"
+async def list_models() -> list:
+    """Call ListModels through the async client and return the raw 'models' array (or empty list)."""
+    return await GEMINI.list_models()
 
-def list_models(api_key: str) -> list:
-    """Call ListModels and return the raw 'models' array (or empty list)."""
-    url = f"{GOOGLE_BASE}/models?key={api_key}"
-    resp = requests.get(url, timeout=15)
-    resp.raise_for_status()
-    data = resp.json()
-    # Google may return models under "models" key
-    return data.get("models", [])
+async def run_upstream(priority: str, coro_fn):
+    """Await an upstream Gemini call in a scheduler slot of the given priority class."""
+    return await SCHEDULER.run_async(priority, coro_fn) if SCHEDULER else await coro_fn()
 
-def choose_model(models: list) -> str | None:
+def rank_models(models: list) -> list:
     """
-    Choose the best model that appears to support generateContent.
+    Rank the models that appear to support generateContent, best first.
     Heuristics:
       - prefer model ids that include 'gemini' or 'flash' or '2.5' / '2.1' etc.
       - prefer ones that list supported methods including 'generateContent' (if available).
@@ -128,57 +162,180 @@ def choose_model(models: list) -> str | None:
     # sort by score desc, prefer non-empty name
     candidates = [c for c in candidates if c[1]]
     if not candidates:
-        return None
+        return []
     candidates.sort(reverse=True, key=lambda t: t[0])
-    # return the top name
-    return candidates[0][1]
+    # keep only generate-capable models for the failover chain (when any say so)
+    if any(c[2] for c in candidates):
+        candidates = [c for c in candidates if c[2]]
+    return [c[1] for c in candidates]
+
+def choose_model(models: list) -> str | None:
+    """Choose the best model that appears to support generateContent."""
+    ranked = rank_models(models)
+    return ranked[0] if ranked else None
+
+def apply_model_catalog(snapshot: dict):
+    """Set AVAILABLE_MODELS, the failover chain and SELECTED_MODEL_ID from a catalog snapshot."""
+    global SELECTED_MODEL_ID, AVAILABLE_MODELS, CATALOG_APPLIED_AT
+    CATALOG_APPLIED_AT = snapshot.get("fetched_at", 0)
+    models = snapshot["models"]
+    AVAILABLE_MODELS = models
+    logger.info(f"Found {len(models)} models.")
+    ranked = rank_models(models)
+    MODEL_CHAIN.set_models(ranked[:FAILOVER_DEPTH] + [FALLBACK_MODEL])
+    chosen = ranked[0] if ranked else None
+    if chosen:
+        SELECTED_MODEL_ID = chosen
+        logger.info(f"Selected model: {SELECTED_MODEL_ID}")
+    elif FALLBACK_MODEL:
+        SELECTED_MODEL_ID = FALLBACK_MODEL
+        logger.info(f"No obvious model chosen from list; using FALLBACK_MODEL: {SELECTED_MODEL_ID}")
+    else:
+        SELECTED_MODEL_ID = None
+        logger.warning("No model selected. You must set FALLBACK_MODEL or ensure models list contains usable models.")
+
+async def refresh_model_catalog():
+    """Background task: pre-warm, then keep the shared catalog snapshot fresh and apply newer ones."""
+    await GEMINI.warm()
+    interval = max(30.0, min(MODEL_CATALOG.ttl / 4, 600.0))
+    while True:
+        snapshot = MODEL_CATALOG.load()
+        if not MODEL_CATALOG.is_fresh(snapshot):
+            try:
+                logger.info("Listing available models from Google Generative API...")
+                snapshot = await MODEL_CATALOG.refresh_async(
+                    lambda: run_upstream(PROBE, list_models), choose_model
+                )
+            except Exception:
+                logger.exception("Failed to refresh the model catalog; keeping the current snapshot")
+        if snapshot and snapshot.get("fetched_at", 0) > CATALOG_APPLIED_AT:
+            apply_model_catalog(snapshot)
+        await asyncio.sleep(interval)
 
 @app.on_event("startup")
-def startup_event():
-    global SELECTED_MODEL_ID, AVAILABLE_MODELS
+async def startup_event():
+    global SELECTED_MODEL_ID, GEMINI, CATALOG_TASK
+    GEMINI = AsyncGeminiClient(API_KEY)
+    snapshot = MODEL_CATALOG.load()
+    if snapshot:
+        apply_model_catalog(snapshot)
+    else:
+        logger.info("No model catalog snapshot yet; it will be fetched in the background.")
+        MODEL_CHAIN.set_models([FALLBACK_MODEL])
+        SELECTED_MODEL_ID = FALLBACK_MODEL or None
+    CATALOG_TASK = asyncio.create_task(refresh_model_catalog())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if CATALOG_TASK is not None:
+        CATALOG_TASK.cancel()
+    if GEMINI is not None:
+        await GEMINI.aclose()
+
+def build_payload(prompt_text: str, max_tokens: int = 512) -> dict:
+    """
+    Request body for generateContent / streamGenerateContent:
+      { "contents": [{"parts": [{"text": "..."}]}], "generationConfig": {"maxOutputTokens": ...} }
+    (the older { "prompt": { "messages": [...] } } shape is rejected by v1beta generateContent.)
+    """
+    return {
+        "contents": [
+            {"parts": [{"text": prompt_text}]}
+        ],
+        "generationConfig": {
+            "maxOutputTokens": max_tokens,
+            "temperature": 0.7
+        }
+    }
+
+async def generate_with_rest(model_id: str, prompt_text: str, max_tokens: int = 512, timeout: float = 30) -> dict:
+    """
+    Call the REST generateContent endpoint for a model without blocking the event loop.
+    This function returns the parsed JSON response (or raises on HTTP error).
+    """
+    payload = build_payload(prompt_text, max_tokens)
+    resp_json = await GEMINI.generate_content(model_id, payload, timeout=timeout)
+    TOKENS.observe(model_id, contents_units(payload["contents"]), resp_json)
+    return resp_json
+
+async def generate_with_failover(prompt_text: str, max_tokens: int = 512, priority: str = INTERACTIVE):
+    """
+    Failover chain wrapped in backoff retries sharing one deadline; returns (model_id, resp_json).
+    Each pass over the chain takes its own scheduler slot, so backoff sleeps do not hold one.
+    """
+    deadline = Deadline(RETRY_POLICY.deadline)
+
+    async def attempt(model_id):
+        if HEDGER is None:
+            return model_id, await generate_with_rest(model_id, prompt_text, max_tokens, timeout=deadline.timeout(30))
+        return await HEDGER.call_async(
+            lambda m: generate_with_rest(m, prompt_text, max_tokens, timeout=deadline.timeout(30)), model_id
+        )
+
+    _, (served_model, resp_json) = await call_with_retry_async(
+        lambda: run_upstream(priority, lambda: MODEL_CHAIN.call_async(attempt, served=Hedger.served)), RETRY_POLICY, RETRY_STATS,
+        deadline=deadline,
+    )
+    return served_model, resp_json
+
+async def generate_coalesced(cache_key: str, reservation, coro_fn) -> tuple:
+    """
+    coro_fn() through GENERATION_FLIGHT, so identical requests in flight share one upstream call, billed once:
+    the caller that ran the call settles its reservation (refunding the tokens if it failed), the others refund theirs.
+    """
+    led = False
+
+    async def lead():
+        nonlocal led
+        led = True
+        return await coro_fn()
+
     try:
-        logger.info("Listing available models from Google Generative API...")
-        models = list_models(API_KEY)
-        AVAILABLE_MODELS = models
-        logger.info(f"Found {len(models)} models.")
-        chosen = choose_model(models)
-        if chosen:
-            SELECTED_MODEL_ID = chosen
-            logger.info(f"Selected model: {SELECTED_MODEL_ID}")
-        elif FALLBACK_MODEL:
-            SELECTED_MODEL_ID = FALLBACK_MODEL
-            logger.info(f"No obvious model chosen from list; using FALLBACK_MODEL: {SELECTED_MODEL_ID}")
+        result = await GENERATION_FLIGHT.do(cache_key, lead)
+    except BaseException:
+        if reservation:
+            await RATE_LIMITER.refund_async(reservation, request=not led)
+        raise
+    if reservation:
+        if led:
+            await RATE_LIMITER.settle_async(reservation, usage_tokens(result[1]))
         else:
-            SELECTED_MODEL_ID = None
-            logger.warning("No model selected. You must set FALLBACK_MODEL or ensure models list contains usable models.")
-    except Exception as e:
-        logger.exception("Failed to list or select models:")
-        if FALLBACK_MODEL:
-            SELECTED_MODEL_ID = FALLBACK_MODEL
-            logger.info(f"Using FALLBACK_MODEL despite list failure: {SELECTED_MODEL_ID}")
-        else:
-            SELECTED_MODEL_ID = None
+            await RATE_LIMITER.refund_async(reservation)
+    return result
 
-def generate_with_rest(model_id: str, prompt_text: str, api_key: str, max_tokens: int = 512) -> dict:
+async def stream_with_rest(prompt_text: str, max_tokens: int = 512, reservation=None) -> tuple:
     """
-    Call the REST generateContent endpoint for a model.
-    We attempt a message-based prompt format that matches common GA examples:
-      { "prompt": { "messages": [{"author":"user","content":"..."}] }, "maxOutputTokens": ... }
-    This function returns the parsed JSON response (or raises on HTTP error).
+    Start streamGenerateContent (SSE) on the first healthy model of the chain; returns (model_id, text deltas).
+    A rate-limit `reservation` is settled with the final chunk's usage, or its tokens refunded if the stream fails.
     """
-    url = f"{GOOGLE_BASE}/models/{model_id}:generateContent?key={api_key}"
-    payload = {
-        "prompt": {
-            "messages": [
-                {"author": "user", "content": prompt_text}
-            ]
-        },
-        "maxOutputTokens": max_tokens
-    }
-    headers = {"Content-Type": "application/json"}
-    resp = requests.post(url, json=payload, headers=headers, timeout=30)
-    resp.raise_for_status()
-    return resp.json()
+    payload = build_payload(prompt_text, max_tokens)
+    try:
+        model_id, chunks = await MODEL_CHAIN.open_stream_async(
+            lambda m: start_stream_async(GEMINI.stream_generate_content(m, payload, timeout=30))
+        )
+    except Exception:
+        if reservation:
+            await RATE_LIMITER.refund_async(reservation, request=False)
+        raise
+
+    async def deltas():
+        usage, pieces = None, []
+        try:
+            async for chunk in chunks:
+                usage = chunk.get("usageMetadata", usage)
+                text = extract_chunk_text(chunk)
+                if text:
+                    pieces.append(text)
+                    yield text
+        except Exception:
+            if reservation:
+                await RATE_LIMITER.refund_async(reservation, request=False)
+            raise
+        TOKENS.observe_usage(model_id, contents_units(payload["contents"]), usage, "".join(pieces))
+        if reservation:
+            await RATE_LIMITER.settle_async(reservation, usage_tokens({"usageMetadata": usage}))
+
+    return model_id, deltas()
 
 def extract_text_from_response(resp_json: dict) -> str:
     """
@@ -231,6 +388,39 @@ def extract_text_from_response(resp_json: dict) -> str:
     # fall back to full json string (last resort)
     return str(resp_json)
 
+@app.get("/health")
+async def health_check():
+    return {
+        "status": "healthy" if SELECTED_MODEL_ID else "degraded",
+        "selected_model": SELECTED_MODEL_ID,
+        "response_cache": RESPONSE_CACHE.stats() if RESPONSE_CACHE else None,
+        "request_coalescing": GENERATION_FLIGHT.stats(),
+        "model_breakers": MODEL_CHAIN.snapshot(),
+        "model_routing": MODEL_ROUTER.stats() if MODEL_ROUTER else None,
+        "retries": RETRY_STATS.stats(),
+        "hedging": HEDGER.stats() if HEDGER else None,
+        "rate_limit": RATE_LIMITER.stats() if RATE_LIMITER else None,
+        "scheduler": SCHEDULER.stats() if SCHEDULER else None,
+        "tokens": TOKENS.stats(),
+    }
+
+def rate_limited_response(exc: RateLimitExceeded) -> JSONResponse:
+    logger.warning(str(exc))
+    return JSONResponse(
+        {"error": str(exc), "scope": exc.scope, "retry_after": round(exc.retry_after, 1)},
+        status_code=429,
+        headers={"Retry-After": str(max(1, round(exc.retry_after + 0.5)))},
+    )
+
+def unavailable_response(exc: NoHealthyModelError | OverloadedError) -> JSONResponse:
+    """503 with Retry-After for open breakers and shed load."""
+    logger.error(str(exc))
+    return JSONResponse(
+        {"error": str(exc), "retry_after": round(exc.retry_after)},
+        status_code=503,
+        headers={"Retry-After": str(max(1, round(exc.retry_after)))},
+    )
+
 @app.post("/chat")
 async def chat_with_gemini(message: Message):
     if not SELECTED_MODEL_ID:
@@ -238,10 +428,26 @@ async def chat_with_gemini(message: Message):
             "error": "No model selected at startup. Check server logs or set FALLBACK_MODEL env var."
         }
     try:
-        logger.info(f"Using model {SELECTED_MODEL_ID} to generate content.")
-        resp_json = generate_with_rest(SELECTED_MODEL_ID, message.prompt, API_KEY)
+        cache_key = make_cache_key(
+            SELECTED_MODEL_ID, message.prompt, build_payload(message.prompt)["generationConfig"]
+        )
+        resp_json = RESPONSE_CACHE.get(cache_key) if RESPONSE_CACHE else None
+        if resp_json is None:
+            reservation = None
+            if RATE_LIMITER:
+                reservation = await RATE_LIMITER.acquire_async(message.user_id, TOKENS.estimate(message.prompt, SELECTED_MODEL_ID) + 512)
+            served_model, resp_json = await generate_coalesced(
+                cache_key, reservation, lambda: generate_with_failover(message.prompt)
+            )
+            logger.info(f"Generated content with model {served_model}.")
+            if RESPONSE_CACHE and is_cacheable(resp_json):
+                RESPONSE_CACHE.set(cache_key, resp_json)
         text = extract_text_from_response(resp_json)
         return {"response": text, "raw": resp_json}
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except (NoHealthyModelError, OverloadedError) as e:
+        return unavailable_response(e)
     except requests.HTTPError as http_err:
         # surface status and body for diagnostics
         logger.exception("HTTP error while calling generateContent")
@@ -257,3 +463,65 @@ async def chat_with_gemini(message: Message):
     except Exception as e:
         logger.exception("Unexpected error while generating content")
         return {"error": str(e)}
+
+@app.post("/chat/stream")
+async def chat_with_gemini_stream(message: Message):
+    """Stream the reply as server-sent events: `data: {"text": ...}` chunks, then `event: done`."""
+    if not SELECTED_MODEL_ID:
+        return {
+            "error": "No model selected at startup. Check server logs or set FALLBACK_MODEL env var."
+        }
+    reservation = None
+    if RATE_LIMITER:
+        try:
+            reservation = await RATE_LIMITER.acquire_async(
+                message.user_id, TOKENS.estimate(message.prompt, SELECTED_MODEL_ID) + 512
+            )
+        except RateLimitExceeded as e:
+            return rate_limited_response(e)
+    try:
+        ticket = await SCHEDULER.acquire_async(INTERACTIVE) if SCHEDULER else None
+    except OverloadedError as e:
+        if reservation:
+            await RATE_LIMITER.refund_async(reservation)
+        return unavailable_response(e)
+
+    async def stream_events():
+        pieces = []
+        try:
+            _, deltas = await stream_with_rest(message.prompt, reservation=reservation)
+            async for text in deltas:
+                pieces.append(text)
+                yield format_sse({"text": text})
+        except NoHealthyModelError as e:
+            logger.error(str(e))
+            yield format_sse({"error": str(e), "retry_after": round(e.retry_after)}, event="error")
+            return
+        except requests.HTTPError as http_err:
+            logger.exception("HTTP error while calling streamGenerateContent")
+            try:
+                body = http_err.response.json()
+            except Exception:
+                body = http_err.response.text if http_err.response is not None else str(http_err)
+            yield format_sse({
+                "error": "HTTPError calling streamGenerateContent",
+                "status_code": http_err.response.status_code if http_err.response is not None else None,
+                "body": body,
+            }, event="error")
+            return
+        except Exception as e:
+            logger.exception("Unexpected error while streaming content")
+            yield format_sse({"error": str(e)}, event="error")
+            return
+        yield format_sse({"response": "".join(pieces)}, event="done")
+
+    async def events():
+        # the scheduler slot is held until the stream finishes or the client goes away
+        try:
+            async for event in stream_events():
+                yield event
+        finally:
+            if ticket:
+                ticket.release()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
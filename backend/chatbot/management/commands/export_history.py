@@ -0,0 +1,49 @@
+"""
+Django management command to export chat history as NDJSON or JSON
+"""
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.export import EXPORT_CHUNK_SIZE, FORMATS, InvalidExportRequest, export_chunks, export_rows, parse_bound
+
+
+class Command(BaseCommand):
+    help = 'Stream chat messages for a user, a session and/or a date range to a file or stdout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=str, help='Only this user_id (default: every user)')
+        parser.add_argument('--session', type=str, help='Only this session_id')
+        parser.add_argument('--since', type=str, help='ISO date or datetime, inclusive')
+        parser.add_argument('--until', type=str, help='ISO date or datetime, inclusive (a date covers the whole day)')
+        parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson', help='Output format')
+        parser.add_argument('--output', '-o', type=str, help='File to write (default: stdout)')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='Rows fetched per query')
+
+    def handle(self, *args, **options):
+        try:
+            rows = export_rows(
+                options['user'],
+                options['session'],
+                since=parse_bound(options['since']),
+                until=parse_bound(options['until'], end=True),
+                chunk_size=options['chunk_size'],
+            )
+            chunks = export_chunks(options['format'], rows)
+        except InvalidExportRequest as e:
+            raise CommandError(str(e))
+
+        out = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        written = 0
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+                written += len(chunk)
+        finally:
+            if options['output']:
+                out.close()
+            else:
+                out.flush()
+        if options['output']:
+            self.stdout.write(self.style.SUCCESS(f"Wrote {written:,} bytes to {options['output']}"))
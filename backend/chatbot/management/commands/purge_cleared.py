@@ -0,0 +1,23 @@
+"""
+Django management command to delete cleared chat messages in the foreground
+"""
+
+from django.core.management.base import BaseCommand
+
+from chatbot.purge import PURGE_CHUNK, PURGE_RATE, Purger
+
+
+class Command(BaseCommand):
+    help = 'Delete messages hidden by a clear, in rate-limited chunks, for every session with a purge pending'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=PURGE_CHUNK, help='Rows deleted per transaction')
+        parser.add_argument('--rate', type=float, default=PURGE_RATE, help='Upper bound on rows deleted per second')
+
+    def handle(self, *args, **options):
+        purger = Purger(chunk_size=options['chunk_size'], rate=options['rate'])
+        deleted = purger.purge_pending()
+        stats = purger.stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {deleted:,} messages from {stats['purged_sessions']} sessions in {stats['chunks']} chunks"
+        ))
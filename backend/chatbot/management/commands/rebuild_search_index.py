@@ -0,0 +1,23 @@
+"""
+Django management command to (re)build the full-text search index over chat messages
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.search import SearchUnavailable, rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Recreate the FTS5 table and triggers if missing, then reindex every chat message'
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        try:
+            indexed = rebuild_index()
+        except SearchUnavailable as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {indexed:,} messages in {time.monotonic() - started:.1f}s"
+        ))
@@ -4,11 +4,12 @@ Django management command to test Google Generative AI integration
 
 from django.core.management.base import BaseCommand
 from django.conf import settings
-import requests
 import json
 import os
 from dotenv import load_dotenv
 
+from chatbot.gemini_client import get_client
+
 load_dotenv()
 
 class Command(BaseCommand):
@@ -85,12 +86,8 @@ class Command(BaseCommand):
 
     def list_models(self, api_key):
         """List available models"""
-        url = f"https://generativelanguage.googleapis.com/v1beta/models?key={api_key}"
         try:
-            response = requests.get(url, timeout=15)
-            response.raise_for_status()
-            data = response.json()
-            return data.get("models", [])
+            return get_client(api_key).list_models()
         except Exception as e:
             self.stdout.write(self.style.ERROR(f'❌ Error listing models: {e}'))
             return []
@@ -122,9 +119,6 @@ class Command(BaseCommand):
 
     def test_generation(self, model_name, api_key):
         """Test content generation"""
-        clean_name = model_name.replace("models/", "")
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{clean_name}:generateContent?key={api_key}"
-        
         payload = {
             "contents": [
                 {
@@ -139,12 +133,8 @@ class Command(BaseCommand):
             }
         }
         
-        headers = {"Content-Type": "application/json"}
-        
         try:
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            response.raise_for_status()
-            data = response.json()
+            data = get_client(api_key).generate_content(model_name, payload, timeout=30)
             
             # Extract text
             text = self.extract_text(data)
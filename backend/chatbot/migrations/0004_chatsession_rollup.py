@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:07
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, OuterRef, Subquery
+
+PREVIEW_CHARS = 200
+BATCH = 1000
+
+
+def backfill_rollups(apps, schema_editor):
+    """Create or update one ChatSession per (user_id, session_id) that has messages."""
+    ChatMessage = apps.get_model('chatbot', 'ChatMessage')
+    ChatSession = apps.get_model('chatbot', 'ChatSession')
+    latest_text = ChatMessage.objects.filter(
+        user_id=OuterRef('user_id'), session_id=OuterRef('session_id')
+    ).order_by('-timestamp', '-id').values('text')[:1]
+    groups = (
+        ChatMessage.objects.filter(user_id__isnull=False, session_id__isnull=False)
+        .values('user_id', 'session_id')
+        .annotate(count=Count('id'), first=Min('timestamp'), last=Max('timestamp'), preview=Subquery(latest_text))
+        .order_by()
+    )
+    existing = {(s.user_id, s.session_id): s for s in ChatSession.objects.all()}
+    to_create, to_update = [], []
+    for group in groups.iterator(chunk_size=BATCH):
+        key = (group['user_id'], group['session_id'])
+        session = existing.get(key) or ChatSession(user_id=key[0], session_id=key[1], created_at=group['first'])
+        session.message_count = group['count']
+        session.first_message_at = group['first']
+        session.last_message_at = group['last']
+        session.preview = (group['preview'] or '')[:PREVIEW_CHARS]
+        (to_update if session.pk else to_create).append(session)
+    ChatSession.objects.bulk_create(to_create, batch_size=BATCH)
+    ChatSession.objects.bulk_update(
+        to_update, ['message_count', 'first_message_at', 'last_message_at', 'preview'], batch_size=BATCH
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0003_chatmessage_session_ts_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='first_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='message_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='preview',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddIndex(
+            model_name='chatsession',
+            index=models.Index(fields=['user_id', 'last_message_at', 'id'], name='chat_session_user_recent_idx'),
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
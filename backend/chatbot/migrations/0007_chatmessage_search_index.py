@@ -0,0 +1,64 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:40
+
+from django.db import migrations
+
+# FTS5 index mirroring chat_messages.text (and user_id, to narrow matches to one user), kept in step by triggers.
+# SQLite only; on other databases the search endpoint reports that search is unavailable.
+CREATE = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(
+        text, user_id, content='chat_messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ai AFTER INSERT ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(rowid, text, user_id) VALUES (new.id, new.text, new.user_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ad AFTER DELETE ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(chat_messages_fts, rowid, text, user_id) VALUES ('delete', old.id, old.text, old.user_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_au AFTER UPDATE OF text, user_id ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(chat_messages_fts, rowid, text, user_id) VALUES ('delete', old.id, old.text, old.user_id);
+        INSERT INTO chat_messages_fts(rowid, text, user_id) VALUES (new.id, new.text, new.user_id);
+    END
+    """,
+    # index the rows already there: the delete/update triggers assume every row is in the index, and a 'delete'
+    # for a row it never held corrupts an external-content table ("database disk image is malformed")
+    "INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('rebuild')",
+]
+DROP = [
+    "DROP TRIGGER IF EXISTS chat_messages_fts_au",
+    "DROP TRIGGER IF EXISTS chat_messages_fts_ad",
+    "DROP TRIGGER IF EXISTS chat_messages_fts_ai",
+    "DROP TABLE IF EXISTS chat_messages_fts",
+]
+
+
+def create_search_index(apps, schema_editor):
+    """Create the index and triggers, and index the existing rows."""
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in CREATE:
+        schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in DROP:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0006_chatsession_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,179 @@
+# chatbot/model_catalog.py
+"""
+On-disk snapshot of the ListModels result and the model chosen from it.
+
+Importing chatbot/views.py used to run a blocking ListModels call (up to 15s)
+in every Django worker, every manage.py command and every test run. A Google
+outage also left the app with no model. Now startup reads this snapshot, which
+takes a few milliseconds. The snapshot is used even when it is stale, because
+a day-old model list is better than none. A background refresher renews it
+once it is older than the TTL.
+
+All workers on a host share one snapshot file. A refresh takes an exclusive
+lock file first. Workers that cannot get the lock skip the fetch and pick up
+the new snapshot on their next check, so a host makes one ListModels call per
+TTL instead of one per worker. Writes go through a temp file and os.replace,
+so readers never see a half-written file.
+
+Configuration (environment):
+  GEMINI_CATALOG_PATH   snapshot file (default backend/.gemini_catalog.json)
+  GEMINI_CATALOG_TTL    seconds before the snapshot is refreshed (default 21600)
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CATALOG_PATH = os.getenv("GEMINI_CATALOG_PATH", str(Path(__file__).resolve().parent.parent / ".gemini_catalog.json"))
+CATALOG_TTL = float(os.getenv("GEMINI_CATALOG_TTL", "21600"))
+
+STALE_LOCK_SECONDS = 120
+
+
+class ModelCatalog:
+    """Read/write access to the shared snapshot plus the cross-process refresh lock."""
+
+    def __init__(self, path: str = CATALOG_PATH, ttl: float = CATALOG_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock_path = path + ".lock"
+
+    def load(self) -> dict | None:
+        """Return the snapshot dict ({'fetched_at', 'models', 'selected_model'}) or None if missing/corrupt."""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable model catalog {self.path}: {e}")
+            return None
+        if not isinstance(snapshot, dict) or not isinstance(snapshot.get("models"), list):
+            return None
+        return snapshot
+
+    def is_fresh(self, snapshot: dict | None) -> bool:
+        return bool(snapshot) and time.time() - snapshot.get("fetched_at", 0) < self.ttl
+
+    def save(self, models: list, selected_model: str | None) -> dict:
+        snapshot = {"fetched_at": time.time(), "models": models, "selected_model": selected_model}
+        directory = os.path.dirname(self.path) or "."
+        fd, tmp_path = tempfile.mkstemp(prefix=".gemini_catalog.", dir=directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        return snapshot
+
+    def _acquire_lock(self) -> bool:
+        """Create the lock file exclusively; a lock older than STALE_LOCK_SECONDS is assumed abandoned."""
+        for _ in range(2):
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode())
+                os.close(fd)
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.lock_path) < STALE_LOCK_SECONDS:
+                        return False
+                    os.unlink(self.lock_path)
+                except FileNotFoundError:
+                    continue
+        return False
+
+    def _release_lock(self):
+        try:
+            os.unlink(self.lock_path)
+        except FileNotFoundError:
+            pass
+
+    def refresh(self, fetch_models, choose) -> dict | None:
+        """
+        Fetch a new snapshot unless another process holds the lock or refreshed it meanwhile.
+        `fetch_models()` returns the ListModels array; `choose(models)` picks the model id.
+        Returns the newest snapshot on disk (possibly unchanged).
+        """
+        if not self._acquire_lock():
+            return self.load()
+        try:
+            current = self.load()
+            if self.is_fresh(current):
+                return current
+            models = fetch_models()
+            return self.save(models, choose(models))
+        finally:
+            self._release_lock()
+
+    async def refresh_async(self, fetch_models, choose) -> dict | None:
+        """refresh() for asyncio services: `fetch_models()` is a coroutine function."""
+        if not self._acquire_lock():
+            return self.load()
+        try:
+            current = self.load()
+            if self.is_fresh(current):
+                return current
+            models = await fetch_models()
+            return self.save(models, choose(models))
+        finally:
+            self._release_lock()
+
+
+class CatalogRefresher:
+    """Daemon thread that keeps a worker's model selection in step with the shared snapshot."""
+
+    def __init__(self, catalog: ModelCatalog, fetch_models, choose, on_update, interval: float | None = None):
+        self.catalog = catalog
+        self.fetch_models = fetch_models
+        self.choose = choose
+        self.on_update = on_update
+        self.interval = interval or max(30.0, min(catalog.ttl / 4, 600.0))
+        self.applied_at = 0.0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def apply(self, snapshot: dict | None):
+        """Hand a snapshot to on_update if it is newer than the one this worker uses."""
+        if snapshot and snapshot.get("fetched_at", 0) > self.applied_at:
+            self.applied_at = snapshot["fetched_at"]
+            self.on_update(snapshot)
+
+    def check(self):
+        snapshot = self.catalog.load()
+        if not self.catalog.is_fresh(snapshot):
+            try:
+                snapshot = self.catalog.refresh(self.fetch_models, self.choose)
+            except Exception:
+                logger.exception("Model catalog refresh failed; keeping the current snapshot")
+        self.apply(snapshot)
+
+    def start(self, before_first_check=None):
+        if self._thread is not None:
+            return
+
+        def _run():
+            if before_first_check is not None:
+                try:
+                    before_first_check()
+                except Exception:
+                    logger.exception("Model catalog refresher setup failed")
+            while not self._stop.is_set():
+                self.check()
+                self._stop.wait(self.interval)
+
+        self._thread = threading.Thread(target=_run, name="gemini-catalog-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
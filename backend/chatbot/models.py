@@ -12,6 +12,10 @@ class ChatMessage(models.Model):
     class Meta:
         db_table = 'chat_messages'
         ordering = ['timestamp']
+        indexes = [
+            # history reads and keyset pages: equality on user/session, range on (timestamp, id)
+            models.Index(fields=['user_id', 'session_id', 'timestamp', 'id'], name='chat_msg_session_ts_idx'),
+        ]
     
     def __str__(self):
         return f"{self.sender}: {self.text[:50]}..."
@@ -19,13 +23,37 @@ class ChatMessage(models.Model):
 class ChatSession(models.Model):
     id = models.AutoField(primary_key=True)
     user_id = models.CharField(max_length=100)
-    session_id = models.CharField(max_length=100, unique=True)
+    session_id = models.CharField(max_length=100)
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
+    # Rolling summary of every message up to and including summary_through_id
+    summary = models.TextField(blank=True, default='')
+    summary_through_id = models.IntegerField(null=True, blank=True)
+    summary_updated_at = models.DateTimeField(null=True, blank=True)
+    # Rollup of the session's ChatMessage rows, kept current by chatbot/sessions.py
+    message_count = models.IntegerField(default=0)
+    first_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    preview = models.CharField(max_length=200, blank=True, default='')
+    # Soft-delete tombstone: messages at or before cleared_at are hidden, and purged in the background while
+    # purge_pending is set (chatbot/purge.py)
+    cleared_at = models.DateTimeField(null=True, blank=True)
+    purge_pending = models.BooleanField(default=False)
+    # Bumped by every message write and clear; keys the history cache (chatbot/history_cache.py)
+    version = models.IntegerField(default=0)
     
     class Meta:
         db_table = 'chat_sessions'
         ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(fields=['user_id', 'session_id'], name='chat_session_user_session_uniq'),
+        ]
+        indexes = [
+            # get_sessions: a user's sessions, most recently active first
+            models.Index(fields=['user_id', 'last_message_at', 'id'], name='chat_session_user_recent_idx'),
+            # the purger's work list: only sessions with hidden rows left to delete
+            models.Index(fields=['purge_pending'], condition=models.Q(purge_pending=True), name='chat_session_purge_idx'),
+        ]
     
     def __str__(self):
         return f"Session {self.session_id} for user {self.user_id}"
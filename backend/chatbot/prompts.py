@@ -0,0 +1,239 @@
+# chatbot/prompts.py
+"""
+Prompt template registry and Gemini context caching for static instructions.
+
+The tutor formatting instructions used to be pasted in front of every
+question, so each call paid to send and process them again. A PromptTemplate
+keeps the static instructions apart from the per-request text. They go out as
+the request's `systemInstruction`, or as a `cachedContent` reference when the
+model supports explicit caching.
+
+ContextCacheManager registers a template's instructions with each model once
+through the cachedContents API. Requests then name that cache. A cache close
+to expiry has its TTL extended with PATCH, and a missing or expired one is
+created again. If a request naming a cache comes back 404/403, because the
+cache expired or was deleted upstream, it is re-sent once with the inline
+systemInstruction. The API rejects caches below a minimum size, so templates
+shorter than GEMINI_PROMPT_CACHE_MIN_TOKENS are always sent inline.
+
+Configuration (environment):
+  GEMINI_PROMPT_CACHE             0 to always send instructions inline (default 1)
+  GEMINI_PROMPT_CACHE_TTL         cache lifetime in seconds (default 3600)
+  GEMINI_PROMPT_CACHE_RENEW       renew when fewer than this many seconds remain (default 300)
+  GEMINI_PROMPT_CACHE_MIN_TOKENS  smallest template worth caching (default 1024, the API minimum)
+"""
+import hashlib
+import itertools
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from .gemini_client import clean_model_id
+from .tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+PROMPT_CACHE_ENABLED = os.getenv("GEMINI_PROMPT_CACHE", "1").lower() not in ("0", "false", "no")
+PROMPT_CACHE_TTL = float(os.getenv("GEMINI_PROMPT_CACHE_TTL", "3600"))
+PROMPT_CACHE_RENEW = float(os.getenv("GEMINI_PROMPT_CACHE_RENEW", "300"))
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_PROMPT_CACHE_MIN_TOKENS", "1024"))
+
+CREATE_RETRY_SECONDS = 600
+
+
+class PromptTemplate:
+    """Static system instructions plus a user-turn template; `version` changes whenever either does."""
+
+    def __init__(self, name: str, system_instruction: str, user_template: str = "{question}"):
+        self.name = name
+        self.system_instruction = system_instruction
+        self.user_template = user_template
+        self.version = hashlib.sha256((system_instruction + "\0" + user_template).encode("utf-8")).hexdigest()[:12]
+
+    def render(self, **fields) -> str:
+        return self.user_template.format(**fields)
+
+    def system_instruction_content(self) -> dict:
+        return {"parts": [{"text": self.system_instruction}]}
+
+
+class PromptRegistry:
+    def __init__(self):
+        self._templates = {}
+
+    def register(self, template: PromptTemplate) -> PromptTemplate:
+        self._templates[template.name] = template
+        return template
+
+    def get(self, name: str) -> PromptTemplate:
+        return self._templates[name]
+
+    def names(self) -> list:
+        return sorted(self._templates)
+
+
+PROMPTS = PromptRegistry()
+
+TUTOR_PROMPT = PROMPTS.register(PromptTemplate("tutor", """You are an AI tutor helping a student learn. Provide a clear, structured response to each of the student's questions.
+
+Please format your response with:
+1. A clear, concise answer
+2. If there are steps, number them clearly (1., 2., 3., etc.)
+3. If there are multiple options, list them with bullet points (•)
+4. Use **bold** for important terms and concepts
+5. Use proper line breaks (\\n) to separate paragraphs
+6. Keep responses helpful but concise
+7. Use clear formatting for lists and steps"""))
+
+
+def is_cache_miss(exc: Exception) -> bool:
+    """True if a request naming a cachedContent failed because that cache is gone or unusable."""
+    if not isinstance(exc, requests.HTTPError) or exc.response is None:
+        return False
+    if exc.response.status_code in (403, 404):
+        return True
+    return exc.response.status_code == 400 and "cachedcontent" in exc.response.text.replace(" ", "").lower()
+
+
+class ContextCacheManager:
+    """
+    One cachedContents entry per (model, template version), renewed before it expires.
+    `client_factory()` returns a GeminiClient; `supports(model_id)` says whether the model can use explicit caching.
+    """
+
+    def __init__(self, client_factory, supports=None, ttl: float = PROMPT_CACHE_TTL,
+                 renew_margin: float = PROMPT_CACHE_RENEW, min_tokens: int = PROMPT_CACHE_MIN_TOKENS):
+        self.client_factory = client_factory
+        self.supports = supports
+        self.ttl = ttl
+        self.renew_margin = renew_margin
+        self.min_tokens = min_tokens
+        self.created = 0
+        self.renewed = 0
+        self.fallbacks = 0
+        self.create_failures = 0
+        self._entries = {}  # (model_id, version) -> (name, expires_at)
+        self._failed = {}  # (model_id, version) -> monotonic time before which creation is not retried
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def eligible(self, model_id: str, template: PromptTemplate) -> bool:
+        if estimate_tokens(template.system_instruction) < self.min_tokens:
+            return False
+        return self.supports is None or self.supports(model_id)
+
+    def resolve(self, model_id: str, template: PromptTemplate) -> str | None:
+        """cachedContent name to use for this model and template, or None to send the instructions inline."""
+        if not self.eligible(model_id, template):
+            return None
+        key = (model_id, template.version)
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry and entry[1] - now > self.renew_margin:
+            return entry[0]
+        with self._key_lock(key):
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry and entry[1] - now > self.renew_margin:
+                return entry[0]  # another thread renewed it meanwhile
+            if entry and entry[1] > now:
+                try:
+                    self.client_factory().update_cached_content_ttl(entry[0], self.ttl)
+                    self._entries[key] = (entry[0], time.monotonic() + self.ttl)
+                    self.renewed += 1
+                    return entry[0]
+                except requests.RequestException as e:
+                    logger.info(f"Renewing {entry[0]} failed ({e}); creating a new cache")
+            if self._failed.get(key, 0) > now:
+                return None
+            try:
+                cached = self.client_factory().create_cached_content({
+                    "model": f"models/{clean_model_id(model_id)}",
+                    "displayName": f"{template.name}-{template.version}",
+                    "systemInstruction": template.system_instruction_content(),
+                    "ttl": f"{int(self.ttl)}s",
+                })
+            except requests.RequestException as e:
+                self.create_failures += 1
+                self._failed[key] = now + CREATE_RETRY_SECONDS
+                self._entries.pop(key, None)
+                logger.warning(f"Could not cache the '{template.name}' prompt for {model_id}: {e}; sending it inline")
+                return None
+            self._entries[key] = (cached["name"], time.monotonic() + self.ttl)
+            self.created += 1
+            logger.info(f"Cached the '{template.name}' prompt for {model_id} as {cached['name']}")
+            return cached["name"]
+
+    def invalidate(self, model_id: str, template: PromptTemplate):
+        self._entries.pop((model_id, template.version), None)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "min_tokens": self.min_tokens,
+            "ttl_seconds": self.ttl,
+            "active": {f"{model}:{version}": round(expires - now) for (model, version), (_, expires) in self._entries.items()},
+            "created": self.created,
+            "renewed": self.renewed,
+            "expired_fallbacks": self.fallbacks,
+            "create_failures": self.create_failures,
+        }
+
+
+def start_stream(chunks):
+    """Pull the first chunk so HTTP errors surface now; return an iterator over all chunks."""
+    iterator = iter(chunks)
+    for first in iterator:
+        return itertools.chain([first], iterator)
+    return iter(())
+
+
+async def start_stream_async(chunks):
+    """asyncio version of start_stream() for an async iterator of chunks."""
+    iterator = aiter(chunks)
+    try:
+        first = await anext(iterator)
+    except StopAsyncIteration:
+        return _empty_async()
+
+    async def rest():
+        yield first
+        async for chunk in iterator:
+            yield chunk
+
+    return rest()
+
+
+async def _empty_async():
+    return
+    yield
+
+
+def call_with_prompt(cache: ContextCacheManager | None, model_id: str, template: PromptTemplate, send):
+    """
+    send(fields) issues the request with `fields` merged into the payload: {"cachedContent": name} when the
+    template is cached for this model, else {"systemInstruction": ...}. A request naming a cache that has
+    expired upstream is re-sent once with the inline instructions.
+    """
+    name = cache.resolve(model_id, template) if cache else None
+    if name:
+        try:
+            return send({"cachedContent": name})
+        except requests.HTTPError as e:
+            if not is_cache_miss(e):
+                raise
+            logger.info(f"{name} is no longer usable ({e}); resending with inline instructions")
+            cache.invalidate(model_id, template)
+            cache.fallbacks += 1
+    return send({"systemInstruction": template.system_instruction_content()})
+
+
+def build_context_cache(client_factory, supports=None) -> ContextCacheManager | None:
+    return ContextCacheManager(client_factory, supports) if PROMPT_CACHE_ENABLED else None
@@ -0,0 +1,181 @@
+# chatbot/purge.py
+"""
+Soft-deleted chat history and its background purge.
+
+Clearing a session used to DELETE all of its messages inside the request.
+For a large session that holds the write lock on chat_messages until the
+statement finishes, and on SQLite every other writer waits behind it. Now a
+clear only writes a tombstone on the session's ChatSession row:
+cleared_at = now, purge_pending = True. That is a single-row UPDATE however
+big the session is (sessions.clear_session / clear_user). From then on every
+read of messages skips those at or before cleared_at. visible_messages() adds
+that as a bound on the (user_id, session_id, timestamp, id) index, and
+hide_cleared() does the same for multi-session queries.
+
+The Purger thread then deletes the hidden rows for real, in chunks of
+GEMINI_PURGE_CHUNK ids. Each chunk is its own short transaction, and the
+thread sleeps so that it deletes at most GEMINI_PURGE_RATE rows per second,
+leaving the write lock free between chunks. A chunk that loses the lock to
+another writer is retried after LOCK_RETRY_DELAY rather than abandoning the
+pass. Once a session has no hidden rows left, purge_pending is cleared. That
+update is a compare-and-set on cleared_at, so a clear that arrives during the
+purge keeps the session queued. build_purger starts the thread with the
+process. It polls every GEMINI_PURGE_INTERVAL seconds, and a clear wakes it
+early, so sessions left pending by a restart or by a process running with
+GEMINI_PURGE=0 are picked up within one interval. `manage.py purge_cleared` runs the same purge in the
+foreground.
+
+Configuration (environment):
+  GEMINI_PURGE           0 to never delete hidden rows in the background (default 1)
+  GEMINI_PURGE_CHUNK     rows deleted per transaction (default 500)
+  GEMINI_PURGE_RATE      upper bound on rows deleted per second (default 5000)
+  GEMINI_PURGE_INTERVAL  seconds between polls for pending sessions (default 60)
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import connection
+from django.db.utils import OperationalError
+from django.db.models import DateTimeField, Exists, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .db_health import is_lock_contention
+from .models import ChatMessage, ChatSession
+
+logger = logging.getLogger(__name__)
+
+PURGE_ENABLED = os.getenv("GEMINI_PURGE", "1").lower() not in ("0", "false", "no")
+PURGE_CHUNK = int(os.getenv("GEMINI_PURGE_CHUNK", "500"))
+PURGE_RATE = float(os.getenv("GEMINI_PURGE_RATE", "5000"))
+PURGE_INTERVAL = float(os.getenv("GEMINI_PURGE_INTERVAL", "60"))
+
+NEVER_CLEARED = datetime.min.replace(tzinfo=dt_timezone.utc)
+SESSIONS_PER_PASS = 100
+LOCK_RETRY_DELAY = 0.5
+
+
+def visible_messages(user_id: str, session_id: str):
+    """A session's ChatMessages that were not hidden by a clear (one query: the tombstone is a subquery)."""
+    cleared_at = ChatSession.objects.filter(user_id=user_id, session_id=session_id).values('cleared_at')[:1]
+    return ChatMessage.objects.filter(
+        user_id=user_id,
+        session_id=session_id,
+        timestamp__gt=Coalesce(Subquery(cleared_at), Value(NEVER_CLEARED), output_field=DateTimeField()),
+    )
+
+
+def hide_cleared(messages):
+    """Drop messages hidden by their session's tombstone from a queryset that may span sessions."""
+    return messages.exclude(Exists(ChatSession.objects.filter(
+        user_id=OuterRef('user_id'), session_id=OuterRef('session_id'), cleared_at__gte=OuterRef('timestamp'),
+    )))
+
+
+class Purger:
+    """Background, rate-limited deletion of messages hidden by a clear."""
+
+    def __init__(self, chunk_size: int = PURGE_CHUNK, rate: float = PURGE_RATE, interval: float = PURGE_INTERVAL):
+        self.chunk_size = chunk_size
+        self.rate = rate
+        self.interval = interval
+        self.purged_rows = 0
+        self.purged_sessions = 0
+        self.chunks = 0
+        self.failures = 0
+        self.lock_retries = 0
+        self.last_chunk_ms = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the purge thread; it first polls after `interval` unless a clear wakes it sooner."""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="chat-purger", daemon=True)
+                    self._thread.start()
+
+    def schedule(self):
+        """Have the purge thread look for pending sessions now."""
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.purge_pending()
+            except Exception:
+                self.failures += 1
+                logger.exception("Purging cleared chat messages failed")
+            finally:
+                connection.close()
+
+    def purge_pending(self) -> int:
+        """Purge every session with purge_pending set; returns the number of rows deleted."""
+        total = 0
+        while True:
+            pending = list(ChatSession.objects.filter(purge_pending=True).values_list(
+                'pk', 'user_id', 'session_id', 'cleared_at'
+            )[:SESSIONS_PER_PASS])
+            for pk, user_id, session_id, cleared_at in pending:
+                total += self.purge_session(pk, user_id, session_id, cleared_at)
+            if len(pending) < SESSIONS_PER_PASS:
+                return total
+
+    def purge_session(self, pk: int, user_id: str, session_id: str, cleared_at) -> int:
+        hidden = ChatMessage.objects.filter(user_id=user_id, session_id=session_id, timestamp__lte=cleared_at)
+        deleted = 0
+        while True:
+            started = time.monotonic()
+            ids = list(hidden.order_by().values_list('id', flat=True)[:self.chunk_size])
+            if ids:
+                try:
+                    deleted += ChatMessage.objects.filter(id__in=ids).delete()[0]
+                except OperationalError as e:
+                    if not is_lock_contention(e):
+                        raise
+                    with self._lock:
+                        self.lock_retries += 1
+                    time.sleep(LOCK_RETRY_DELAY)
+                    continue
+                with self._lock:
+                    self.chunks += 1
+                    self.last_chunk_ms = round((time.monotonic() - started) * 1000, 1)
+            if len(ids) < self.chunk_size:
+                break
+            time.sleep(len(ids) / self.rate)
+        # a newer clear moved cleared_at: leave the session pending for the next pass
+        done = ChatSession.objects.filter(pk=pk, cleared_at=cleared_at).update(purge_pending=False)
+        with self._lock:
+            self.purged_rows += deleted
+            self.purged_sessions += done
+        logger.info(f"Purged {deleted} cleared messages of session {session_id} for user {user_id}")
+        return deleted
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "chunk_size": self.chunk_size,
+                "rate": self.rate,
+                "running": self._thread is not None,
+                "purged_rows": self.purged_rows,
+                "purged_sessions": self.purged_sessions,
+                "chunks": self.chunks,
+                "last_chunk_ms": self.last_chunk_ms,
+                "failures": self.failures,
+                "lock_retries": self.lock_retries,
+            }
+
+
+def build_purger() -> Purger | None:
+    if not PURGE_ENABLED:
+        return None
+    purger = Purger()
+    purger.start()
+    return purger
@@ -0,0 +1,251 @@
+# chatbot/rate_limit.py
+"""
+Token-bucket rate limiting in front of Gemini generation calls.
+
+A global pair of buckets is sized to the API quota: requests per minute and
+(estimated) tokens per minute. Each user_id gets its own smaller pair, so one
+user cannot drain the quota for everyone. A request reserves from all four
+buckets in one atomic step. If the buckets are short, the reservation is
+still granted (the buckets go into debt) as long as the debt clears within
+`max_wait`. The request then sleeps that long before calling Gemini. So short
+bursts queue in arrival order instead of reaching Google and coming back as
+429s. Requests that would have to wait longer are rejected with a
+retry-after hint, and nothing is reserved for them.
+
+Token reservations start as an estimate: prompt tokens from chatbot/tokens.py
+plus maxOutputTokens. settle() corrects them with the real usageMetadata.totalTokenCount.
+refund() gives a reservation back. Callers that joined another request's
+coalesced upstream call refund all of it. A call that failed refunds its
+tokens but not its request.
+
+Bucket state lives in memory (one process) or in a SQLite file, which every
+worker process on the node shares. Each reservation is a single
+BEGIN IMMEDIATE transaction. That transaction can wait up to 5 s on a
+locked file, so the *_async methods run store calls in a worker thread
+rather than on the event loop.
+
+Configuration (environment):
+  GEMINI_RATE_LIMIT_BACKEND   memory | sqlite | off (default memory)
+  GEMINI_RATE_LIMIT_DB        SQLite file for the sqlite backend (default backend/.gemini_ratelimit.sqlite3)
+  GEMINI_RPM / GEMINI_TPM     global requests / tokens per minute (default 60 / 1000000)
+  GEMINI_USER_RPM / GEMINI_USER_TPM   per-user requests / tokens per minute (default 10 / 100000)
+  GEMINI_RATE_LIMIT_MAX_WAIT  seconds a request may queue before it is rejected (default 2)
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_BACKEND = os.getenv("GEMINI_RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_DB = os.getenv("GEMINI_RATE_LIMIT_DB", str(Path(__file__).resolve().parent.parent / ".gemini_ratelimit.sqlite3"))
+GLOBAL_RPM = float(os.getenv("GEMINI_RPM", "60"))
+GLOBAL_TPM = float(os.getenv("GEMINI_TPM", "1000000"))
+USER_RPM = float(os.getenv("GEMINI_USER_RPM", "10"))
+USER_TPM = float(os.getenv("GEMINI_USER_TPM", "100000"))
+RATE_LIMIT_MAX_WAIT = float(os.getenv("GEMINI_RATE_LIMIT_MAX_WAIT", "2"))
+
+
+class RateLimitExceeded(Exception):
+    """The request would have to queue longer than allowed; try again after `retry_after` seconds."""
+
+    def __init__(self, retry_after: float, scope: str):
+        super().__init__(f"Rate limit exceeded ({scope}); retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+        self.scope = scope
+
+
+def _reserve(states: dict, demands: list, now: float, max_wait: float):
+    """
+    Shared bucket arithmetic. states: key -> (tokens, updated_at), demands: [(key, per_minute, amount)].
+    Returns (new_states or None, wait, limiting_key); new_states is None when the request is rejected.
+    """
+    refilled = {}
+    wait, limiting = 0.0, None
+    for key, per_minute, amount in demands:
+        tokens, updated = states.get(key, (per_minute, now))
+        rate = per_minute / 60.0
+        tokens = min(per_minute, tokens + (now - updated) * rate)
+        refilled[key] = tokens
+        shortfall = min(amount, per_minute) - tokens
+        if shortfall > 0 and shortfall / rate > wait:
+            wait, limiting = shortfall / rate, key
+    if wait > max_wait:
+        return None, wait, limiting
+    return {key: (refilled[key] - amount, now) for key, _, amount in demands}, wait, limiting
+
+
+class MemoryBucketStore:
+    name = "memory"
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, demands: list, max_wait: float):
+        with self._lock:
+            new_states, wait, limiting = _reserve(self._states, demands, time.time(), max_wait)
+            if new_states is not None:
+                self._states.update(new_states)
+            return new_states is not None, wait, limiting
+
+    def adjust(self, key: str, per_minute: float, delta: float):
+        with self._lock:
+            tokens, updated = self._states.get(key, (per_minute, time.time()))
+            self._states[key] = (min(per_minute, tokens - delta), updated)
+
+
+class SQLiteBucketStore:
+    """Buckets in a SQLite file shared by every worker process on the node."""
+
+    name = "sqlite"
+
+    def __init__(self, path: str = RATE_LIMIT_DB):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def reserve(self, demands: list, max_wait: float):
+        conn = self._conn()
+        keys = [key for key, _, _ in demands]
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                f"SELECT key, tokens, updated FROM buckets WHERE key IN ({','.join('?' * len(keys))})", keys
+            ).fetchall()
+            new_states, wait, limiting = _reserve({k: (t, u) for k, t, u in rows}, demands, time.time(), max_wait)
+            if new_states is not None:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                    [(key, tokens, updated) for key, (tokens, updated) in new_states.items()],
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return new_states is not None, wait, limiting
+
+    def adjust(self, key: str, per_minute: float, delta: float):
+        self._conn().execute(
+            "UPDATE buckets SET tokens = MIN(?, tokens - ?) WHERE key = ?", (per_minute, delta, key)
+        )
+
+
+class Reservation:
+    __slots__ = ("user_id", "tokens", "wait")
+
+    def __init__(self, user_id: str, tokens: int, wait: float):
+        self.user_id = user_id
+        self.tokens = tokens
+        self.wait = wait
+
+
+class RateLimiter:
+    def __init__(self, store, rpm: float = GLOBAL_RPM, tpm: float = GLOBAL_TPM, user_rpm: float = USER_RPM,
+                 user_tpm: float = USER_TPM, max_wait: float = RATE_LIMIT_MAX_WAIT):
+        self.store = store
+        self.rpm = rpm
+        self.tpm = tpm
+        self.user_rpm = user_rpm
+        self.user_tpm = user_tpm
+        self.max_wait = max_wait
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = {}
+        self.refunded = 0
+        self.total_wait = 0.0
+        self._lock = threading.Lock()
+
+    def _request_buckets(self, user_id: str) -> list:
+        return [("global:rpm", self.rpm), (f"user:{user_id}:rpm", self.user_rpm)]
+
+    def _token_buckets(self, user_id: str) -> list:
+        return [("global:tpm", self.tpm), (f"user:{user_id}:tpm", self.user_tpm)]
+
+    def reserve(self, user_id: str, tokens: int) -> Reservation:
+        """Reserve one request and `tokens` tokens; raises RateLimitExceeded if the wait would exceed max_wait."""
+        demands = [(key, per_minute, 1) for key, per_minute in self._request_buckets(user_id)]
+        demands += [(key, per_minute, tokens) for key, per_minute in self._token_buckets(user_id)]
+        granted, wait, limiting = self.store.reserve(demands, self.max_wait)
+        with self._lock:
+            if not granted:
+                scope = "global" if limiting.startswith("global:") else "user"
+                self.rejected[scope] = self.rejected.get(scope, 0) + 1
+                raise RateLimitExceeded(wait, scope)
+            self.admitted += 1
+            if wait > 0:
+                self.queued += 1
+                self.total_wait += wait
+        return Reservation(user_id, tokens, wait)
+
+    def acquire(self, user_id: str, tokens: int) -> Reservation:
+        reservation = self.reserve(user_id, tokens)
+        if reservation.wait > 0:
+            time.sleep(reservation.wait)
+        return reservation
+
+    async def acquire_async(self, user_id: str, tokens: int) -> Reservation:
+        reservation = await asyncio.to_thread(self.reserve, user_id, tokens)
+        if reservation.wait > 0:
+            await asyncio.sleep(reservation.wait)
+        return reservation
+
+    def settle(self, reservation: Reservation, actual_tokens: int | None):
+        """Replace the token estimate with the usage Gemini reported."""
+        if actual_tokens is None or actual_tokens == reservation.tokens:
+            return
+        for key, per_minute in self._token_buckets(reservation.user_id):
+            self.store.adjust(key, per_minute, actual_tokens - reservation.tokens)
+
+    def refund(self, reservation: Reservation, request: bool = True):
+        """Return a reservation's tokens, and its request slot unless `request` is False, to the buckets."""
+        buckets = [(key, per_minute, 1) for key, per_minute in self._request_buckets(reservation.user_id)] if request else []
+        buckets += [(key, per_minute, reservation.tokens) for key, per_minute in self._token_buckets(reservation.user_id)]
+        for key, per_minute, amount in buckets:
+            self.store.adjust(key, per_minute, -amount)
+        with self._lock:
+            self.refunded += 1
+
+    async def settle_async(self, reservation: Reservation, actual_tokens: int | None):
+        await asyncio.to_thread(self.settle, reservation, actual_tokens)
+
+    async def refund_async(self, reservation: Reservation, request: bool = True):
+        await asyncio.to_thread(self.refund, reservation, request)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": self.store.name,
+                "global_rpm": self.rpm,
+                "global_tpm": self.tpm,
+                "user_rpm": self.user_rpm,
+                "user_tpm": self.user_tpm,
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected": dict(self.rejected),
+                "refunded": self.refunded,
+                "avg_queue_wait_ms": round(self.total_wait / self.queued * 1000, 1) if self.queued else 0.0,
+            }
+
+
+def build_rate_limiter(backend: str = RATE_LIMIT_BACKEND) -> RateLimiter | None:
+    if backend == "off":
+        return None
+    if backend == "sqlite":
+        return RateLimiter(SQLiteBucketStore())
+    if backend != "memory":
+        logger.warning(f"Unknown GEMINI_RATE_LIMIT_BACKEND={backend!r}; using memory")
+    return RateLimiter(MemoryBucketStore())
@@ -0,0 +1,180 @@
+# chatbot/response_cache.py
+"""
+Exact-match cache for generateContent responses.
+
+Entries are keyed on a hash of the model id, the fully built prompt and the
+generationConfig, so a hit is only returned for a byte-identical request.
+Two interchangeable backends are provided:
+
+  MemoryCacheBackend  in-process, size-bounded LRU with a per-entry TTL
+  DjangoCacheBackend  any configured Django cache (shared between workers when
+                      that cache is, e.g. Redis or Memcached)
+
+Configuration (environment):
+  GEMINI_CACHE_BACKEND      memory | django | off (default memory)
+  GEMINI_CACHE_MAX_ENTRIES  LRU capacity of the memory backend (default 1024)
+  GEMINI_CACHE_TTL          seconds an entry stays valid (default 3600)
+  GEMINI_CACHE_ALIAS        Django cache alias for the django backend (default "default")
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CACHE_BACKEND = os.getenv("GEMINI_CACHE_BACKEND", "memory").lower()
+CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL = float(os.getenv("GEMINI_CACHE_TTL", "3600"))
+CACHE_ALIAS = os.getenv("GEMINI_CACHE_ALIAS", "default")
+
+KEY_PREFIX = "gemini:resp:"
+
+
+def make_cache_key(model_id: str, prompt, generation_config: dict | None) -> str:
+    """Stable key for (model, prompt, generationConfig); `prompt` may be a string or a contents list."""
+    material = json.dumps(
+        {"model": model_id, "prompt": prompt, "config": generation_config or {}},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return KEY_PREFIX + hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    """Thread-safe LRU dict with per-entry expiry."""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self.expirations = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: float):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class DjangoCacheBackend:
+    """Stores entries in a Django cache; eviction and expiry are delegated to that cache."""
+
+    name = "django"
+
+    def __init__(self, alias: str = CACHE_ALIAS):
+        self.alias = alias
+
+    @property
+    def _cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def get(self, key: str):
+        return self._cache.get(key)
+
+    def set(self, key: str, value, ttl: float):
+        self._cache.set(key, value, timeout=ttl)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return {"alias": self.alias}
+
+
+class ResponseCache:
+    """Front door used by the views: TTL policy plus hit/miss accounting over a backend."""
+
+    def __init__(self, backend, ttl: float = CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"Response cache read failed: {e}")
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value):
+        try:
+            self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            logger.warning(f"Response cache write failed: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "backend": self.backend.name,
+            "ttl_seconds": self.ttl,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / total, 4) if total else 0.0,
+            **self.backend.stats(),
+        }
+
+
+def build_response_cache(backend: str = CACHE_BACKEND, django_available: bool = True) -> ResponseCache | None:
+    """Create the cache selected by GEMINI_CACHE_BACKEND, or None when caching is off."""
+    if backend in ("off", "none", "0", ""):
+        return None
+    if backend == "django" and django_available:
+        return ResponseCache(DjangoCacheBackend())
+    if backend == "django":
+        logger.info("Django cache backend not available in this process; using the in-memory cache")
+        backend = "memory"
+    if backend != "memory":
+        logger.warning(f"Unknown GEMINI_CACHE_BACKEND {backend!r}; using the in-memory cache")
+    return ResponseCache(MemoryCacheBackend())
+
+
+def is_cacheable(resp_json: dict) -> bool:
+    """Only keep responses that actually carry a candidate answer (not blocked/empty ones)."""
+    candidates = resp_json.get("candidates") if isinstance(resp_json, dict) else None
+    return bool(candidates) and not resp_json.get("promptFeedback", {}).get("blockReason")
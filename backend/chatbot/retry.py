@@ -0,0 +1,246 @@
+# chatbot/retry.py
+"""
+Retries with exponential backoff, full jitter and an overall deadline for
+Gemini calls.
+
+Transient failures are retried after a backoff delay of
+uniform(0, min(max_delay, base_delay * 2**attempt)). These are 429/500/502/503/504,
+timeouts and connection errors. When the server says how long to wait,
+through a Retry-After header or a google.rpc.RetryInfo retryDelay in the
+error body, that delay is used instead. If it is longer than max_delay, the
+call gives up rather than hold a worker that long. Nothing is retried
+once the next attempt could not finish inside the request's deadline, so
+retries never push a reply past its latency budget. Validation errors (other
+4xx) and exhausted daily quotas are never retried. Timeouts and dropped
+connections are only retried for idempotent calls. "All breakers open"
+(NoHealthyModelError) is not retried either. Its cooldown is far longer
+than any backoff, so the caller answers 503 with Retry-After at once.
+
+Callers run each attempt in its own scheduler slot (see generate_with_failover
+in views.py and main.py), so the wait between attempts never holds a slot.
+
+Every call records per-attempt timings, so RetryStats can report how much tail
+latency retries add.
+
+Configuration (environment):
+  GEMINI_RETRY_MAX_ATTEMPTS  attempts per request including the first (default 3)
+  GEMINI_RETRY_BASE_DELAY    backoff base in seconds (default 0.5)
+  GEMINI_RETRY_MAX_DELAY     backoff cap in seconds (default 8)
+  GEMINI_RETRY_DEADLINE      total seconds a request may spend on attempts and waits (default 45)
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from .failover import NoHealthyModelError
+
+logger = logging.getLogger(__name__)
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("GEMINI_RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("GEMINI_RETRY_MAX_DELAY", "8"))
+RETRY_DEADLINE = float(os.getenv("GEMINI_RETRY_DEADLINE", "45"))
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+MIN_ATTEMPT_SECONDS = 1.0
+
+
+class Deadline:
+    """Wall-clock budget shared by every attempt of one request."""
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def timeout(self, cap: float) -> float:
+        """Per-attempt timeout: never longer than `cap`, never past the deadline."""
+        return max(0.001, min(cap, self.remaining()))
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int = RETRY_MAX_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY, deadline: float = RETRY_DEADLINE, rng: random.Random | None = None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self._rng = rng or random.Random()
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter delay before retry number `attempt` (1-based)."""
+        return self._rng.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+
+def _error_body(exc) -> dict:
+    try:
+        body = exc.response.json()
+    except Exception:
+        return {}
+    return body.get("error", {}) if isinstance(body, dict) else {}
+
+
+def server_retry_delay(exc: Exception) -> float | None:
+    """Delay the server asked for: Retry-After header or RetryInfo.retryDelay."""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    header = response.headers.get("Retry-After") if response.headers is not None else None
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(header).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    for detail in _error_body(exc).get("details") or []:
+        if isinstance(detail, dict) and detail.get("@type", "").endswith("google.rpc.RetryInfo"):
+            delay = str(detail.get("retryDelay", "")).rstrip("s")
+            try:
+                return max(0.0, float(delay))
+            except ValueError:
+                return None
+    return None
+
+
+def _daily_quota_exhausted(exc: Exception) -> bool:
+    for detail in _error_body(exc).get("details") or []:
+        if isinstance(detail, dict) and detail.get("@type", "").endswith("google.rpc.QuotaFailure"):
+            for violation in detail.get("violations") or []:
+                if "perday" in str(violation.get("quotaId", "")).lower():
+                    return True
+    return False
+
+
+def is_retryable(exc: Exception, idempotent: bool = True) -> bool:
+    if isinstance(exc, NoHealthyModelError):
+        return False  # every breaker is cooling down; a backoff-sized wait cannot outlast that
+    if isinstance(exc, requests.HTTPError):
+        status = exc.response.status_code if exc.response is not None else None
+        if status not in RETRYABLE_STATUS:
+            return False
+        return not (status == 429 and _daily_quota_exhausted(exc))
+    if isinstance(exc, requests.ConnectTimeout):
+        return True  # nothing reached the server
+    if isinstance(exc, (requests.Timeout, requests.ConnectionError)):
+        return idempotent
+    return False
+
+
+class RetryStats:
+    """Per-attempt timing of recent calls, summarised as the latency retries add."""
+
+    def __init__(self, window: int = 500):
+        self.calls = 0
+        self.retried_calls = 0
+        self.attempts = 0
+        self.gave_up = 0
+        self._overheads = deque(maxlen=window)  # seconds spent after the first attempt, retried calls only
+        self._lock = threading.Lock()
+
+    def record(self, attempt_log: list, started: float, ok: bool):
+        """attempt_log: [(attempt, seconds, outcome)] for one call."""
+        with self._lock:
+            self.calls += 1
+            self.attempts += len(attempt_log)
+            if not ok:
+                self.gave_up += 1
+            if len(attempt_log) > 1:
+                self.retried_calls += 1
+                self._overheads.append(time.monotonic() - started - attempt_log[0][1])
+
+    def stats(self) -> dict:
+        with self._lock:
+            overheads = sorted(self._overheads)
+
+            def pct(p):
+                return round(overheads[min(len(overheads) - 1, int(len(overheads) * p / 100))] * 1000, 1) if overheads else None
+
+            return {
+                "calls": self.calls,
+                "attempts": self.attempts,
+                "retried_calls": self.retried_calls,
+                "gave_up_after_retries": self.gave_up,
+                "retry_added_latency_ms": {"p50": pct(50), "p95": pct(95), "max": pct(100)},
+            }
+
+
+def _next_delay(exc, attempt: int, policy: RetryPolicy, deadline: Deadline, idempotent: bool) -> float | None:
+    """Seconds to wait before the next attempt, or None to give up and re-raise."""
+    if attempt >= policy.max_attempts or not is_retryable(exc, idempotent):
+        return None
+    delay = server_retry_delay(exc)
+    if delay is None:
+        delay = policy.backoff(attempt)
+    elif delay > policy.max_delay:
+        logger.info(f"Not retrying: the server asked for {delay:.1f}s, more than the {policy.max_delay:.1f}s cap")
+        return None
+    if delay + MIN_ATTEMPT_SECONDS > deadline.remaining():
+        logger.info(f"Not retrying: waiting {delay:.1f}s would exceed the request deadline")
+        return None
+    return delay
+
+
+def call_with_retry(fn, policy: RetryPolicy, stats: RetryStats | None = None, deadline: Deadline | None = None,
+                    idempotent: bool = True):
+    """Call fn() until it succeeds, the error is not retryable, attempts run out or the deadline would be missed."""
+    deadline = deadline or Deadline(policy.deadline)
+    started = time.monotonic()
+    attempt_log = []
+    attempt = 0
+    while True:
+        attempt += 1
+        t0 = time.monotonic()
+        try:
+            result = fn()
+        except Exception as e:
+            attempt_log.append((attempt, time.monotonic() - t0, type(e).__name__))
+            delay = _next_delay(e, attempt, policy, deadline, idempotent)
+            if delay is None:
+                if stats is not None:
+                    stats.record(attempt_log, started, ok=False)
+                raise
+            logger.warning(f"Attempt {attempt} failed ({e}); retrying in {delay:.2f}s")
+            time.sleep(delay)
+            continue
+        attempt_log.append((attempt, time.monotonic() - t0, "ok"))
+        if stats is not None:
+            stats.record(attempt_log, started, ok=True)
+        return result
+
+
+async def call_with_retry_async(coro_fn, policy: RetryPolicy, stats: RetryStats | None = None,
+                                deadline: Deadline | None = None, idempotent: bool = True):
+    """asyncio version of call_with_retry(); waits with asyncio.sleep so the event loop keeps running."""
+    deadline = deadline or Deadline(policy.deadline)
+    started = time.monotonic()
+    attempt_log = []
+    attempt = 0
+    while True:
+        attempt += 1
+        t0 = time.monotonic()
+        try:
+            result = await coro_fn()
+        except Exception as e:
+            attempt_log.append((attempt, time.monotonic() - t0, type(e).__name__))
+            delay = _next_delay(e, attempt, policy, deadline, idempotent)
+            if delay is None:
+                if stats is not None:
+                    stats.record(attempt_log, started, ok=False)
+                raise
+            logger.warning(f"Attempt {attempt} failed ({e}); retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            continue
+        attempt_log.append((attempt, time.monotonic() - t0, "ok"))
+        if stats is not None:
+            stats.record(attempt_log, started, ok=True)
+        return result
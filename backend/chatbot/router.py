@@ -0,0 +1,160 @@
+# chatbot/router.py
+"""
+Latency-aware model routing from live generateContent measurements.
+
+choose_model() ranks models by name heuristics only ("flash" +3, "pro" +2,
+...). LatencyRouter reorders that ranking using what it actually observes:
+for every model it keeps an EWMA of latency, a p95 over recent calls and an
+EWMA error rate. Each request goes to the best-ranked model that currently
+meets the latency SLO. Models that miss it follow, fastest first. A small
+exploration fraction sends traffic to other models now and then, so their
+statistics do not go stale while they are not the leader.
+
+The router plugs into FailoverChain (chatbot/failover.py): the chain asks it
+for the order to try models in and reports every attempt back to it, so the
+Django views and the FastAPI service share the same routing logic.
+
+Configuration (environment):
+  GEMINI_ROUTER_ENABLED       0 to keep the static ranking (default 1)
+  GEMINI_LATENCY_SLO          target p95 latency in seconds (default 10)
+  GEMINI_ROUTER_MAX_ERRORS    error rate above which a model misses the SLO (default 0.2)
+  GEMINI_ROUTER_EXPLORE       fraction of requests routed for exploration (default 0.05)
+  GEMINI_ROUTER_EWMA_ALPHA    weight of the newest sample in the EWMAs (default 0.2)
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+
+ROUTER_ENABLED = os.getenv("GEMINI_ROUTER_ENABLED", "1").lower() not in ("0", "false", "no")
+LATENCY_SLO = float(os.getenv("GEMINI_LATENCY_SLO", "10"))
+ROUTER_MAX_ERRORS = float(os.getenv("GEMINI_ROUTER_MAX_ERRORS", "0.2"))
+ROUTER_EXPLORE = float(os.getenv("GEMINI_ROUTER_EXPLORE", "0.05"))
+ROUTER_EWMA_ALPHA = float(os.getenv("GEMINI_ROUTER_EWMA_ALPHA", "0.2"))
+
+MIN_SAMPLES = 5
+P95_WINDOW = 200
+
+
+class ModelStats:
+    """Rolling latency/error statistics for one model."""
+
+    def __init__(self, alpha: float = ROUTER_EWMA_ALPHA):
+        self.alpha = alpha
+        self.count = 0
+        self.errors = 0
+        self.ewma_latency = None
+        self.ewma_error_rate = 0.0
+        self.last_observed = 0.0
+        self._latencies = deque(maxlen=P95_WINDOW)
+
+    def observe(self, latency: float, ok: bool):
+        self.count += 1
+        self.last_observed = time.monotonic()
+        if not ok:
+            self.errors += 1
+        self.ewma_error_rate += self.alpha * ((0.0 if ok else 1.0) - self.ewma_error_rate)
+        if ok:
+            self._latencies.append(latency)
+            if self.ewma_latency is None:
+                self.ewma_latency = latency
+            else:
+                self.ewma_latency += self.alpha * (latency - self.ewma_latency)
+
+    def percentile(self, pct: float) -> float | None:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    @property
+    def p95(self) -> float | None:
+        return self.percentile(95)
+
+    def snapshot(self) -> dict:
+        p95 = self.p95
+        return {
+            "requests": self.count,
+            "errors": self.errors,
+            "ewma_latency_ms": round(self.ewma_latency * 1000, 1) if self.ewma_latency is not None else None,
+            "p95_latency_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "ewma_error_rate": round(self.ewma_error_rate, 4),
+        }
+
+
+class LatencyRouter:
+    """Orders candidate models by SLO compliance using live EWMA/p95/error-rate measurements."""
+
+    def __init__(self, slo: float = LATENCY_SLO, max_error_rate: float = ROUTER_MAX_ERRORS,
+                 explore: float = ROUTER_EXPLORE, alpha: float = ROUTER_EWMA_ALPHA, rng: random.Random | None = None):
+        self.slo = slo
+        self.max_error_rate = max_error_rate
+        self.explore = explore
+        self.alpha = alpha
+        self.decisions = {}
+        self.explorations = 0
+        self._stats = {}
+        self._rng = rng or random.Random()
+        self._lock = threading.Lock()
+
+    def _model_stats(self, model_id: str) -> ModelStats:
+        stats = self._stats.get(model_id)
+        if stats is None:
+            stats = self._stats[model_id] = ModelStats(self.alpha)
+        return stats
+
+    def observe(self, model_id: str, latency: float, ok: bool):
+        with self._lock:
+            self._model_stats(model_id).observe(latency, ok)
+
+    def percentile(self, model_id: str, pct: float) -> float | None:
+        """Observed latency percentile for a model; None until it has MIN_SAMPLES calls."""
+        with self._lock:
+            stats = self._stats.get(model_id)
+            if stats is None or stats.count < MIN_SAMPLES:
+                return None
+            return stats.percentile(pct)
+
+    def meets_slo(self, model_id: str) -> bool:
+        """Models without enough samples get the benefit of the doubt."""
+        stats = self._stats.get(model_id)
+        if stats is None or stats.count < MIN_SAMPLES:
+            return True
+        p95 = stats.p95
+        return (p95 is None or p95 <= self.slo) and stats.ewma_error_rate <= self.max_error_rate
+
+    def order(self, models: list) -> list:
+        """Return `models` (static rank order) rearranged for the next request."""
+        if len(models) < 2:
+            return list(models)
+        with self._lock:
+            meeting = [m for m in models if self.meets_slo(m)]
+            missing = [m for m in models if m not in meeting]
+            missing.sort(key=lambda m: (self._stats[m].ewma_error_rate > self.max_error_rate, self._stats[m].p95 or 0))
+            ordered = meeting + missing
+            if self.explore > 0 and self._rng.random() < self.explore:
+                # probe the model we have heard least from recently
+                candidate = min(ordered[1:], key=lambda m: self._stats[m].last_observed if m in self._stats else 0.0)
+                ordered.remove(candidate)
+                ordered.insert(0, candidate)
+                self.explorations += 1
+            self.decisions[ordered[0]] = self.decisions.get(ordered[0], 0) + 1
+            return ordered
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "slo_p95_ms": round(self.slo * 1000),
+                "explore_fraction": self.explore,
+                "explorations": self.explorations,
+                "decisions": dict(self.decisions),
+                "models": {
+                    model_id: {**stats.snapshot(), "meets_slo": self.meets_slo(model_id)}
+                    for model_id, stats in self._stats.items()
+                },
+            }
+
+
+def build_router() -> LatencyRouter | None:
+    return LatencyRouter() if ROUTER_ENABLED else None
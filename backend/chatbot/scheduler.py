@@ -0,0 +1,343 @@
+# chatbot/scheduler.py
+"""
+Admission control and priority scheduling for upstream Gemini calls.
+
+Without it, a burst ties up every Django worker thread in a Gemini call for up
+to 30 s and everyone's latency degrades. AdmissionScheduler limits how many
+upstream calls a process runs at once. Callers over the limit wait in a
+priority queue: interactive chat first, then probes (the ListModels catalog
+refresh that decides which models are usable), then background jobs such as
+summaries. The queue is not allowed to grow into a standing backlog:
+
+  * CoDel-style shedding: every dequeue measures how long the request waited
+    (its sojourn time). If sojourn times stay above `target` for a whole
+    `interval`, the queue is standing rather than absorbing a burst. New
+    arrivals that would have to queue are then rejected immediately, until a
+    dequeue sees a sojourn below target again.
+  * An arrival whose expected wait exceeds `queue_timeout` is rejected
+    immediately. The expected wait is the queue ahead of it times the EWMA
+    service time, divided by the concurrency.
+  * A request that still waits longer than `queue_timeout` gives up.
+
+Rejections raise OverloadedError, which the views turn into a fast 503 with a
+Retry-After header. Threads wait on an Event and asyncio tasks on a Future, so
+the Django views and the FastAPI service use the same scheduler. stats()
+exports the queue-depth and wait-time histograms.
+
+Configuration (environment):
+  GEMINI_SCHEDULER          0 to disable admission control (default 1)
+  GEMINI_MAX_INFLIGHT       concurrent upstream calls per process (default 32)
+  GEMINI_QUEUE_TARGET       CoDel target sojourn time in seconds (default 0.5)
+  GEMINI_QUEUE_INTERVAL     CoDel interval in seconds (default 2)
+  GEMINI_QUEUE_TIMEOUT      longest a request may wait for a slot, in seconds (default 5)
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_ENABLED = os.getenv("GEMINI_SCHEDULER", "1").lower() not in ("0", "false", "no")
+MAX_INFLIGHT = int(os.getenv("GEMINI_MAX_INFLIGHT", "32"))
+QUEUE_TARGET = float(os.getenv("GEMINI_QUEUE_TARGET", "0.5"))
+QUEUE_INTERVAL = float(os.getenv("GEMINI_QUEUE_INTERVAL", "2"))
+QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", "5"))
+
+# Priority classes, most urgent first
+INTERACTIVE = "interactive"
+PROBE = "probe"
+BACKGROUND = "background"
+PRIORITIES = {INTERACTIVE: 0, PROBE: 1, BACKGROUND: 2}
+
+WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SERVICE_EWMA_ALPHA = 0.1
+
+
+class OverloadedError(RuntimeError):
+    """The request was shed; retry after `retry_after` seconds."""
+
+    def __init__(self, retry_after: float, reason: str):
+        super().__init__(f"Server is overloaded ({reason}); retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Histogram:
+    """Fixed-bound bucket counts plus an overflow bucket."""
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += 1
+        self.sum += value
+
+    def snapshot(self) -> dict:
+        buckets = {f"le_{bound}": count for bound, count in zip(self.bounds, self.counts)}
+        buckets["inf"] = self.counts[-1]
+        return {"count": self.total, "sum": round(self.sum, 1), "buckets": buckets}
+
+
+class Ticket:
+    """A granted slot; release() is idempotent."""
+
+    __slots__ = ("scheduler", "priority", "admitted_at", "released")
+
+    def __init__(self, scheduler, priority: str):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler._release(self)
+
+    def wrap(self, iterable):
+        """Iterator that releases the ticket when exhausted or closed (for StreamingHttpResponse bodies)."""
+        return _ReleasingIterator(self, iterable)
+
+
+class _ReleasingIterator:
+    def __init__(self, ticket: Ticket, iterable):
+        self._ticket = ticket
+        self._iterator = iter(iterable)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except BaseException:
+            self._ticket.release()
+            raise
+
+    def close(self):
+        try:
+            close = getattr(self._iterator, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self._ticket.release()
+
+
+class _Waiter:
+    __slots__ = ("priority", "enqueued_at", "granted", "cancelled", "notify")
+
+    def __init__(self, priority: str, notify):
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.cancelled = False
+        self.notify = notify
+
+
+class AdmissionScheduler:
+    def __init__(self, max_concurrency: int = MAX_INFLIGHT, target: float = QUEUE_TARGET,
+                 interval: float = QUEUE_INTERVAL, queue_timeout: float = QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.target = target
+        self.interval = interval
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.dropping = False
+        self.admitted = {p: 0 for p in PRIORITIES}
+        self.shed = {p: {} for p in PRIORITIES}
+        self._first_above = 0.0
+        self._service_time = None
+        self._queue = []  # (priority rank, seq, waiter)
+        self._queued = {p: 0 for p in PRIORITIES}
+        self._seq = itertools.count()
+        self._wait_ms = {p: Histogram(WAIT_BUCKETS_MS) for p in PRIORITIES}
+        self._depth = Histogram(DEPTH_BUCKETS)
+        self._lock = threading.Lock()
+
+    # -- bookkeeping (call with self._lock held) --
+
+    def _queue_depth(self) -> int:
+        return sum(self._queued.values())
+
+    def _expected_wait(self, ahead: int) -> float | None:
+        if self._service_time is None:
+            return None
+        return (ahead + 1) * self._service_time / self.max_concurrency
+
+    def _retry_after(self) -> float:
+        expected = self._expected_wait(self._queue_depth())
+        return max(1.0, expected if expected is not None else self.interval)
+
+    def _reject(self, priority: str, reason: str) -> OverloadedError:
+        counts = self.shed[priority]
+        counts[reason] = counts.get(reason, 0) + 1
+        return OverloadedError(self._retry_after(), reason)
+
+    def _codel(self, sojourn: float, now: float):
+        if sojourn < self.target:
+            self._first_above = 0.0
+            if self.dropping:
+                logger.info("Upstream queue drained; admission shedding stopped")
+            self.dropping = False
+        elif self._first_above == 0.0:
+            self._first_above = now + self.interval
+        elif now >= self._first_above and not self.dropping:
+            self.dropping = True
+            logger.warning(f"Upstream queue wait above {self.target}s for {self.interval}s; shedding new arrivals")
+
+    def _admit(self, priority: str, notify):
+        """Return a Ticket when a slot is free, else a queued _Waiter; raises OverloadedError when shedding."""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority class {priority!r}")
+        with self._lock:
+            depth = self._queue_depth()
+            self._depth.observe(depth)
+            if self.running < self.max_concurrency and depth == 0:
+                self.running += 1
+                self.admitted[priority] += 1
+                self._wait_ms[priority].observe(0.0)
+                return Ticket(self, priority)
+            if self.dropping:
+                raise self._reject(priority, "standing_queue")
+            rank = PRIORITIES[priority]
+            ahead = sum(n for p, n in self._queued.items() if PRIORITIES[p] <= rank)
+            expected = self._expected_wait(ahead)
+            if expected is not None and expected > self.queue_timeout:
+                raise self._reject(priority, "expected_wait")
+            waiter = _Waiter(priority, notify)
+            heapq.heappush(self._queue, (rank, next(self._seq), waiter))
+            self._queued[priority] += 1
+            return waiter
+
+    def _withdraw(self, waiter: _Waiter) -> bool:
+        """Leave the queue; True if the slot was granted in the meantime (the caller now owns it)."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            waiter.cancelled = True
+            self._queued[waiter.priority] -= 1
+            return False
+
+    def _timed_out(self, waiter: _Waiter) -> Ticket:
+        if self._withdraw(waiter):
+            return Ticket(self, waiter.priority)
+        with self._lock:
+            raise self._reject(waiter.priority, "queue_timeout")
+
+    def _release(self, ticket: Ticket):
+        with self._lock:
+            now = time.monotonic()
+            service = now - ticket.admitted_at
+            if self._service_time is None:
+                self._service_time = service
+            else:
+                self._service_time += SERVICE_EWMA_ALPHA * (service - self._service_time)
+            while self._queue:
+                _, _, waiter = heapq.heappop(self._queue)
+                if waiter.cancelled:
+                    continue
+                self._queued[waiter.priority] -= 1
+                sojourn = now - waiter.enqueued_at
+                self._codel(sojourn, now)
+                self._wait_ms[waiter.priority].observe(sojourn * 1000)
+                self.admitted[waiter.priority] += 1
+                waiter.granted = True
+                break  # the slot passes straight to the waiter
+            else:
+                self.running -= 1
+                if not self._queue and self.dropping:
+                    self.dropping = False
+                    self._first_above = 0.0
+                return
+        waiter.notify()
+
+    # -- public API --
+
+    def acquire(self, priority: str = INTERACTIVE) -> Ticket:
+        """Block the calling thread until a slot is granted."""
+        event = threading.Event()
+        admitted = self._admit(priority, event.set)
+        if isinstance(admitted, Ticket):
+            return admitted
+        if event.wait(self.queue_timeout):
+            return Ticket(self, priority)
+        return self._timed_out(admitted)
+
+    async def acquire_async(self, priority: str = INTERACTIVE) -> Ticket:
+        """asyncio version of acquire()."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        admitted = self._admit(priority, notify)
+        if isinstance(admitted, Ticket):
+            return admitted
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            return self._timed_out(admitted)
+        except asyncio.CancelledError:
+            # the caller went away: leave the queue, or hand back a slot granted meanwhile
+            if self._withdraw(admitted):
+                Ticket(self, priority).release()
+            raise
+        return Ticket(self, priority)
+
+    @contextmanager
+    def slot(self, priority: str = INTERACTIVE):
+        ticket = self.acquire(priority)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    @asynccontextmanager
+    async def slot_async(self, priority: str = INTERACTIVE):
+        ticket = await self.acquire_async(priority)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def run(self, priority: str, fn):
+        with self.slot(priority):
+            return fn()
+
+    async def run_async(self, priority: str, coro_fn):
+        async with self.slot_async(priority):
+            return await coro_fn()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "running": self.running,
+                "queued": dict(self._queued),
+                "dropping": self.dropping,
+                "service_time_ms": round(self._service_time * 1000, 1) if self._service_time is not None else None,
+                "admitted": dict(self.admitted),
+                "shed": {p: dict(reasons) for p, reasons in self.shed.items()},
+                "queue_depth_histogram": self._depth.snapshot(),
+                "wait_ms_histogram": {p: h.snapshot() for p, h in self._wait_ms.items()},
+            }
+
+
+def build_scheduler() -> AdmissionScheduler | None:
+    return AdmissionScheduler() if SCHEDULER_ENABLED else None
@@ -0,0 +1,231 @@
+# chatbot/search.py
+"""
+Full-text search over chat history with SQLite FTS5.
+
+chat_messages_fts is an external-content FTS5 table over chat_messages
+(migration 0007). It stores only the inverted index and reads the text back
+from chat_messages, and triggers on chat_messages keep it in step with every
+insert, update and delete. That covers record_message, write-behind batches
+and the purger alike. The migration indexes the rows that were already
+there, and `manage.py rebuild_search_index` repairs the index if it ever
+drifts.
+
+user_id is indexed as a second FTS column with BM25 weight 0. Each search
+matches the user's id as a phrase in that column, so FTS5 intersects the
+term lists with the user's own list before any row is read. An exact
+m.user_id = ? on the joined row then removes ids that only share tokens
+(user_1 vs user_1_2). The session, date and clear tombstone filters apply to
+that small set. Results are ordered by bm25() over the text column, and
+snippet() marks the matches. Scoring bm25() costs about 1 us per matching
+row. A word that appears in nearly every message of a user with 50k messages
+would take ~150 ms to rank in full, so only the newest
+GEMINI_SEARCH_CANDIDATES matches are ranked. For most queries that is every
+match. The snippet is HTML-escaped and the markers
+become <mark> tags, so it is safe to render as HTML.
+
+Latency still grows with how common the terms are, because FTS5 reads each
+term's whole posting list. On 2M messages (benchmarks/bench_search.py), a
+rare word takes well under a millisecond for a typical user and ~15 ms for a
+user with 100k messages. A word in ~1% of messages takes 2-20 ms. A word in
+nearly every message, or a phrase of common words, takes ~100 ms. A LIKE
+scan over the heavy user's messages takes ~100 ms for any term.
+
+The query string is never passed to MATCH as written. Words become quoted
+terms and a trailing * becomes a prefix match. "Quoted phrases" are kept as
+phrases, and every term must match. FTS5 operator syntax in user input can
+therefore neither break the query nor change its meaning.
+
+Django's SQLite schema editor rebuilds a table to alter it, which drops its
+triggers. rebuild_search_index recreates them (ensure_index) before it
+reindexes, so run it after any migration that alters ChatMessage.
+
+Configuration (environment):
+  GEMINI_SEARCH_PAGE_SIZE        results per page when no limit is given (default 20)
+  GEMINI_SEARCH_MAX_RESULTS      cap on offset + limit (default 200)
+  GEMINI_SEARCH_SNIPPET_TOKENS   tokens of context in each snippet (default 16)
+  GEMINI_SEARCH_CANDIDATES       newest matches ranked by BM25 per query (default 2000)
+"""
+import html
+import os
+import re
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import connection
+from django.utils.dateparse import parse_datetime
+
+SEARCH_PAGE_SIZE = int(os.getenv("GEMINI_SEARCH_PAGE_SIZE", "20"))
+SEARCH_MAX_RESULTS = int(os.getenv("GEMINI_SEARCH_MAX_RESULTS", "200"))
+SEARCH_SNIPPET_TOKENS = int(os.getenv("GEMINI_SEARCH_SNIPPET_TOKENS", "16"))
+SEARCH_CANDIDATES = int(os.getenv("GEMINI_SEARCH_CANDIDATES", "2000"))
+
+FTS_TABLE = "chat_messages_fts"
+MAX_TERMS = 16
+MARK_OPEN, MARK_CLOSE = "\x02", "\x03"
+
+# same statements as migration 0007, for recreating triggers dropped by a table rebuild
+SCHEMA = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        text, user_id, content='chat_messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ai AFTER INSERT ON chat_messages BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, text, user_id) VALUES (new.id, new.text, new.user_id);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ad AFTER DELETE ON chat_messages BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text, user_id) VALUES ('delete', old.id, old.text, old.user_id);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_au AFTER UPDATE OF text, user_id ON chat_messages BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text, user_id) VALUES ('delete', old.id, old.text, old.user_id);
+        INSERT INTO {FTS_TABLE}(rowid, text, user_id) VALUES (new.id, new.text, new.user_id);
+    END
+    """,
+]
+
+_PHRASE = re.compile(r'"([^"]*)"')
+_TERM = re.compile(r"\w+\*?")
+
+
+class InvalidSearch(ValueError):
+    """The search query or one of its filters could not be used."""
+
+
+class SearchUnavailable(RuntimeError):
+    """The database has no FTS5 search index (not SQLite, or migration 0007 not applied)."""
+
+
+def search_available() -> bool:
+    if connection.vendor != "sqlite":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+        return cursor.fetchone() is not None
+
+
+def _quote(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+def build_match(query: str) -> str:
+    """FTS5 expression that requires every word/phrase of `query`; raises InvalidSearch if it has none."""
+    parts = []
+    for phrase in _PHRASE.findall(query):
+        words = _TERM.findall(phrase)
+        if words:
+            parts.append(_quote(" ".join(word.rstrip("*") for word in words)))
+    for word in _TERM.findall(_PHRASE.sub(" ", query)):
+        parts.append(_quote(word[:-1]) + "*" if word.endswith("*") else _quote(word))
+    if not parts:
+        raise InvalidSearch("Search query must contain at least one word")
+    if len(parts) > MAX_TERMS:
+        raise InvalidSearch(f"Search query has more than {MAX_TERMS} terms")
+    return " AND ".join(parts)
+
+
+def parse_paging(limit: str | None, offset: str | None) -> tuple:
+    try:
+        limit = int(limit) if limit not in (None, "") else SEARCH_PAGE_SIZE
+        offset = int(offset) if offset not in (None, "") else 0
+    except ValueError as e:
+        raise InvalidSearch("limit and offset must be integers") from e
+    if limit < 1 or offset < 0:
+        raise InvalidSearch("limit must be at least 1 and offset not negative")
+    limit = min(limit, SEARCH_MAX_RESULTS)
+    if offset + limit > SEARCH_MAX_RESULTS:
+        raise InvalidSearch(f"Results beyond the first {SEARCH_MAX_RESULTS} are not available; refine the query")
+    return limit, offset
+
+
+def highlight(snippet: str) -> str:
+    return html.escape(snippet).replace(MARK_OPEN, "<mark>").replace(MARK_CLOSE, "</mark>")
+
+
+def _timestamp(value) -> datetime:
+    stamp = value if isinstance(value, datetime) else parse_datetime(value)
+    return stamp if stamp.tzinfo else stamp.replace(tzinfo=dt_timezone.utc)
+
+
+def search_messages(query: str, user_id: str, session_id: str | None = None, since: datetime | None = None,
+                    until: datetime | None = None, limit: int = SEARCH_PAGE_SIZE, offset: int = 0) -> dict:
+    """A user's messages matching `query`, best BM25 match first, each with a highlighted snippet."""
+    if not search_available():
+        raise SearchUnavailable("Full-text search needs the SQLite FTS5 index (migration 0007)")
+    match = build_match(query)
+    if re.search(r"\w", user_id):
+        match = f"user_id : {_quote(user_id)} AND text : ({match})"
+    else:
+        match = f"text : ({match})"
+
+    filters, params = ["m.user_id = %s"], [user_id]
+    if session_id is not None:
+        filters.append("m.session_id = %s")
+        params.append(session_id)
+    if since is not None:
+        filters.append("m.timestamp >= %s")
+        params.append(connection.ops.adapt_datetimefield_value(since))
+    if until is not None:
+        filters.append("m.timestamp <= %s")
+        params.append(connection.ops.adapt_datetimefield_value(until))
+    # bm25() is scored for at most `candidates` matches, newest first (FTS5 walks its doclist backwards and stops);
+    # snippet() re-reads and re-tokenizes text, so it runs only for the page
+    sql = f"""
+        WITH candidates AS (
+            SELECT m.id AS id, bm25({FTS_TABLE}, 1.0, 0.0) AS score
+            FROM {FTS_TABLE} CROSS JOIN chat_messages m ON m.id = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH %s AND {" AND ".join(filters)}
+              AND NOT EXISTS (
+                  SELECT 1 FROM chat_sessions s
+                  WHERE s.user_id = m.user_id AND s.session_id = m.session_id AND s.cleared_at >= m.timestamp
+              )
+            ORDER BY {FTS_TABLE}.rowid DESC
+            LIMIT %s
+        ), hits AS (
+            SELECT id, score FROM candidates ORDER BY score LIMIT %s OFFSET %s
+        )
+        SELECT m.id, m.session_id, m.sender, m.timestamp, snippet({FTS_TABLE}, 0, %s, %s, '…', %s), hits.score
+        FROM hits
+        CROSS JOIN {FTS_TABLE} ON {FTS_TABLE}.rowid = hits.id
+        CROSS JOIN chat_messages m ON m.id = hits.id
+        WHERE {FTS_TABLE} MATCH %s
+        ORDER BY hits.score
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [match, *params, SEARCH_CANDIDATES, limit + 1, offset, MARK_OPEN, MARK_CLOSE, SEARCH_SNIPPET_TOKENS, match])
+        rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    results = [
+        {
+            'id': str(message_id),
+            'session_id': row_session,
+            'sender': sender,
+            'timestamp': _timestamp(stamp).isoformat(),
+            'snippet': highlight(snippet),
+            'score': -score,  # bm25() is lower-is-better; report higher-is-better
+        }
+        for message_id, row_session, sender, stamp, snippet, score in rows[:limit]
+    ]
+    return {"query": query, "results": results, "count": len(results), "has_more": has_more}
+
+
+def ensure_index():
+    """Create the FTS table and its triggers if any are missing."""
+    with connection.cursor() as cursor:
+        for sql in SCHEMA:
+            cursor.execute(sql)
+
+
+def rebuild_index() -> int:
+    """Recreate missing schema, reindex every row of chat_messages, and return the number of rows indexed."""
+    if connection.vendor != "sqlite":
+        raise SearchUnavailable("Full-text search is only available on SQLite")
+    ensure_index()
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+        cursor.execute("SELECT COUNT(*) FROM chat_messages")
+        return cursor.fetchone()[0]
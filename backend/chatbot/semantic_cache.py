@@ -0,0 +1,281 @@
+# chatbot/semantic_cache.py
+"""
+Near-duplicate answer cache: "what is photosynthesis" and "explain
+photosynthesis" should share one Gemini answer.
+
+Prompts are embedded locally with a hashed word + character n-gram vectorizer
+(no model download, NumPy only) into L2-normalised float32 vectors. Stored
+vectors live in one preallocated float32 matrix per model. A lookup first
+narrows the matrix to a candidate set with random-hyperplane LSH bands (a few
+dict lookups), then scores the candidates with one vectorized cosine product
+and returns the stored answer if the best score clears the threshold. This
+keeps lookups well under a millisecond at 100k entries, where a full matrix
+scan would not be.
+
+Wording can change freely but the substance of a question cannot. The
+question word ("when" vs "why"), numbers and operators are part of the
+embedding, and they also form an exact signature that a stored entry must
+share to be returned. So "What is 3+2?" and "What is 3*2?" never trade
+answers, however close their vectors are. "explain", "describe" and "define"
+count as the same question word as "what".
+
+Capacity is bounded per model; when full, the least recently used entry is
+evicted. Entries also expire after a TTL.
+
+Configuration (environment):
+  GEMINI_SEMANTIC_CACHE      1 to enable (default off)
+  GEMINI_SEMANTIC_THRESHOLD  minimum cosine similarity for a hit (default 0.92)
+  GEMINI_SEMANTIC_CAPACITY   max entries per model (default 10000)
+  GEMINI_SEMANTIC_TTL        seconds an entry stays valid (default 3600)
+"""
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_ENABLED = os.getenv("GEMINI_SEMANTIC_CACHE", "0").lower() in ("1", "true", "yes", "on")
+SEMANTIC_THRESHOLD = float(os.getenv("GEMINI_SEMANTIC_THRESHOLD", "0.92"))
+SEMANTIC_CAPACITY = int(os.getenv("GEMINI_SEMANTIC_CAPACITY", "10000"))
+SEMANTIC_TTL = float(os.getenv("GEMINI_SEMANTIC_TTL", "3600"))
+
+EMBEDDING_DIM = 256
+LSH_TABLES = 8
+LSH_BAND_BITS = 12
+
+# Filler that carries no topic: dropped so paraphrases embed alike.
+STOPWORDS = frozenset("""
+a an the is are was were be been am do does did can could would should will shall may might
+tell me us about please give show i you we my your of to in on for and or with by as at it
+its this that these those
+""".split())
+
+# Question words, mapped to the kind of answer they ask for.
+QUESTION_WORDS = {
+    "what": "what", "whats": "what", "explain": "what", "describe": "what", "define": "what",
+    "which": "which", "who": "who", "whom": "who", "whose": "who", "how": "how", "why": "why",
+    "when": "when", "where": "where",
+}
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?|[-+*/^=<>%]")
+_OPERATORS = frozenset("-+*/^=<>%")
+
+
+class HashedNgramEmbedder:
+    """Signed feature hashing of question words, word unigrams/bigrams and character trigrams into `dim` buckets."""
+
+    def __init__(self, dim: int = EMBEDDING_DIM, char_ngram: int = 3, char_weight: float = 0.5):
+        self.dim = dim
+        self.char_ngram = char_ngram
+        self.char_weight = char_weight
+
+    def _features(self, text: str):
+        tokens = _TOKEN_RE.findall(text.lower())
+        for question in dict.fromkeys(QUESTION_WORDS[t] for t in tokens if t in QUESTION_WORDS):
+            yield "q:" + question, 1.0
+        words = [t for t in tokens if t not in STOPWORDS and t not in QUESTION_WORDS]
+        for word in words:
+            yield "w:" + word, 1.0
+            if word in _OPERATORS:
+                continue
+            padded = f"#{word}#"
+            for i in range(len(padded) - self.char_ngram + 1):
+                yield "c:" + padded[i:i + self.char_ngram], self.char_weight
+        for first, second in zip(words, words[1:]):
+            yield f"b:{first} {second}", 1.0
+
+    @staticmethod
+    def signature(text: str) -> tuple:
+        """What must match exactly for a hit: the question words, then every number and operator in order."""
+        tokens = _TOKEN_RE.findall(text.lower())
+        questions = tuple(dict.fromkeys(QUESTION_WORDS[t] for t in tokens if t in QUESTION_WORDS))
+        return questions, tuple(t for t in tokens if t in _OPERATORS or any(c.isdigit() for c in t))
+
+    def embed(self, text: str):
+        """Return an L2-normalised float32 vector (all zeros when the text has no content words)."""
+        indices = []
+        weights = []
+        for feature, weight in self._features(text):
+            h = zlib.crc32(feature.encode("utf-8"))
+            indices.append(h % self.dim)
+            weights.append(weight if h & 0x80000000 else -weight)
+        vec = np.bincount(indices, weights=weights, minlength=self.dim).astype(np.float32) if indices \
+            else np.zeros(self.dim, dtype=np.float32)
+        norm = float(np.linalg.norm(vec))
+        if norm > 0:
+            vec /= norm
+        return vec
+
+
+class SemanticIndex:
+    """Bounded float32 vector store with LSH candidate selection, LRU eviction and TTL."""
+
+    def __init__(self, dim: int = EMBEDDING_DIM, capacity: int = SEMANTIC_CAPACITY, ttl: float = SEMANTIC_TTL,
+                 tables: int = LSH_TABLES, band_bits: int = LSH_BAND_BITS, seed: int = 7):
+        self.dim = dim
+        self.capacity = capacity
+        self.ttl = ttl
+        self.tables = tables
+        self.band_bits = band_bits
+        rng = np.random.default_rng(seed)
+        self._planes = rng.standard_normal((dim, tables * band_bits)).astype(np.float32)
+        self._band_weights = (1 << np.arange(band_bits, dtype=np.int64))
+        allocated = min(capacity, 1024)
+        self._vectors = np.zeros((allocated, dim), dtype=np.float32)
+        self._bands = np.zeros((allocated, tables), dtype=np.int64)
+        self._last_used = np.zeros(allocated, dtype=np.float64)
+        self._expires = np.zeros(allocated, dtype=np.float64)
+        self._values = [None] * allocated
+        self._signatures = [None] * allocated
+        self._buckets = [dict() for _ in range(tables)]
+        self._size = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return self._size
+
+    def _band_keys(self, vec):
+        bits = (vec @ self._planes > 0).reshape(self.tables, self.band_bits)
+        return bits.astype(np.int64) @ self._band_weights
+
+    def _grow(self):
+        new_size = min(self.capacity, len(self._values) * 2)
+        extra = new_size - len(self._values)
+        self._vectors = np.vstack([self._vectors, np.zeros((extra, self.dim), dtype=np.float32)])
+        self._bands = np.vstack([self._bands, np.zeros((extra, self.tables), dtype=np.int64)])
+        self._last_used = np.concatenate([self._last_used, np.zeros(extra)])
+        self._expires = np.concatenate([self._expires, np.zeros(extra)])
+        self._values.extend([None] * extra)
+        self._signatures.extend([None] * extra)
+
+    def _unlink(self, slot: int):
+        for table, key in enumerate(self._bands[slot]):
+            bucket = self._buckets[table].get(int(key))
+            if bucket is not None:
+                bucket.discard(slot)
+                if not bucket:
+                    del self._buckets[table][int(key)]
+
+    def _candidates(self, keys):
+        found = set()
+        for table, key in enumerate(keys):
+            bucket = self._buckets[table].get(int(key))
+            if bucket:
+                found.update(bucket)
+        return found
+
+    def search(self, vec, now: float | None = None, signature=None):
+        """Closest live LSH candidate stored with the same `signature`, as (slot, similarity); (None, 0.0) if none."""
+        candidates = {slot for slot in self._candidates(self._band_keys(vec)) if self._signatures[slot] == signature}
+        if not candidates:
+            return None, 0.0
+        slots = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        now = time.time() if now is None else now
+        slots = slots[self._expires[slots] > now]
+        if slots.size == 0:
+            return None, 0.0
+        scores = self._vectors[slots] @ vec
+        best = int(scores.argmax())
+        return int(slots[best]), float(scores[best])
+
+    def get(self, slot: int):
+        self._last_used[slot] = time.time()
+        return self._values[slot]
+
+    def add(self, vec, value, signature=None):
+        """Store `value` under `vec`, replacing an identical entry or evicting the LRU one when full."""
+        now = time.time()
+        slot, score = self.search(vec, now, signature)
+        if slot is None or score < 0.9999:
+            if self._size < len(self._values):
+                slot = self._size
+                self._size += 1
+            elif self._size < self.capacity:
+                self._grow()
+                slot = self._size
+                self._size += 1
+            else:
+                live = self._last_used[:self._size].copy()
+                live[self._expires[:self._size] <= now] = -1.0  # expired entries go first
+                slot = int(live.argmin())
+                self.evictions += 1
+        self._unlink(slot)
+        keys = self._band_keys(vec)
+        self._vectors[slot] = vec
+        self._bands[slot] = keys
+        self._values[slot] = value
+        self._signatures[slot] = signature
+        self._last_used[slot] = now
+        self._expires[slot] = now + self.ttl
+        for table, key in enumerate(keys):
+            self._buckets[table].setdefault(int(key), set()).add(slot)
+
+
+class SemanticCache:
+    """Per-model semantic indexes plus hit/miss accounting, safe to share between threads."""
+
+    def __init__(self, threshold: float = SEMANTIC_THRESHOLD, capacity: int = SEMANTIC_CAPACITY,
+                 ttl: float = SEMANTIC_TTL, embedder: HashedNgramEmbedder | None = None):
+        self.threshold = threshold
+        self.capacity = capacity
+        self.ttl = ttl
+        self.embedder = embedder or HashedNgramEmbedder()
+        self.hits = 0
+        self.misses = 0
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_id: str, prompt: str):
+        vec = self.embedder.embed(prompt)
+        signature = self.embedder.signature(prompt)
+        with self._lock:
+            index = self._indexes.get(model_id)
+            slot, score = index.search(vec, signature=signature) if index is not None and vec.any() else (None, 0.0)
+            if slot is not None and score >= self.threshold:
+                self.hits += 1
+                return index.get(slot)
+            self.misses += 1
+            return None
+
+    def set(self, model_id: str, prompt: str, value):
+        vec = self.embedder.embed(prompt)
+        if not vec.any():
+            return
+        with self._lock:
+            index = self._indexes.get(model_id)
+            if index is None:
+                index = self._indexes[model_id] = SemanticIndex(
+                    dim=self.embedder.dim, capacity=self.capacity, ttl=self.ttl
+                )
+            index.add(vec, value, self.embedder.signature(prompt))
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "entries": sum(len(index) for index in self._indexes.values()),
+                "capacity_per_model": self.capacity,
+                "evictions": sum(index.evictions for index in self._indexes.values()),
+            }
+
+
+def build_semantic_cache() -> SemanticCache | None:
+    """Create the semantic cache when GEMINI_SEMANTIC_CACHE is on and NumPy is installed."""
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    if np is None:
+        logger.warning("GEMINI_SEMANTIC_CACHE is on but NumPy is not installed; semantic cache disabled")
+        return None
+    return SemanticCache()
@@ -0,0 +1,171 @@
+# chatbot/sessions.py
+"""
+Per-session rollups on ChatSession, kept in step with ChatMessage.
+
+get_sessions used to run one query to list a user's sessions, then a .first()
+and a .count() per session: 2N+1 queries per call. Now every ChatSession row
+carries message_count, first/last message timestamps and a preview of the
+latest message. record_message() inserts the message and bumps the rollup in
+the same transaction. clear_session() deletes the messages and resets the
+rollup together. So the listing is one indexed query on
+chat_session_user_recent_idx (user_id, last_message_at, id), paged with the
+same cursors as chat history. record_messages() does the same for a batch
+(the write-behind queue, chatbot/write_behind.py): one bulk INSERT and one
+rollup UPDATE per session, all in one transaction. A batch queued before a
+clear can commit after it. Its messages are then at or before the session's
+cleared_at and hidden, so they are left out of the rollup.
+
+The rollup is bumped with an UPDATE on F() expressions, so concurrent writers
+to one session never lose a count. The ChatSession row is created on a
+session's first message. If two first messages race, the loser's insert hits
+the unique constraint, and it falls back to the UPDATE.
+
+Clearing is a soft delete. clear_session() and clear_user() set the tombstone
+(cleared_at, purge_pending) and reset the rollup, and chatbot/purge.py deletes
+the hidden rows later in the background.
+
+Every write and clear also bumps ChatSession.version, which is what the
+history cache is keyed on (session_version()).
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .history import decode_cursor, encode_cursor
+from .models import ChatMessage, ChatSession
+
+PREVIEW_CHARS = 200
+
+
+def _bump(user_id: str, session_id: str, count: int, first, last, preview: str) -> int:
+    return ChatSession.objects.filter(user_id=user_id, session_id=session_id).update(
+        message_count=F('message_count') + count,
+        version=F('version') + 1,
+        first_message_at=Coalesce(F('first_message_at'), first),
+        last_message_at=Greatest(Coalesce(F('last_message_at'), last), last),
+        preview=preview[:PREVIEW_CHARS],
+    )
+
+
+def _roll_up(user_id: str, session_id: str, count: int, first, last, preview: str):
+    """Add `count` messages spanning first..last to the session's rollup, creating the row if needed."""
+    if _bump(user_id, session_id, count, first, last, preview):
+        return
+    try:
+        with transaction.atomic():
+            ChatSession.objects.create(
+                user_id=user_id,
+                session_id=session_id,
+                message_count=count,
+                version=1,
+                first_message_at=first,
+                last_message_at=last,
+                preview=preview[:PREVIEW_CHARS],
+            )
+    except IntegrityError:
+        _bump(user_id, session_id, count, first, last, preview)  # created concurrently by another writer
+
+
+def record_message(user_id: str, session_id: str, sender: str, text: str) -> ChatMessage:
+    """Insert a ChatMessage and update its session's rollup atomically."""
+    with transaction.atomic():
+        message = ChatMessage.objects.create(user_id=user_id, session_id=session_id, sender=sender, text=text)
+        _roll_up(user_id, session_id, 1, message.timestamp, message.timestamp, text)
+    return message
+
+
+def _cleared_at(keys: set) -> dict:
+    """(user_id, session_id) -> cleared_at for the sessions in `keys` that have a tombstone."""
+    rows = ChatSession.objects.filter(
+        user_id__in={user_id for user_id, _ in keys},
+        session_id__in={session_id for _, session_id in keys},
+        cleared_at__isnull=False,
+    ).values_list('user_id', 'session_id', 'cleared_at')
+    return {(user_id, session_id): cleared_at for user_id, session_id, cleared_at in rows
+            if (user_id, session_id) in keys}
+
+
+def record_messages(messages: list) -> list:
+    """Insert unsaved ChatMessages (in order) and update every affected rollup in one transaction."""
+    with transaction.atomic():
+        saved = ChatMessage.objects.bulk_create(messages)
+        # read tombstones after the INSERT holds the write lock, so no clear can land in between
+        cleared = _cleared_at({(message.user_id, message.session_id) for message in saved})
+        rollups = {}
+        for message in saved:
+            key = (message.user_id, message.session_id)
+            if key in cleared and message.timestamp <= cleared[key]:
+                continue  # hidden by a clear that committed while the message was queued
+            count, first, last, preview = rollups.get(key, (0, message.timestamp, message.timestamp, ''))
+            if message.timestamp >= last:
+                last, preview = message.timestamp, message.text
+            rollups[key] = (count + 1, min(first, message.timestamp), last, preview)
+        for (user_id, session_id), rollup in rollups.items():
+            _roll_up(user_id, session_id, *rollup)
+    return saved
+
+
+CLEARED = dict(
+    version=F('version') + 1, message_count=0, first_message_at=None, last_message_at=None, preview='',
+    summary='', summary_through_id=None, summary_updated_at=None,
+)
+
+
+def clear_session(user_id: str, session_id: str) -> int:
+    """Hide a session's messages behind a tombstone and reset its rollup and summary; returns the number hidden."""
+    with transaction.atomic():
+        rows = ChatSession.objects.select_for_update().filter(user_id=user_id, session_id=session_id)
+        hidden = rows.values_list('message_count', flat=True).first()
+        if hidden is not None:
+            rows.update(cleared_at=timezone.now(), purge_pending=True, **CLEARED)
+            return hidden
+        # messages without a rollup row (written before rollups existed) still need a tombstone
+        hidden = ChatMessage.objects.filter(user_id=user_id, session_id=session_id).count()
+        if hidden:
+            ChatSession.objects.create(user_id=user_id, session_id=session_id, cleared_at=timezone.now(),
+                                       purge_pending=True, version=1)
+    return hidden
+
+
+def clear_user(user_id: str) -> tuple:
+    """Clear every session of a user in one UPDATE; returns (sessions cleared, messages hidden)."""
+    with transaction.atomic():
+        rows = ChatSession.objects.filter(user_id=user_id, message_count__gt=0)
+        hidden = rows.aggregate(total=Sum('message_count'))['total'] or 0
+        sessions = rows.update(cleared_at=timezone.now(), purge_pending=True, **CLEARED)
+    return sessions, hidden
+
+
+def session_version(user_id: str, session_id: str) -> int:
+    """Current version of a session's messages (0 before its first write); one lookup on the unique index."""
+    return ChatSession.objects.filter(user_id=user_id, session_id=session_id).values_list('version', flat=True).first() or 0
+
+
+def session_page(user_id: str, before: str | None = None, limit: int = 50) -> dict:
+    """A user's non-empty sessions, most recently active first; `before` is the previous page's cursor."""
+    rows = ChatSession.objects.filter(user_id=user_id, message_count__gt=0)
+    if before:
+        stamp, row_id = decode_cursor(before)
+        rows = rows.filter(last_message_at__lte=stamp).exclude(last_message_at=stamp, id__gte=row_id)
+    page = list(rows.order_by('-last_message_at', '-id').values_list(
+        'id', 'session_id', 'message_count', 'first_message_at', 'last_message_at', 'preview'
+    )[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    sessions = [
+        {
+            'session_id': session_id,
+            'created_at': first.isoformat(),
+            'last_message_at': last.isoformat(),
+            'message_count': count,
+            'preview': preview,
+        }
+        for _, session_id, count, first, last, preview in page
+    ]
+    return {
+        "sessions": sessions,
+        "count": len(sessions),
+        "has_more": has_more,
+        "cursors": {"before": encode_cursor(page[-1][4], page[-1][0]) if has_more else None},
+    }
@@ -0,0 +1,96 @@
+# chatbot/singleflight.py
+"""
+Single-flight request coalescing.
+
+When several callers ask for the same generation request at the same moment
+(a class pasting one assignment question), only the first one calls Gemini.
+The others wait for that call and receive the same result, or the same
+exception. SingleFlight serves the threaded Django views and AsyncSingleFlight
+serves the asyncio FastAPI service. Both count how many upstream calls were
+saved.
+"""
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapse concurrent calls that share a key into one execution (thread-safe)."""
+
+    def __init__(self):
+        self.executed = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn):
+        """Run fn() unless a call for `key` is already in flight, in which case wait for its outcome."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "upstream_calls": self.executed,
+                "upstream_calls_saved": self.coalesced,
+                "in_flight": len(self._calls),
+            }
+
+
+class AsyncSingleFlight:
+    """asyncio flavour of SingleFlight; the shared call runs as a task so a cancelled caller doesn't cancel the others."""
+
+    def __init__(self):
+        self.executed = 0
+        self.coalesced = 0
+        self._tasks = {}
+
+    async def do(self, key: str, coro_fn):
+        """Await coro_fn() unless a call for `key` is already in flight, in which case await that one."""
+        task = self._tasks.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.executed += 1
+            task = self._tasks[key] = asyncio.ensure_future(coro_fn())
+            task.add_done_callback(lambda _t, k=key: self._tasks.pop(k, None))
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {
+            "upstream_calls": self.executed,
+            "upstream_calls_saved": self.coalesced,
+            "in_flight": len(self._tasks),
+        }
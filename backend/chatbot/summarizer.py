@@ -0,0 +1,169 @@
+# chatbot/summarizer.py
+"""
+Rolling summaries of long chat sessions.
+
+Once a session has GEMINI_SUMMARY_TRIGGER messages after its summary,
+everything except the newest GEMINI_SUMMARY_KEEP_RECENT messages is folded
+into ChatSession.summary. ChatSession.summary_through_id then points at the
+last folded message. Each fold sends the previous summary plus only the new
+turns, so the cost of a fold does not grow with the length of the session.
+The context assembler (chatbot/context.py) then sends the summary and the
+recent turns instead of the whole history.
+
+Folding is done by a single background thread fed from a bounded queue, so
+chatbot_reply never waits for it. A session is queued at most once at a time.
+The summary is written with a compare-and-set on summary_through_id, so a
+concurrent fold from another process cannot be overwritten by a stale one.
+
+Configuration (environment):
+  GEMINI_SUMMARY_ENABLED      0 to disable rolling summaries (default 1)
+  GEMINI_SUMMARY_TRIGGER      unsummarized messages that trigger a fold (default 24)
+  GEMINI_SUMMARY_KEEP_RECENT  newest messages kept verbatim (default 8)
+  GEMINI_SUMMARY_MAX_TOKENS   maxOutputTokens for the summary (default 400)
+"""
+import logging
+import os
+import queue
+import threading
+
+from django.db import IntegrityError, connection
+from django.utils import timezone
+
+from .models import ChatSession
+from .purge import visible_messages
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_ENABLED = os.getenv("GEMINI_SUMMARY_ENABLED", "1").lower() not in ("0", "false", "no")
+SUMMARY_TRIGGER = int(os.getenv("GEMINI_SUMMARY_TRIGGER", "24"))
+SUMMARY_KEEP_RECENT = int(os.getenv("GEMINI_SUMMARY_KEEP_RECENT", "8"))
+SUMMARY_MAX_TOKENS = int(os.getenv("GEMINI_SUMMARY_MAX_TOKENS", "400"))
+
+QUEUE_SIZE = 1000
+
+
+def build_summary_prompt(summary: str, turns: list) -> str:
+    """Prompt that folds `turns` [(sender, text)] into the existing `summary`."""
+    transcript = "\n".join(f"{'Student' if sender == 'user' else 'Tutor'}: {text}" for sender, text in turns)
+    return f"""
+You maintain a running summary of a tutoring conversation between a student and an AI tutor.
+
+Current summary:
+{summary or "(none yet)"}
+
+New turns to fold into the summary:
+{transcript}
+
+Write the updated summary. Keep the topics covered, what the student already understands or struggles with,
+open questions, and any facts or preferences the student shared. Be concise, use plain sentences,
+and do not address the student.
+
+Updated summary:
+"""
+
+
+class RollingSummarizer:
+    """
+    Background folding of old turns into ChatSession.summary.
+    `summarize(summary, turns)` returns the new summary text (it calls Gemini);
+    `on_updated(user_id, session_id)` runs after a summary was stored.
+    """
+
+    def __init__(self, summarize, on_updated=None, trigger: int = SUMMARY_TRIGGER,
+                 keep_recent: int = SUMMARY_KEEP_RECENT):
+        self.summarize = summarize
+        self.on_updated = on_updated
+        self.trigger = trigger
+        self.keep_recent = keep_recent
+        self.folds = 0
+        self.folded_messages = 0
+        self.failures = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._pending = set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def maybe_schedule(self, user_id: str, session_id: str, unsummarized: int):
+        """Queue a fold when a session has at least `trigger` messages beyond its summary."""
+        if unsummarized < self.trigger:
+            return
+        key = (user_id, session_id)
+        with self._lock:
+            if key in self._pending:
+                return
+            try:
+                self._queue.put_nowait(key)
+            except queue.Full:
+                self.dropped += 1
+                return
+            self._pending.add(key)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="chat-summarizer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            key = self._queue.get()
+            try:
+                self.fold(*key)
+            except Exception:
+                self.failures += 1
+                logger.exception(f"Summarizing session {key[1]} of user {key[0]} failed")
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                connection.close()
+
+    def _session(self, user_id: str, session_id: str) -> ChatSession:
+        try:
+            session, _ = ChatSession.objects.get_or_create(user_id=user_id, session_id=session_id)
+        except IntegrityError:
+            session = ChatSession.objects.get(user_id=user_id, session_id=session_id)
+        return session
+
+    def fold(self, user_id: str, session_id: str) -> bool:
+        """Fold everything but the newest keep_recent messages into the summary; True if a summary was stored."""
+        session = self._session(user_id, session_id)
+        through = session.summary_through_id
+        messages = visible_messages(user_id, session_id)
+        if through is not None:
+            messages = messages.filter(id__gt=through)
+        rows = list(messages.order_by('id').values_list('id', 'sender', 'text'))
+        to_fold = rows[:-self.keep_recent] if self.keep_recent else rows
+        if not to_fold:
+            return False
+
+        summary = self.summarize(session.summary, [(sender, text) for _, sender, text in to_fold])
+        # a clear while folding moves cleared_at, and this fold is then about hidden messages
+        stored = ChatSession.objects.filter(pk=session.pk, summary_through_id=through, cleared_at=session.cleared_at).update(
+            summary=summary,
+            summary_through_id=to_fold[-1][0],
+            summary_updated_at=timezone.now(),
+        )
+        if not stored:
+            logger.info(f"Summary of session {session_id} changed while folding; discarding this fold")
+            return False
+        with self._lock:
+            self.folds += 1
+            self.folded_messages += len(to_fold)
+        logger.info(f"Folded {len(to_fold)} messages into the summary of session {session_id}")
+        if self.on_updated is not None:
+            self.on_updated(user_id, session_id)
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "trigger": self.trigger,
+                "keep_recent": self.keep_recent,
+                "queued": len(self._pending),
+                "folds": self.folds,
+                "folded_messages": self.folded_messages,
+                "failures": self.failures,
+                "dropped": self.dropped,
+            }
+
+
+def build_summarizer(summarize, on_updated=None) -> RollingSummarizer | None:
+    return RollingSummarizer(summarize, on_updated) if SUMMARY_ENABLED else None
@@ -1,3 +1,176 @@
-from django.test import TestCase
+from types import SimpleNamespace
+from unittest import skipIf
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from benchmarks.stub_gemini import start_in_thread
+
+from .context import ContextAssembler
+from .gemini_client import GeminiClient
+from .prompts import ContextCacheManager, PromptTemplate, call_with_prompt, start_stream
+from .semantic_cache import SemanticCache, np
+
+FLASH = "models/gemini-stub-flash"
+PRO = "models/gemini-stub-pro"
+LONG_TEMPLATE = PromptTemplate("long", "Explain every answer step by step. " * 200)
+
+
+class ContextCacheTests(SimpleTestCase):
+    """ContextCacheManager against the local Gemini stand-in."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = start_in_thread(delay=0.0)
+        cls.gemini = GeminiClient("test-key", base_url=cls.stub.base_url)
+
+    def setUp(self):
+        self.stub.cached_contents.clear()
+        supported = {FLASH}
+        self.cache = ContextCacheManager(lambda: self.gemini, supports=lambda m: m in supported,
+                                         ttl=600, renew_margin=60, min_tokens=100)
+
+    def generate(self, model_id, template=LONG_TEMPLATE):
+        payload = {"contents": [{"role": "user", "parts": [{"text": "What is a prime?"}]}]}
+        sent = []
+
+        def send(fields):
+            sent.append(fields)
+            return self.gemini.generate_content(model_id, dict(payload, **fields))
+
+        return call_with_prompt(self.cache, model_id, template, send), sent
+
+    def test_creates_cache_once_and_reuses_it(self):
+        _, first = self.generate(FLASH)
+        _, second = self.generate(FLASH)
+        self.assertEqual(len(self.stub.cached_contents), 1)
+        name = next(iter(self.stub.cached_contents))
+        self.assertEqual(first, [{"cachedContent": name}])
+        self.assertEqual(second, [{"cachedContent": name}])
+        self.assertEqual(self.cache.stats()["created"], 1)
+
+    def test_renews_ttl_near_expiry(self):
+        key = (FLASH, LONG_TEMPLATE.version)
+        self.cache.resolve(FLASH, LONG_TEMPLATE)
+        name, expires_at = self.cache._entries[key]
+        # 20 s left: inside the 60 s renew margin
+        self.cache._entries[key] = (name, expires_at - 580)
+        self.stub.cached_contents[name]["expire_at"] -= 580
+        self.assertEqual(self.cache.resolve(FLASH, LONG_TEMPLATE), name)
+        self.assertEqual(self.cache.renewed, 1)
+        self.assertEqual(self.cache.created, 1)
+        self.assertGreater(self.cache.stats()["active"][f"{FLASH}:{LONG_TEMPLATE.version}"], 500)
+        self.assertTrue(self.stub._cache_alive(name))
+
+    def test_falls_back_inline_when_cache_expired_upstream(self):
+        self.generate(FLASH)
+        name = next(iter(self.stub.cached_contents))
+        self.stub.cached_contents[name]["expire_at"] = 0
+        resp, sent = self.generate(FLASH)
+        self.assertIn("candidates", resp)
+        self.assertEqual(sent[0], {"cachedContent": name})
+        self.assertIn("systemInstruction", sent[1])
+        self.assertEqual(self.cache.fallbacks, 1)
+        # the next request registers a fresh cache
+        _, sent = self.generate(FLASH)
+        self.assertNotEqual(sent, [{"cachedContent": name}])
+        self.assertIn("cachedContent", sent[0])
+
+    def test_stream_falls_back_inline_when_cache_expired_upstream(self):
+        name = self.cache.resolve(FLASH, LONG_TEMPLATE)
+        self.stub.cached_contents[name]["expire_at"] = 0
+        payload = {"contents": [{"role": "user", "parts": [{"text": "hi"}]}]}
+        chunks = call_with_prompt(
+            self.cache, FLASH, LONG_TEMPLATE,
+            lambda fields: start_stream(self.gemini.stream_generate_content(FLASH, dict(payload, **fields))),
+        )
+        self.assertEqual(len(list(chunks)), 4)
+        self.assertEqual(self.cache.fallbacks, 1)
+
+    def test_unsupported_model_sends_instructions_inline(self):
+        _, sent = self.generate(PRO)
+        self.assertEqual(sent, [{"systemInstruction": LONG_TEMPLATE.system_instruction_content()}])
+        self.assertEqual(self.stub.cached_contents, {})
+
+    def test_short_template_is_not_cached(self):
+        short = PromptTemplate("short", "Be brief.")
+        _, sent = self.generate(FLASH, short)
+        self.assertEqual(sent, [{"systemInstruction": short.system_instruction_content()}])
+        self.assertEqual(self.stub.cached_contents, {})
+
+    def test_template_version_tracks_instructions(self):
+        self.assertNotEqual(PromptTemplate("t", "a").version, PromptTemplate("t", "b").version)
+        self.assertEqual(PromptTemplate("t", "a").version, PromptTemplate("t", "a").version)
+
+
+@skipIf(np is None, "NumPy is not installed")
+class SemanticCacheTests(SimpleTestCase):
+    """Near-duplicate lookups must not cross questions that differ in substance."""
+
+    def setUp(self):
+        self.cache = SemanticCache()
+
+    def assertNotShared(self, stored, asked):
+        self.cache.set("m", stored, stored)
+        self.assertIsNone(self.cache.get("m", asked))
+
+    def test_paraphrase_hits(self):
+        self.cache.set("m", "What is photosynthesis?", "answer")
+        self.assertEqual(self.cache.get("m", "explain photosynthesis"), "answer")
+
+    def test_operators_must_match(self):
+        self.assertNotShared("solve 2x + 3 = 7", "solve 2x - 3 = 7")
+        self.assertNotShared("What is 3+2?", "What is 3*2?")
+        self.assertNotShared("x^2 + 1 = 0", "x^2 - 1 = 0")
+
+    def test_numbers_must_match(self):
+        self.assertNotShared("What is 3+2?", "What is 3+4?")
+
+    def test_question_word_must_match(self):
+        self.assertNotShared("When did World War 2 end?", "Why did World War 2 end?")
+
+
+class ContextAssemblerTests(SimpleTestCase):
+    """The in-process window must notice messages another worker wrote to the session."""
+
+    def setUp(self):
+        self.rows = []  # (id, sender, text): the session's messages in the database
+        self.context = ContextAssembler(
+            lambda user_id, session_id, limit: ('', [(sender, text) for _, sender, text in self.rows[-limit:]]),
+            lambda user_id, session_id: self.rows[-1][0] if self.rows else None,
+        )
+
+    def write(self, sender, text):
+        message = SimpleNamespace(id=len(self.rows) + 1)
+        self.rows.append((message.id, sender, text))
+        return message
+
+    def texts(self):
+        history, _ = self.context.build_contents("u", "s", "next", 10000)
+        return [part["text"] for turn in history for part in turn["parts"]]
+
+    def test_reloads_after_write_outside_the_assembler(self):
+        self.write("user", "q1")
+        self.write("ai", "a1")
+        self.assertEqual(self.texts(), ["q1", "a1"])
+        self.write("user", "q2")  # served by another worker
+        self.write("ai", "a2")
+        self.assertEqual(self.texts(), ["q1", "a1", "q2", "a2"])
+        self.assertEqual(self.context.stats()["stale_reloads"], 1)
+
+    def test_own_writes_do_not_reload(self):
+        self.write("user", "q1")
+        self.texts()
+        self.context.append("u", "s", "ai", "a1", self.write("ai", "a1"))
+        self.assertEqual(self.texts(), ["q1", "a1"])
+        self.assertEqual(self.context.stats()["db_backfills"], 1)
+
+    def test_queued_write_counts_once_it_lands(self):
+        self.write("user", "q1")
+        self.texts()
+        queued = SimpleNamespace(id=None)
+        self.context.append("u", "s", "ai", "a1", queued)
+        self.assertEqual(self.texts(), ["q1", "a1"])
+        queued.id = self.write("ai", "a1").id  # the write-behind batch is written
+        self.assertEqual(self.texts(), ["q1", "a1"])
+        self.assertEqual(self.context.stats()["stale_reloads"], 0)
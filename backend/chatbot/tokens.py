@@ -0,0 +1,207 @@
+# chatbot/tokens.py
+"""
+Local token estimation, calibrated against Gemini's usageMetadata.
+
+Calling countTokens before every generation would add a round trip, so token
+counts are estimated locally. A text's raw size is its character count / 4,
+plus 3/8 of a token for every extra UTF-8 byte. English runs about four
+characters per token, while CJK text tokenizes at roughly one token per
+character, and a three-byte character comes out at exactly one. Both terms
+are computed in C (len and str.encode), so an estimate costs about a
+microsecond per KB or less (benchmarks/bench_token_estimator.py).
+
+The raw size is then multiplied by a per-model ratio learned from traffic.
+Every generateContent reply carries usageMetadata. observe() compares
+promptTokenCount with the raw size of what was sent, and candidatesTokenCount
+with the raw size of the reply text. Each ratio is an EWMA, so drift in the
+tokenizer or the traffic mix is followed without keeping samples. Estimates
+for a model with no observations yet use the pooled ratio over all models.
+
+The same observations are tallied per model for cost accounting. Prices come
+from GEMINI_TOKEN_PRICES and are USD per million input:output tokens, e.g.
+"gemini-2.5-flash=0.30:2.50,gemini-2.5-pro=1.25:10".
+
+Configuration (environment):
+  GEMINI_TOKEN_CALIBRATION  0 to keep the uncalibrated estimate (default 1)
+  GEMINI_TOKEN_EWMA_ALPHA   weight of each new observation (default 0.05)
+  GEMINI_TOKEN_PRICES       per-model USD per 1M input:output tokens (default none)
+"""
+import logging
+import os
+import threading
+
+from .gemini_client import clean_model_id
+
+logger = logging.getLogger(__name__)
+
+TOKEN_CALIBRATION = os.getenv("GEMINI_TOKEN_CALIBRATION", "1").lower() not in ("0", "false", "no")
+TOKEN_EWMA_ALPHA = float(os.getenv("GEMINI_TOKEN_EWMA_ALPHA", "0.05"))
+TOKEN_PRICES = os.getenv("GEMINI_TOKEN_PRICES", "")
+
+CHARS_PER_TOKEN = 4
+TOKENS_PER_EXTRA_BYTE = 0.375
+MIN_RATIO, MAX_RATIO = 0.25, 4.0
+MIN_SAMPLE_UNITS = 8  # tiny texts are dominated by per-turn overhead and say little about the ratio
+
+
+def raw_units(text: str) -> float:
+    """Uncalibrated token estimate of `text`."""
+    chars = len(text)
+    extra = len(text.encode("utf-8")) - chars
+    return chars / CHARS_PER_TOKEN + extra * TOKENS_PER_EXTRA_BYTE
+
+
+def contents_units(contents: list, system_texts: tuple = ()) -> float:
+    """Raw size of a generateContent `contents` array plus any system instruction texts."""
+    units = sum(raw_units(part.get("text", "")) for turn in contents for part in turn.get("parts", ()))
+    return units + sum(raw_units(text) for text in system_texts)
+
+
+def reply_text(resp_json: dict) -> str:
+    try:
+        return "".join(part.get("text", "") for part in resp_json["candidates"][0]["content"]["parts"])
+    except (KeyError, IndexError, TypeError):
+        return ""
+
+
+def parse_prices(spec: str) -> dict:
+    """'model=in:out,...' -> {model: (usd per 1M input tokens, usd per 1M output tokens)}."""
+    prices = {}
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        try:
+            model, rates = item.split("=", 1)
+            prompt_rate, output_rate = rates.split(":", 1)
+            prices[clean_model_id(model.strip())] = (float(prompt_rate), float(output_rate))
+        except ValueError:
+            logger.warning(f"Ignoring malformed GEMINI_TOKEN_PRICES entry {item!r}")
+    return prices
+
+
+class _Ratio:
+    __slots__ = ("value", "samples", "abs_error")
+
+    def __init__(self):
+        self.value = 1.0
+        self.samples = 0
+        self.abs_error = 0.0  # EWMA of |estimate - actual| / actual, measured before each update
+
+    def update(self, actual: int, units: float, alpha: float):
+        estimate = units * self.value
+        error = abs(estimate - actual) / actual
+        observed = min(MAX_RATIO, max(MIN_RATIO, actual / units))
+        if self.samples == 0:
+            self.value, self.abs_error = observed, error
+        else:
+            self.value += alpha * (observed - self.value)
+            self.abs_error += alpha * (error - self.abs_error)
+        self.samples += 1
+
+
+class _Usage:
+    __slots__ = ("requests", "prompt_tokens", "output_tokens", "cached_tokens")
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.cached_tokens = 0
+
+
+class TokenEstimator:
+    """Per-model prompt and output ratios learned from usageMetadata, plus per-model usage totals."""
+
+    def __init__(self, calibrate: bool = TOKEN_CALIBRATION, alpha: float = TOKEN_EWMA_ALPHA,
+                 prices: dict | None = None):
+        self.calibrate = calibrate
+        self.alpha = alpha
+        self.prices = parse_prices(TOKEN_PRICES) if prices is None else prices
+        self._prompt = {None: _Ratio()}  # model id -> _Ratio; None pools every model
+        self._output = {None: _Ratio()}
+        self._usage = {}
+        self._lock = threading.Lock()
+
+    def _ratio(self, table: dict, model_id: str | None) -> float:
+        if not self.calibrate:
+            return 1.0
+        ratio = table.get(clean_model_id(model_id) if model_id else None)
+        if ratio is None or ratio.samples == 0:
+            ratio = table[None]
+        return ratio.value if ratio.samples else 1.0
+
+    def estimate(self, text: str, model_id: str | None = None) -> int:
+        """Estimated prompt tokens for `text` on `model_id` (pooled calibration when None or unseen)."""
+        return int(raw_units(text) * self._ratio(self._prompt, model_id)) + 1
+
+    def estimate_contents(self, contents: list, model_id: str | None = None, system_texts: tuple = ()) -> int:
+        return int(contents_units(contents, system_texts) * self._ratio(self._prompt, model_id)) + 1
+
+    def estimate_output(self, text: str, model_id: str | None = None) -> int:
+        return int(raw_units(text) * self._ratio(self._output, model_id)) + 1
+
+    def observe(self, model_id: str, prompt_units: float, resp_json: dict):
+        """Calibrate against a generateContent reply; `prompt_units` is contents_units() of what was sent."""
+        if isinstance(resp_json, dict):
+            self.observe_usage(model_id, prompt_units, resp_json.get("usageMetadata"), reply_text(resp_json))
+
+    def observe_usage(self, model_id: str, prompt_units: float, usage: dict | None, reply: str):
+        """Same as observe() for a streamed reply: its final usageMetadata and the concatenated text."""
+        if not isinstance(usage, dict):
+            return
+        model = clean_model_id(model_id)
+        prompt_tokens = usage.get("promptTokenCount") or 0
+        output_tokens = usage.get("candidatesTokenCount") or 0
+        output_units = raw_units(reply) if output_tokens else 0.0
+        with self._lock:
+            totals = self._usage.setdefault(model, _Usage())
+            totals.requests += 1
+            totals.prompt_tokens += prompt_tokens
+            totals.output_tokens += output_tokens
+            totals.cached_tokens += usage.get("cachedContentTokenCount") or 0
+            for table, actual, units in ((self._prompt, prompt_tokens, prompt_units),
+                                         (self._output, output_tokens, output_units)):
+                if actual and units >= MIN_SAMPLE_UNITS:
+                    table.setdefault(model, _Ratio()).update(actual, units, self.alpha)
+                    table[None].update(actual, units, self.alpha)
+
+    def cost_usd(self, model_id: str, prompt_tokens: int, output_tokens: int) -> float | None:
+        rates = self.prices.get(clean_model_id(model_id))
+        if rates is None:
+            return None
+        return (prompt_tokens * rates[0] + output_tokens * rates[1]) / 1_000_000
+
+    def stats(self) -> dict:
+        def ratios(table):
+            return {model or "all": {"ratio": round(r.value, 3), "samples": r.samples,
+                                     "mean_abs_error": round(r.abs_error, 3)}
+                    for model, r in table.items() if r.samples}
+
+        with self._lock:
+            usage = {}
+            for model, totals in self._usage.items():
+                usage[model] = {
+                    "requests": totals.requests,
+                    "prompt_tokens": totals.prompt_tokens,
+                    "output_tokens": totals.output_tokens,
+                    "cached_tokens": totals.cached_tokens,
+                    "cost_usd": self.cost_usd(model, totals.prompt_tokens, totals.output_tokens),
+                }
+            return {
+                "calibrated": self.calibrate,
+                "prompt_ratio": ratios(self._prompt),
+                "output_ratio": ratios(self._output),
+                "usage": usage,
+            }
+
+
+# Process-wide estimator shared by context trimming, rate limiting and the prompt cache
+TOKENS = TokenEstimator()
+
+
+def estimate_tokens(text: str, model_id: str | None = None) -> int:
+    return TOKENS.estimate(text, model_id)
+
+
+def usage_tokens(resp_json: dict) -> int | None:
+    """usageMetadata.totalTokenCount of a generateContent reply, if present."""
+    usage = resp_json.get("usageMetadata") if isinstance(resp_json, dict) else None
+    return usage.get("totalTokenCount") if isinstance(usage, dict) else None
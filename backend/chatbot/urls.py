@@ -1,11 +1,15 @@
 # chatbot/urls.py
 from django.urls import path
-from .views import chatbot_reply, health_check, get_chat_history, clear_chat, get_sessions
+from .views import chatbot_reply, chatbot_stream, health_check, get_chat_history, search_chat_history, export_chat_history, clear_chat, clear_all_chats, get_sessions
 
 urlpatterns = [
     path('chat/', chatbot_reply, name='chatbot_reply'),
+    path('chat/stream/', chatbot_stream, name='chatbot_stream'),
     path('health/', health_check, name='health_check'),
     path('history/', get_chat_history, name='get_chat_history'),
+    path('history/search/', search_chat_history, name='search_chat_history'),
+    path('history/export/', export_chat_history, name='export_chat_history'),
     path('clear/', clear_chat, name='clear_chat'),
+    path('clear/all/', clear_all_chats, name='clear_all_chats'),
     path('sessions/', get_sessions, name='get_sessions'),
 ]
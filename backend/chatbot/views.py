@@ -182,7 +182,7 @@
 
 # @csrf_exempt
 # def clear_chat(request):
-#     """Clear chat messages for a specific user and session"""
+#     """Clear a user's session: its messages disappear at once and are deleted in the background"""
 #     if request.method == 'POST':
 #         try:
 #             data = json.loads(request.body)
@@ -262,16 +262,40 @@
 
 
 # chatbot/views.py
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.db import connection
 from django.db.utils import OperationalError
 from dotenv import load_dotenv
 import os
 import json
+import time
 import requests
 import logging
 from .models import ChatMessage, ChatSession
+from .gemini_client import extract_chunk_text, format_sse, get_client
+from .response_cache import build_response_cache, is_cacheable, make_cache_key
+from .semantic_cache import build_semantic_cache
+from .singleflight import SingleFlight
+from .failover import FAILOVER_DEPTH, FailoverChain, NoHealthyModelError
+from .router import build_router
+from .hedging import Hedger, build_hedger
+from .rate_limit import RateLimitExceeded, build_rate_limiter
+from .tokens import TOKENS, contents_units, usage_tokens
+from .scheduler import BACKGROUND, INTERACTIVE, PROBE, OverloadedError, build_scheduler
+from .context import build_context_assembler, token_budget
+from .summarizer import SUMMARY_MAX_TOKENS, build_summarizer, build_summary_prompt
+from .prompts import TUTOR_PROMPT, PromptTemplate, build_context_cache, call_with_prompt, start_stream
+from .retry import Deadline, RetryPolicy, RetryStats, call_with_retry
+from .model_catalog import CatalogRefresher, ModelCatalog
+from .db_health import build_db_health
+from .history import InvalidCursor, message_page, parse_limit
+from .sessions import clear_session, clear_user, record_message, record_messages, session_page, session_version
+from .history_cache import build_history_cache
+from .purge import build_purger, visible_messages
+from .write_behind import WRITE_BEHIND_SETTLE_TIMEOUT, build_write_behind
+from .export import FORMATS, InvalidExportRequest, export_chunks, export_rows, parse_bound
+from .search import InvalidSearch, SearchUnavailable, parse_paging, search_messages
 from django.utils import timezone
 
 # Load environment variables
@@ -282,7 +306,6 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Config
-GOOGLE_BASE = "https://generativelanguage.googleapis.com/v1beta"
 API_KEY = os.getenv("GOOGLE_API_KEY")
 FALLBACK_MODEL = os.getenv("FALLBACK_MODEL", "")  # e.g. "gemini-2.5-flash"
 
@@ -292,9 +315,36 @@ if not API_KEY:
 # Globals populated at import/startup
 SELECTED_MODEL_ID = None
 AVAILABLE_MODELS = []
+# Ranked models with a circuit breaker each; the latency router reorders them per request
+MODEL_ROUTER = build_router()
+MODEL_CHAIN = FailoverChain(router=MODEL_ROUTER)
+# Backoff/deadline policy applied around the failover chain
+RETRY_POLICY = RetryPolicy()
+RETRY_STATS = RetryStats()
+# Opt-in hedging of slow generateContent calls (None unless GEMINI_HEDGING=1)
+HEDGER = build_hedger(MODEL_ROUTER, MODEL_CHAIN)
+
+# Exact-match generateContent cache (None when GEMINI_CACHE_BACKEND=off)
+RESPONSE_CACHE = build_response_cache()
+# Near-duplicate prompt cache (None unless GEMINI_SEMANTIC_CACHE=1)
+SEMANTIC_CACHE = build_semantic_cache()
+# Coalesces concurrent identical generateContent requests
+GENERATION_FLIGHT = SingleFlight()
+# Global + per-user RPM/TPM buckets in front of Gemini (None when GEMINI_RATE_LIMIT_BACKEND=off)
+RATE_LIMITER = build_rate_limiter()
+# Bounded, prioritised admission of upstream calls (None when GEMINI_SCHEDULER=0)
+SCHEDULER = build_scheduler()
+# Cached DB up/down status from real queries plus a background probe (None when GEMINI_DB_HEALTH=0)
+DB_HEALTH = build_db_health()
+# Serialized history pages keyed by ChatSession.version (None when GEMINI_HISTORY_CACHE=0)
+HISTORY_CACHE = build_history_cache()
+# Rate-limited background deletion of cleared messages (None when GEMINI_PURGE=0)
+PURGER = build_purger()
+# Batched background persistence of chat messages (None unless GEMINI_WRITE_BEHIND=1)
+WRITE_BEHIND = build_write_behind(record_messages, on_error=lambda exc: note_db_error(exc))
 
 def check_database_connection():
-    """Check if database is connected and accessible"""
+    """Check if database is connected and accessible (a live SELECT 1; views use DB_HEALTH instead)"""
     try:
         with connection.cursor() as cursor:
             cursor.execute("SELECT 1")
@@ -305,21 +355,17 @@ def check_database_connection():
         return False, f"Unexpected database error: {str(e)}"
 
 def list_models(api_key: str):
-    """Call ListModels and return models list (or empty)."""
-    url = f"{GOOGLE_BASE}/models?key={api_key}"
-    resp = requests.get(url, timeout=15)
-    resp.raise_for_status()
-    data = resp.json()
-    return data.get("models", [])
+    """Call ListModels through the pooled client and return models list (or empty)."""
+    return get_client(api_key).list_models()
 
-def choose_model(models: list):
+def rank_models(models: list) -> list:
     """
     Improved model selection with better heuristics:
       - prefer models containing 'gemini'
       - prefer ones that list 'generateContent' in supported methods
       - prefer 'flash'/'pro' and specific versions (001, latest)
       - avoid experimental models unless no other option
-    Returns model identifier (string) or None.
+    Returns model identifiers ordered best first (empty list if none).
     """
     candidates = []
     for m in models:
@@ -358,60 +404,91 @@ def choose_model(models: list):
         candidates.append((score, name, supports_generate, is_experimental))
     
     if not candidates:
-        return None
+        return []
         
     # Sort by score (descending), prefer non-experimental
     candidates.sort(reverse=True, key=lambda t: (t[0], not t[3]))
     
     # Log the top candidates for debugging
     logger.info(f"Top model candidates: {candidates[:3]}")
-    
-    return candidates[0][1]
 
-def startup_select_model():
-    """Populate SELECTED_MODEL_ID and AVAILABLE_MODELS on import/startup."""
+    # Only models that can generate belong in the failover chain (when we can tell)
+    if any(c[2] for c in candidates):
+        candidates = [c for c in candidates if c[2]]
+    return [c[1] for c in candidates]
+
+def choose_model(models: list):
+    """Return the best-ranked model identifier (string) or None."""
+    ranked = rank_models(models)
+    return ranked[0] if ranked else None
+
+def apply_model_catalog(models: list):
+    """Set AVAILABLE_MODELS, the failover chain and SELECTED_MODEL_ID from a ListModels result."""
     global SELECTED_MODEL_ID, AVAILABLE_MODELS
-    try:
-        logger.info("Listing available models from Google Generative API...")
-        models = list_models(API_KEY)
-        AVAILABLE_MODELS = models
-        logger.info(f"Found {len(models)} models.")
-        chosen = choose_model(models)
-        if chosen:
-            SELECTED_MODEL_ID = chosen
-            logger.info(f"Selected model: {SELECTED_MODEL_ID}")
-        elif FALLBACK_MODEL:
-            SELECTED_MODEL_ID = FALLBACK_MODEL
-            logger.warning(f"No suitable model chosen from ListModels; using FALLBACK_MODEL: {SELECTED_MODEL_ID}")
-        else:
-            SELECTED_MODEL_ID = None
-            logger.warning("No model selected. Set FALLBACK_MODEL or ensure models list contains usable models.")
-    except Exception as e:
-        logger.exception("Failed to list/select models on startup.")
-        if FALLBACK_MODEL:
-            SELECTED_MODEL_ID = FALLBACK_MODEL
-            logger.info(f"Using FALLBACK_MODEL due to list failure: {SELECTED_MODEL_ID}")
-        else:
-            SELECTED_MODEL_ID = None
+    AVAILABLE_MODELS = models
+    logger.info(f"Found {len(models)} models.")
+    ranked = rank_models(models)
+    MODEL_CHAIN.set_models(ranked[:FAILOVER_DEPTH] + [FALLBACK_MODEL])
+    chosen = ranked[0] if ranked else None
+    if chosen:
+        SELECTED_MODEL_ID = chosen
+        logger.info(f"Selected model: {SELECTED_MODEL_ID}")
+    elif FALLBACK_MODEL:
+        SELECTED_MODEL_ID = FALLBACK_MODEL
+        logger.warning(f"No suitable model chosen from ListModels; using FALLBACK_MODEL: {SELECTED_MODEL_ID}")
+    else:
+        SELECTED_MODEL_ID = None
+        logger.warning("No model selected. Set FALLBACK_MODEL or ensure models list contains usable models.")
+
+# Shared on-disk ListModels snapshot, refreshed in the background once older than its TTL
+MODEL_CATALOG = ModelCatalog()
+CATALOG_REFRESHER = CatalogRefresher(
+    MODEL_CATALOG,
+    fetch_models=lambda: run_upstream(PROBE, lambda: list_models(API_KEY)),
+    choose=choose_model,
+    on_update=lambda snapshot: apply_model_catalog(snapshot["models"]),
+)
+
+def startup_select_model():
+    """
+    Populate SELECTED_MODEL_ID and AVAILABLE_MODELS on import/startup from the shared
+    catalog snapshot (no network), then keep it current from a background thread.
+    """
+    global SELECTED_MODEL_ID
+    snapshot = MODEL_CATALOG.load()
+    if snapshot:
+        logger.info(f"Loaded model catalog snapshot from {MODEL_CATALOG.path}")
+        CATALOG_REFRESHER.apply(snapshot)
+    else:
+        logger.info("No model catalog snapshot yet; it will be fetched in the background.")
+        MODEL_CHAIN.set_models([FALLBACK_MODEL])
+        SELECTED_MODEL_ID = FALLBACK_MODEL or None
+    # pre-warming and ListModels both happen off the import path
+    CATALOG_REFRESHER.start(before_first_check=get_client(API_KEY).warm)
 
 # run selection at import time (Django will import this module at startup)
 startup_select_model()
 
-def generate_with_gemini_rest(prompt: str, max_tokens: int = 512):
-    """Call :generateContent REST endpoint and return JSON."""
-    if not SELECTED_MODEL_ID:
-        raise RuntimeError("No SELECTED_MODEL_ID available. Check logs or set FALLBACK_MODEL.")
-    model_id = SELECTED_MODEL_ID
-    
-    # Clean model ID - remove 'models/' prefix if present
-    if model_id.startswith('models/'):
-        model_id = model_id[7:]  # Remove 'models/' prefix
-    
-    # Build endpoint with corrected payload format
-    url = f"{GOOGLE_BASE}/models/{model_id}:generateContent?key={API_KEY}"
-    payload = {
-        "contents": [
+def build_structured_prompt(prompt: str) -> str:
+    """The student's turn; the tutor formatting instructions travel separately as TUTOR_PROMPT."""
+    return TUTOR_PROMPT.render(question=prompt)
+
+def supports_context_cache(model_id: str) -> bool:
+    """True if ListModels reports that `model_id` accepts explicit cachedContents."""
+    for m in AVAILABLE_MODELS:
+        if m.get("name") == model_id:
+            return "createCachedContent" in (m.get("supportedGenerationMethods") or [])
+    return False
+
+# cachedContents entries for static prompt templates (None when GEMINI_PROMPT_CACHE=0)
+PROMPT_CACHE = build_context_cache(lambda: get_client(API_KEY), supports=supports_context_cache)
+
+def build_generate_payload(prompt: str, max_tokens: int = 512, contents: list | None = None) -> dict:
+    """Request body shared by :generateContent and :streamGenerateContent; `contents` carries prior turns."""
+    return {
+        "contents": contents or [
             {
+                "role": "user",
                 "parts": [
                     {"text": prompt}
                 ]
@@ -422,10 +499,190 @@ def generate_with_gemini_rest(prompt: str, max_tokens: int = 512):
             "temperature": 0.7
         }
     }
-    headers = {"Content-Type": "application/json"}
-    resp = requests.post(url, json=payload, headers=headers, timeout=30)
-    resp.raise_for_status()
-    return resp.json()
+
+def generate_with_gemini_rest(prompt: str, max_tokens: int = 512, model_id: str | None = None, timeout: float = 30,
+                              contents: list | None = None, template: PromptTemplate | None = None):
+    """Call :generateContent REST endpoint and return JSON; `template` supplies the system instructions."""
+    model_id = model_id or SELECTED_MODEL_ID
+    if not model_id:
+        raise RuntimeError("No SELECTED_MODEL_ID available. Check logs or set FALLBACK_MODEL.")
+    payload = build_generate_payload(prompt, max_tokens, contents)
+    client = get_client(API_KEY)
+    if template is None:
+        resp_json = client.generate_content(model_id, payload, timeout=timeout)
+    else:
+        resp_json = call_with_prompt(
+            PROMPT_CACHE, model_id, template,
+            lambda fields: client.generate_content(model_id, dict(payload, **fields), timeout=timeout),
+        )
+    TOKENS.observe(model_id, prompt_units(payload, template), resp_json)
+    return resp_json
+
+def prompt_units(payload: dict, template: PromptTemplate | None) -> float:
+    """Raw token size of a request, counting the template's instructions whether inline or cached."""
+    return contents_units(payload["contents"], (template.system_instruction,) if template else ())
+
+def estimate_request_tokens(contents: list, template: PromptTemplate | None = None, max_tokens: int = 512) -> int:
+    """Calibrated prompt estimate plus the output allowance, for rate-limit reservations."""
+    system_texts = (template.system_instruction,) if template else ()
+    return TOKENS.estimate_contents(contents, SELECTED_MODEL_ID, system_texts) + max_tokens
+
+def run_upstream(priority: str, fn):
+    """Run an upstream Gemini call in a scheduler slot of the given priority class."""
+    return SCHEDULER.run(priority, fn) if SCHEDULER else fn()
+
+def generate_with_failover(prompt: str, max_tokens: int = 512, contents: list | None = None,
+                           template: PromptTemplate | None = None, priority: str = INTERACTIVE):
+    """
+    Generate on the first healthy model of the ranked chain; returns (model_id, resp_json).
+    If every model fails transiently, the whole chain is retried with backoff within one deadline.
+    Each pass over the chain takes its own scheduler slot, so backoff sleeps do not hold one.
+    """
+    deadline = Deadline(RETRY_POLICY.deadline)
+
+    def attempt(model_id):
+        if HEDGER is None:
+            return model_id, generate_with_gemini_rest(
+                prompt, max_tokens, model_id=model_id, timeout=deadline.timeout(30), contents=contents, template=template
+            )
+        return HEDGER.call(
+            lambda m: generate_with_gemini_rest(
+                prompt, max_tokens, model_id=m, timeout=deadline.timeout(30), contents=contents, template=template
+            ),
+            model_id,
+        )
+
+    _, (served_model, resp_json) = call_with_retry(
+        lambda: run_upstream(priority, lambda: MODEL_CHAIN.call(attempt, served=Hedger.served)), RETRY_POLICY, RETRY_STATS, deadline=deadline
+    )
+    return served_model, resp_json
+
+def generate_coalesced(cache_key: str, reservation, generate) -> tuple:
+    """
+    generate() through GENERATION_FLIGHT, so identical requests in flight share one upstream call, billed once:
+    the caller that ran the call settles its reservation (refunding the tokens if it failed), the others refund theirs.
+    """
+    led = False
+
+    def lead():
+        nonlocal led
+        led = True
+        return generate()
+
+    try:
+        result = GENERATION_FLIGHT.do(cache_key, lead)
+    except BaseException:
+        if reservation:
+            RATE_LIMITER.refund(reservation, request=not led)
+        raise
+    if reservation:
+        if led:
+            RATE_LIMITER.settle(reservation, usage_tokens(result[1]))
+        else:
+            RATE_LIMITER.refund(reservation)
+    return result
+
+def stream_with_gemini_rest(prompt: str, max_tokens: int = 512, contents: list | None = None,
+                            template: PromptTemplate | None = None, reservation=None) -> tuple:
+    """
+    Start :streamGenerateContent (SSE) on the first healthy model of the chain; returns (model_id, text deltas).
+    Models that fail before the first chunk are skipped; the stream's outcome goes to that model's breaker.
+    A rate-limit `reservation` is settled with the final chunk's usage, or its tokens refunded if the stream fails.
+    """
+    payload = build_generate_payload(prompt, max_tokens, contents)
+    client = get_client(API_KEY)
+
+    def start(model_id):
+        # the first chunk is read eagerly so a failing model raises here, and an expired cachedContent can still
+        # fall back to inline instructions
+        if template is None:
+            return start_stream(client.stream_generate_content(model_id, payload, timeout=30))
+        return call_with_prompt(
+            PROMPT_CACHE, model_id, template,
+            lambda fields: start_stream(client.stream_generate_content(model_id, dict(payload, **fields), timeout=30)),
+        )
+
+    try:
+        model_id, chunks = MODEL_CHAIN.open_stream(start)
+    except Exception:
+        if reservation:
+            RATE_LIMITER.refund(reservation, request=False)
+        raise
+
+    def deltas():
+        usage, pieces = None, []
+        try:
+            for chunk in chunks:
+                usage = chunk.get("usageMetadata", usage)
+                text = extract_chunk_text(chunk)
+                if text:
+                    pieces.append(text)
+                    yield text
+        except Exception:
+            if reservation:
+                RATE_LIMITER.refund(reservation, request=False)
+            raise
+        TOKENS.observe_usage(model_id, prompt_units(payload, template), usage, "".join(pieces))
+        if reservation:
+            RATE_LIMITER.settle(reservation, usage_tokens({"usageMetadata": usage}))
+
+    return model_id, deltas()
+
+def load_chat_history(user_id: str, session_id: str, limit: int) -> tuple:
+    """Return (summary, rows): the rolling summary and the newest `limit` messages after it as (sender, text)."""
+    session = ChatSession.objects.filter(
+        user_id=user_id,
+        session_id=session_id
+    ).values_list('summary', 'summary_through_id', 'cleared_at').first()
+    summary, through, cleared_at = session or ('', None, None)
+    messages = ChatMessage.objects.filter(user_id=user_id, session_id=session_id)
+    if cleared_at is not None:
+        messages = messages.filter(timestamp__gt=cleared_at)
+    if through is not None:
+        messages = messages.filter(id__gt=through)
+    rows = messages.order_by('-timestamp', '-id').values_list('sender', 'text')[:limit]
+    return summary, list(reversed(rows))
+
+def latest_message_id(user_id: str, session_id: str) -> int | None:
+    """Id of a session's newest visible message; one seek on chat_msg_session_ts_idx."""
+    return visible_messages(user_id, session_id).order_by('-timestamp', '-id').values_list('id', flat=True).first()
+
+# Per-session window of recent turns, backfilled from ChatMessage on a miss or when another worker wrote to the
+# session (None when GEMINI_CONTEXT_ENABLED=0)
+CONTEXT = build_context_assembler(load_chat_history, latest_message_id)
+
+def context_budget() -> int:
+    """Token budget for history, from the smallest inputTokenLimit among the models a request may reach."""
+    limits = {m.get("name"): m.get("inputTokenLimit") for m in AVAILABLE_MODELS}
+    known = [limits[m] for m in MODEL_CHAIN.models if limits.get(m)]
+    return token_budget(min(known) if known else None)
+
+def assemble_contents(user_id: str, session_id: str, structured_prompt: str) -> tuple:
+    """Return (history, contents) for the next turn; history is empty on a session's first turn."""
+    if not CONTEXT:
+        return [], build_generate_payload(structured_prompt)["contents"]
+    try:
+        return CONTEXT.build_contents(user_id, session_id, structured_prompt, context_budget())
+    except Exception as e:
+        logger.warning(f"Failed to load conversation context: {e}")
+        return [], build_generate_payload(structured_prompt)["contents"]
+
+def summarize_turns(summary: str, turns: list) -> str:
+    """Fold `turns` into `summary` with a background-priority generation call."""
+    prompt = build_summary_prompt(summary, turns)
+    _, resp_json = generate_with_failover(prompt, max_tokens=SUMMARY_MAX_TOKENS, priority=BACKGROUND)
+    if not is_cacheable(resp_json):
+        raise RuntimeError(f"Summary generation returned no candidate: {resp_json}")
+    return extract_text_from_response(resp_json).strip()
+
+# Folds old turns into ChatSession.summary off the request path (None when disabled or without context)
+SUMMARIZER = build_summarizer(summarize_turns, on_updated=CONTEXT.invalidate) if CONTEXT else None
+
+def remember_message(user_id: str, session_id: str, sender: str, text: str, message: ChatMessage | None = None):
+    if CONTEXT:
+        CONTEXT.append(user_id, session_id, sender, text, message)
+        if SUMMARIZER:
+            SUMMARIZER.maybe_schedule(user_id, session_id, CONTEXT.unsummarized(user_id, session_id))
 
 def extract_text_from_response(resp_json: dict) -> str:
     """Extract text from Google Generative AI response with improved parsing."""
@@ -488,29 +745,90 @@ def extract_text_from_response(resp_json: dict) -> str:
 def health_check(request):
     """Health check endpoint to verify database connectivity"""
     if request.method == 'GET':
-        db_connected, db_message = check_database_connection()
+        db_connected, db_message = DB_HEALTH.status() if DB_HEALTH else check_database_connection()
         response_data = {
             "status": "healthy" if db_connected else "unhealthy",
             "database": {
                 "connected": db_connected,
-                "message": db_message
+                "message": db_message,
+                "monitor": DB_HEALTH.stats() if DB_HEALTH else None
             },
             "selected_model": SELECTED_MODEL_ID,
+            "model_catalog_age_seconds": round(time.time() - CATALOG_REFRESHER.applied_at) if CATALOG_REFRESHER.applied_at else None,
+            "response_cache": RESPONSE_CACHE.stats() if RESPONSE_CACHE else None,
+            "semantic_cache": SEMANTIC_CACHE.stats() if SEMANTIC_CACHE else None,
+            "request_coalescing": GENERATION_FLIGHT.stats(),
+            "model_breakers": MODEL_CHAIN.snapshot(),
+            "model_routing": MODEL_ROUTER.stats() if MODEL_ROUTER else None,
+            "retries": RETRY_STATS.stats(),
+            "hedging": HEDGER.stats() if HEDGER else None,
+            "rate_limit": RATE_LIMITER.stats() if RATE_LIMITER else None,
+            "scheduler": SCHEDULER.stats() if SCHEDULER else None,
+            "conversation_context": CONTEXT.stats() if CONTEXT else None,
+            "summarizer": SUMMARIZER.stats() if SUMMARIZER else None,
+            "prompt_cache": PROMPT_CACHE.stats() if PROMPT_CACHE else None,
+            "tokens": TOKENS.stats(),
+            "write_behind": WRITE_BEHIND.stats() if WRITE_BEHIND else None,
+            "purge": PURGER.stats() if PURGER else None,
+            "history_cache": HISTORY_CACHE.stats() if HISTORY_CACHE else None,
             "timestamp": timezone.now().isoformat()
         }
         status_code = 200 if db_connected else 503
         return JsonResponse(response_data, status=status_code)
     return JsonResponse({"error": "GET method required"}, status=405)
 
+def unavailable_response(exc: NoHealthyModelError | OverloadedError) -> JsonResponse:
+    """503 with Retry-After for open breakers and shed load."""
+    logger.error(str(exc))
+    response = JsonResponse({"error": str(exc), "retry_after": round(exc.retry_after)}, status=503)
+    response["Retry-After"] = str(max(1, round(exc.retry_after)))
+    return response
+
+def database_unavailable() -> JsonResponse | None:
+    """503 without touching the database while DB_HEALTH knows it is down, else None."""
+    if DB_HEALTH is None or DB_HEALTH.available():
+        return None
+    response = JsonResponse({"error": "Database connection failed", "retry_after": round(DB_HEALTH.retry_after())}, status=503)
+    response["Retry-After"] = str(max(1, round(DB_HEALTH.retry_after())))
+    return response
+
+def note_db_error(exc: Exception):
+    """Report a caught exception so a lost connection marks the database down."""
+    if DB_HEALTH:
+        DB_HEALTH.record_failure(exc)
+
+def save_message(user_id: str, session_id: str, sender: str, text: str):
+    """Persist a chat message now, or queue it for the write-behind writer (its id is then None)."""
+    if WRITE_BEHIND:
+        return WRITE_BEHIND.enqueue(user_id, session_id, sender, text)
+    return record_message(user_id, session_id, sender, text)
+
+def settle_writes() -> JsonResponse | None:
+    """
+    Let this process's queued messages reach the database before a view reads or clears them; 503 with Retry-After
+    if they have not landed within WRITE_BEHIND_SETTLE_TIMEOUT (the writer is retrying a batch), else None.
+    """
+    if WRITE_BEHIND is None or WRITE_BEHIND.flush(WRITE_BEHIND_SETTLE_TIMEOUT):
+        return None
+    logger.warning(f"Queued chat messages not written within {WRITE_BEHIND_SETTLE_TIMEOUT}s; answering 503")
+    response = JsonResponse({"error": "Recent messages are still being saved", "retry_after": 1}, status=503)
+    response["Retry-After"] = "1"
+    return response
+
+def rate_limited_response(exc: RateLimitExceeded) -> JsonResponse:
+    logger.warning(str(exc))
+    response = JsonResponse({"error": str(exc), "scope": exc.scope, "retry_after": round(exc.retry_after, 1)}, status=429)
+    response["Retry-After"] = str(max(1, round(exc.retry_after + 0.5)))
+    return response
+
 @csrf_exempt
 def chatbot_reply(request):
     if request.method == 'POST':
         try:
-            # Check DB connection
-            db_connected, db_message = check_database_connection()
-            if not db_connected:
-                logger.error(f"Database connection failed: {db_message}")
-                return JsonResponse({"error": "Database connection failed"}, status=503)
+            # Fail fast while the database is known to be down
+            unavailable = database_unavailable()
+            if unavailable:
+                return unavailable
 
             data = json.loads(request.body)
             prompt = data.get("prompt", "")
@@ -523,115 +841,299 @@ def chatbot_reply(request):
             if not prompt:
                 return JsonResponse({"error": "Prompt is required."}, status=400)
 
+            if not SELECTED_MODEL_ID:
+                return JsonResponse({"error": "No model selected on startup. Check server logs or set FALLBACK_MODEL."}, status=500)
+
+            # Build structured prompt and the conversation so far (read before this turn is saved)
+            structured_prompt = build_structured_prompt(prompt)
+            history, contents = assemble_contents(user_id, session_id, structured_prompt)
+
+            # the key covers the whole conversation, not just the latest question
+            cache_key = make_cache_key(
+                SELECTED_MODEL_ID, contents,
+                dict(build_generate_payload(structured_prompt)["generationConfig"], template=TUTOR_PROMPT.version),
+            )
+            served_model = SELECTED_MODEL_ID
+            resp_json = RESPONSE_CACHE.get(cache_key) if RESPONSE_CACHE else None
+            # near-duplicate answers are only reusable when there is no earlier context
+            if resp_json is None and SEMANTIC_CACHE and not history:
+                resp_json = SEMANTIC_CACHE.get(SELECTED_MODEL_ID, prompt)
+
+            # rate-limit before anything is persisted, so a 429 leaves no orphan user turn behind
+            reservation = None
+            if resp_json is None and RATE_LIMITER:
+                try:
+                    reservation = RATE_LIMITER.acquire(user_id, estimate_request_tokens(contents, TUTOR_PROMPT))
+                except RateLimitExceeded as e:
+                    return rate_limited_response(e)
+
             # Save user message to DB (best-effort)
+            user_message = None
             try:
-                user_message = ChatMessage.objects.create(
-                    user_id=user_id,
-                    text=prompt,
-                    sender='user',
-                    session_id=session_id
-                )
-                logger.info(f"Saved user message to DB: {user_message.id}")
+                user_message = save_message(user_id, session_id, 'user', prompt)
+                logger.info(f"Saved user message to DB: {user_message.id or 'queued'}")
             except Exception as e:
+                note_db_error(e)
                 logger.warning(f"Failed to save user message: {e}")
+            remember_message(user_id, session_id, 'user', prompt, user_message)
 
-            # Build structured prompt
-            structured_prompt = f"""
-You are an AI tutor helping a student learn. Please provide a clear, structured response to the following question:
-
-Question: {prompt}
-
-Please format your response with:
-1. A clear, concise answer
-2. If there are steps, number them clearly (1., 2., 3., etc.)
-3. If there are multiple options, list them with bullet points (•)
-4. Use **bold** for important terms and concepts
-5. Use proper line breaks (\n) to separate paragraphs
-6. Keep responses helpful but concise
-7. Use clear formatting for lists and steps
-
-Response:
-"""
-
-            # Generate via REST
-            if not SELECTED_MODEL_ID:
-                return JsonResponse({"error": "No model selected on startup. Check server logs or set FALLBACK_MODEL."}, status=500)
-
-            try:
-                resp_json = generate_with_gemini_rest(structured_prompt)
-                logger.info("Received response from model")
-            except requests.HTTPError as http_err:
-                logger.exception("HTTP error while calling generateContent")
+            if resp_json is not None:
+                logger.info("Serving reply from response cache")
+            else:
                 try:
-                    err_body = http_err.response.json()
-                except Exception:
-                    err_body = http_err.response.text if http_err.response is not None else str(http_err)
-                return JsonResponse({
-                    "error": "HTTPError calling generateContent",
-                    "status_code": http_err.response.status_code if http_err.response is not None else None,
-                    "body": err_body,
-                    "selected_model": SELECTED_MODEL_ID
-                }, status=502)
+                    served_model, resp_json = generate_coalesced(
+                        cache_key, reservation,
+                        lambda: generate_with_failover(structured_prompt, contents=contents, template=TUTOR_PROMPT),
+                    )
+                    logger.info(f"Received response from model {served_model}")
+                except (NoHealthyModelError, OverloadedError) as e:
+                    return unavailable_response(e)
+                except requests.HTTPError as http_err:
+                    logger.exception("HTTP error while calling generateContent")
+                    try:
+                        err_body = http_err.response.json()
+                    except Exception:
+                        err_body = http_err.response.text if http_err.response is not None else str(http_err)
+                    return JsonResponse({
+                        "error": "HTTPError calling generateContent",
+                        "status_code": http_err.response.status_code if http_err.response is not None else None,
+                        "body": err_body,
+                        "selected_model": SELECTED_MODEL_ID
+                    }, status=502)
+                if is_cacheable(resp_json):
+                    if RESPONSE_CACHE:
+                        RESPONSE_CACHE.set(cache_key, resp_json)
+                    if SEMANTIC_CACHE and not history:
+                        SEMANTIC_CACHE.set(SELECTED_MODEL_ID, prompt, resp_json)
 
             # Extract text safely
             reply = extract_text_from_response(resp_json)
 
             # Save AI response to DB
+            ai_message = None
             try:
-                ai_message = ChatMessage.objects.create(
-                    user_id=user_id,
-                    text=reply,
-                    sender='ai',
-                    session_id=session_id
-                )
-                logger.info(f"Saved AI response to DB: {ai_message.id}")
+                ai_message = save_message(user_id, session_id, 'ai', reply)
+                logger.info(f"Saved AI response to DB: {ai_message.id or 'queued'}")
             except Exception as e:
+                note_db_error(e)
                 logger.warning(f"Failed to save AI response: {e}")
+            remember_message(user_id, session_id, 'ai', reply, ai_message)
 
-            return JsonResponse({"reply": reply, "selected_model": SELECTED_MODEL_ID})
+            return JsonResponse({"reply": reply, "selected_model": served_model})
         except Exception as e:
+            note_db_error(e)
             logger.exception("Error in chatbot_reply")
             return JsonResponse({"error": str(e)}, status=500)
 
     return JsonResponse({"message": "Send a POST request with a prompt."})
 
+@csrf_exempt
+def chatbot_stream(request):
+    """Same contract as chatbot_reply, but streams the reply as server-sent events."""
+    if request.method != 'POST':
+        return JsonResponse({"error": "POST method required"}, status=405)
+    ticket = None
+    reservation = None
+    try:
+        unavailable = database_unavailable()
+        if unavailable:
+            return unavailable
+
+        data = json.loads(request.body)
+        prompt = data.get("prompt", "")
+        user_id = data.get("user_id", "anonymous")
+        session_id = data.get("session_id", "default")
+
+        if not prompt:
+            return JsonResponse({"error": "Prompt is required."}, status=400)
+        if not SELECTED_MODEL_ID:
+            return JsonResponse({"error": "No model selected on startup. Check server logs or set FALLBACK_MODEL."}, status=500)
+
+        structured_prompt = build_structured_prompt(prompt)
+        _, contents = assemble_contents(user_id, session_id, structured_prompt)
+        if RATE_LIMITER:
+            try:
+                reservation = RATE_LIMITER.acquire(user_id, estimate_request_tokens(contents, TUTOR_PROMPT))
+            except RateLimitExceeded as e:
+                return rate_limited_response(e)
+        try:
+            ticket = SCHEDULER.acquire(INTERACTIVE) if SCHEDULER else None
+        except OverloadedError as e:
+            if reservation:
+                RATE_LIMITER.refund(reservation)
+            return unavailable_response(e)
+
+        user_message = None
+        try:
+            user_message = save_message(user_id, session_id, 'user', prompt)
+            logger.info(f"Saved user message to DB: {user_message.id or 'queued'}")
+        except Exception as e:
+            note_db_error(e)
+            logger.warning(f"Failed to save user message: {e}")
+        remember_message(user_id, session_id, 'user', prompt, user_message)
+    except Exception as e:
+        note_db_error(e)
+        logger.exception("Error in chatbot_stream")
+        if ticket:
+            ticket.release()
+        if reservation:
+            RATE_LIMITER.refund(reservation)
+        return JsonResponse({"error": str(e)}, status=500)
+
+    def events():
+        pieces = []
+        served_model = None
+        try:
+            served_model, deltas = stream_with_gemini_rest(
+                structured_prompt, contents=contents, template=TUTOR_PROMPT, reservation=reservation
+            )
+            for text in deltas:
+                pieces.append(text)
+                yield format_sse({"text": text})
+        except NoHealthyModelError as e:
+            logger.error(str(e))
+            yield format_sse({"error": str(e), "retry_after": round(e.retry_after)}, event="error")
+            return
+        except requests.HTTPError as http_err:
+            logger.exception("HTTP error while calling streamGenerateContent")
+            try:
+                err_body = http_err.response.json()
+            except Exception:
+                err_body = http_err.response.text if http_err.response is not None else str(http_err)
+            yield format_sse({
+                "error": "HTTPError calling streamGenerateContent",
+                "status_code": http_err.response.status_code if http_err.response is not None else None,
+                "body": err_body,
+                "selected_model": served_model
+            }, event="error")
+            return
+        except Exception as e:
+            logger.exception("Error while streaming reply")
+            yield format_sse({"error": str(e)}, event="error")
+            return
+
+        reply = "".join(pieces)
+        ai_message = None
+        try:
+            ai_message = save_message(user_id, session_id, 'ai', reply)
+            logger.info(f"Saved AI response to DB: {ai_message.id or 'queued'}")
+        except Exception as e:
+            note_db_error(e)
+            logger.warning(f"Failed to save AI response: {e}")
+        remember_message(user_id, session_id, 'ai', reply, ai_message)
+        yield format_sse({"reply": reply, "selected_model": served_model}, event="done")
+
+    # the scheduler slot is held until the stream finishes or the client goes away
+    body = ticket.wrap(events()) if ticket else events()
+    response = StreamingHttpResponse(body, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
 @csrf_exempt
 def get_chat_history(request):
-    """Get chat history for a user"""
+    """Get one page of chat history for a user's session (newest page unless before/after is given)"""
     if request.method == 'GET':
         try:
             user_id = request.GET.get('user_id', 'anonymous')
             session_id = request.GET.get('session_id', 'default')
 
-            # Check DB connection
-            db_connected, db_message = check_database_connection()
-            if not db_connected:
-                return JsonResponse({"error": "Database connection failed"}, status=503)
-
-            messages = ChatMessage.objects.filter(
-                user_id=user_id,
-                session_id=session_id
-            ).order_by('timestamp')
-
-            chat_history = []
-            for msg in messages:
-                chat_history.append({
-                    'id': str(msg.id),
-                    'text': msg.text,
-                    'sender': msg.sender,
-                    'timestamp': msg.timestamp.isoformat()
-                })
+            # Fail fast while the database is known to be down
+            unavailable = database_unavailable()
+            if unavailable:
+                return unavailable
 
-            return JsonResponse({
-                "messages": chat_history,
-                "count": len(chat_history)
-            })
+            unsettled = settle_writes()
+            if unsettled:
+                return unsettled
+            try:
+                before = request.GET.get('before') or None
+                after = request.GET.get('after') or None
+                limit = parse_limit(request.GET.get('limit'))
+
+                def build():
+                    return json.dumps(message_page(user_id, session_id, before=before, after=after, limit=limit)).encode("utf-8")
+
+                if HISTORY_CACHE:
+                    # the version is read first, so the page built below is at least that new
+                    body = HISTORY_CACHE.get_or_build(
+                        user_id, session_id, session_version(user_id, session_id), (before, after, limit), build
+                    )
+                else:
+                    body = build()
+            except InvalidCursor as e:
+                return JsonResponse({"error": str(e)}, status=400)
+
+            return HttpResponse(body, content_type="application/json")
         except Exception as e:
+            note_db_error(e)
             logger.exception("Error getting chat history")
             return JsonResponse({"error": str(e)}, status=500)
 
     return JsonResponse({"error": "GET method required"}, status=405)
 
+@csrf_exempt
+def search_chat_history(request):
+    """Full-text search over a user's messages, ranked by BM25, with highlighted snippets"""
+    if request.method != 'GET':
+        return JsonResponse({"error": "GET method required"}, status=405)
+    try:
+        unavailable = database_unavailable()
+        if unavailable:
+            return unavailable
+
+        unsettled = settle_writes()
+        if unsettled:
+            return unsettled
+        try:
+            limit, offset = parse_paging(request.GET.get('limit'), request.GET.get('offset'))
+            page = search_messages(
+                request.GET.get('q', ''),
+                request.GET.get('user_id', 'anonymous'),
+                session_id=request.GET.get('session_id') or None,
+                since=parse_bound(request.GET.get('since')),
+                until=parse_bound(request.GET.get('until'), end=True),
+                limit=limit,
+                offset=offset,
+            )
+        except (InvalidSearch, InvalidExportRequest) as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        except SearchUnavailable as e:
+            return JsonResponse({"error": str(e)}, status=501)
+        return JsonResponse(page)
+    except Exception as e:
+        note_db_error(e)
+        logger.exception("Error searching chat history")
+        return JsonResponse({"error": str(e)}, status=500)
+
+@csrf_exempt
+def export_chat_history(request):
+    """Stream a user's messages (one session, or all of them) as NDJSON or JSON without buffering the export"""
+    if request.method != 'GET':
+        return JsonResponse({"error": "GET method required"}, status=405)
+    unavailable = database_unavailable()
+    if unavailable:
+        return unavailable
+    user_id = request.GET.get('user_id', 'anonymous')
+    session_id = request.GET.get('session_id') or None
+    fmt = request.GET.get('format', 'ndjson')
+    unsettled = settle_writes()
+    if unsettled:
+        return unsettled
+    try:
+        chunks = export_chunks(fmt, export_rows(
+            user_id,
+            session_id,
+            since=parse_bound(request.GET.get('since')),
+            until=parse_bound(request.GET.get('until'), end=True),
+        ))
+    except InvalidExportRequest as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    response = StreamingHttpResponse(chunks, content_type=FORMATS[fmt])
+    filename = f"chat-{user_id}-{session_id or 'all'}.{fmt}".replace('"', '')
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
 @csrf_exempt
 def clear_chat(request):
     """Clear chat messages for a specific user and session"""
@@ -641,16 +1143,19 @@ def clear_chat(request):
             user_id = data.get('user_id', 'anonymous')
             session_id = data.get('session_id', 'default')
 
-            # Check DB connection
-            db_connected, db_message = check_database_connection()
-            if not db_connected:
-                return JsonResponse({"error": "Database connection failed"}, status=503)
-
-            deleted_count = ChatMessage.objects.filter(
-                user_id=user_id, 
-                session_id=session_id
-            ).delete()[0]
-
+            # Fail fast while the database is known to be down
+            unavailable = database_unavailable()
+            if unavailable:
+                return unavailable
+
+            unsettled = settle_writes()
+            if unsettled:
+                return unsettled
+            deleted_count = clear_session(user_id, session_id)
+            if PURGER:
+                PURGER.schedule()
+            if CONTEXT:
+                CONTEXT.invalidate(user_id, session_id)
             logger.info(f"Cleared {deleted_count} messages for user {user_id}, session {session_id}")
 
             return JsonResponse({
@@ -659,49 +1164,73 @@ def clear_chat(request):
                 "message": f"Cleared {deleted_count} messages"
             })
         except Exception as e:
+            note_db_error(e)
             logger.exception("Error clearing chat")
             return JsonResponse({"error": str(e)}, status=500)
 
     return JsonResponse({"error": "POST method required"}, status=405)
 
+@csrf_exempt
+def clear_all_chats(request):
+    """Clear every session of a user in one step; messages are deleted in the background"""
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            user_id = data.get('user_id', 'anonymous')
+
+            unavailable = database_unavailable()
+            if unavailable:
+                return unavailable
+
+            unsettled = settle_writes()
+            if unsettled:
+                return unsettled
+            session_count, deleted_count = clear_user(user_id)
+            if PURGER:
+                PURGER.schedule()
+            if CONTEXT:
+                CONTEXT.invalidate_user(user_id)
+            logger.info(f"Cleared {deleted_count} messages in {session_count} sessions for user {user_id}")
+
+            return JsonResponse({
+                "status": "success",
+                "session_count": session_count,
+                "deleted_count": deleted_count,
+                "message": f"Cleared {deleted_count} messages in {session_count} sessions"
+            })
+        except Exception as e:
+            note_db_error(e)
+            logger.exception("Error clearing all chats")
+            return JsonResponse({"error": str(e)}, status=500)
+
+    return JsonResponse({"error": "POST method required"}, status=405)
+
 @csrf_exempt
 def get_sessions(request):
-    """Get all chat sessions for a user"""
+    """Get a page of a user's chat sessions, most recently active first"""
     if request.method == 'GET':
         try:
             user_id = request.GET.get('user_id', 'anonymous')
 
-            db_connected, db_message = check_database_connection()
-            if not db_connected:
-                return JsonResponse({"error": "Database connection failed"}, status=503)
-
-            sessions = ChatMessage.objects.filter(
-                user_id=user_id
-            ).values('session_id').distinct().order_by('-timestamp')
-
-            session_list = []
-            for session in sessions:
-                session_id = session['session_id']
-                first_message = ChatMessage.objects.filter(
-                    user_id=user_id,
-                    session_id=session_id
-                ).order_by('timestamp').first()
-
-                if first_message:
-                    session_list.append({
-                        'session_id': session_id,
-                        'created_at': first_message.timestamp.isoformat(),
-                        'message_count': ChatMessage.objects.filter(
-                            user_id=user_id,
-                            session_id=session_id
-                        ).count()
-                    })
+            unavailable = database_unavailable()
+            if unavailable:
+                return unavailable
 
-            return JsonResponse({
-                "sessions": session_list,
-                "count": len(session_list)
-            })
+            unsettled = settle_writes()
+            if unsettled:
+                return unsettled
+            try:
+                page = session_page(
+                    user_id,
+                    before=request.GET.get('before') or None,
+                    limit=parse_limit(request.GET.get('limit')),
+                )
+            except InvalidCursor as e:
+                return JsonResponse({"error": str(e)}, status=400)
+
+            return JsonResponse(page)
         except Exception as e:
+            note_db_error(e)
             logger.exception("Error getting sessions")
             return JsonResponse({"error": str(e)}, status=500)
 
@@ -0,0 +1,391 @@
+# chatbot/write_behind.py
+"""
+Optional write-behind persistence of chat messages.
+
+Without it, every chatbot_reply turn runs two autocommit transactions
+(record_message for the question, then again for the answer). On SQLite each
+one takes the database write lock and syncs the file, so concurrent turns
+queue behind each other's INSERTs. With GEMINI_WRITE_BEHIND=1, views only put
+the message on a bounded in-process queue. A single writer thread persists
+the queue with sessions.record_messages(): one bulk_create and one rollup
+UPDATE per session, all in one transaction per batch. A batch is written when
+it reaches GEMINI_WRITE_BEHIND_BATCH messages or GEMINI_WRITE_BEHIND_INTERVAL
+seconds after its first message, whichever comes first.
+
+Each message gets its timestamp when it is queued, so history order does not
+depend on when the batch lands. Its id stays None until the batch commits.
+
+Backpressure: when the queue is full, a caller waits up to
+GEMINI_WRITE_BEHIND_BLOCK seconds for room. After that it writes its message
+synchronously, so a database that cannot keep up slows requests down to its
+own pace instead of growing the queue or losing messages.
+
+Reads of this process's own writes: flush() waits until everything queued
+before the call is committed. The history, export, sessions and clear views
+call it first. Other processes see a message at most one interval plus one
+batch write after it was queued.
+
+Reads: views that read or clear messages first wait for this process's
+queued writes to land (flush), for at most GEMINI_WRITE_BEHIND_SETTLE_TIMEOUT
+seconds. While the writer is stuck retrying a batch (lock contention, or an
+outage the health monitor has not caught), they answer 503 instead of
+blocking.
+
+Shutdown: an atexit hook flushes the queue (up to SHUTDOWN_TIMEOUT seconds).
+
+Durability (GEMINI_WRITE_BEHIND_DURABILITY):
+  memory   queued messages live only in memory; a crash loses at most the
+           unflushed batch window
+  journal  each message is also appended to a per-process journal file in
+           GEMINI_WRITE_BEHIND_JOURNAL_DIR and flushed to the OS, which
+           survives a process crash
+  fsync    as journal, plus an fsync per message, which survives power loss
+           but costs one disk sync per message
+The journal is truncated whenever the writer has caught up. Journals left by
+processes that are no longer running are replayed by the next process to
+queue a message. Rows that are already in the table are skipped, matched on
+user, session, sender and timestamp.
+
+Configuration (environment):
+  GEMINI_WRITE_BEHIND              1 to queue message writes (default 0: write synchronously)
+  GEMINI_WRITE_BEHIND_BATCH        messages per transaction (default 200)
+  GEMINI_WRITE_BEHIND_INTERVAL     seconds a batch may wait to fill (default 0.05)
+  GEMINI_WRITE_BEHIND_QUEUE        queued messages before backpressure (default 10000)
+  GEMINI_WRITE_BEHIND_BLOCK        seconds a caller waits for room before writing itself (default 1)
+  GEMINI_WRITE_BEHIND_DURABILITY   memory, journal or fsync (default memory)
+  GEMINI_WRITE_BEHIND_JOURNAL_DIR  directory for journal files (default: system temp dir)
+  GEMINI_WRITE_BEHIND_SETTLE_TIMEOUT  seconds a read waits for queued writes before a 503 (default 2)
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from django.db import connection
+from django.utils import timezone
+
+from .db_health import is_connectivity_error, is_lock_contention
+from .models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_ENABLED = os.getenv("GEMINI_WRITE_BEHIND", "0").lower() in ("1", "true", "yes")
+WRITE_BEHIND_BATCH = int(os.getenv("GEMINI_WRITE_BEHIND_BATCH", "200"))
+WRITE_BEHIND_INTERVAL = float(os.getenv("GEMINI_WRITE_BEHIND_INTERVAL", "0.05"))
+WRITE_BEHIND_QUEUE = int(os.getenv("GEMINI_WRITE_BEHIND_QUEUE", "10000"))
+WRITE_BEHIND_BLOCK = float(os.getenv("GEMINI_WRITE_BEHIND_BLOCK", "1"))
+WRITE_BEHIND_DURABILITY = os.getenv("GEMINI_WRITE_BEHIND_DURABILITY", "memory").lower()
+WRITE_BEHIND_JOURNAL_DIR = os.getenv("GEMINI_WRITE_BEHIND_JOURNAL_DIR") or tempfile.gettempdir()
+WRITE_BEHIND_SETTLE_TIMEOUT = float(os.getenv("GEMINI_WRITE_BEHIND_SETTLE_TIMEOUT", "2"))
+
+DURABILITY_MODES = ("memory", "journal", "fsync")
+JOURNAL_PREFIX = "chat-write-behind-"
+SHUTDOWN_TIMEOUT = 10.0
+MAX_RETRY_DELAY = 5.0
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _Journal:
+    """Append-only JSON-lines file of queued messages for one process."""
+
+    def __init__(self, directory: str, sync: bool):
+        self.directory = directory
+        self.sync = sync
+        self.path = os.path.join(directory, f"{JOURNAL_PREFIX}{os.getpid()}.jsonl")
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def append(self, message: ChatMessage):
+        line = json.dumps({
+            "user_id": message.user_id,
+            "session_id": message.session_id,
+            "sender": message.sender,
+            "text": message.text,
+            "timestamp": message.timestamp.isoformat(),
+        }, ensure_ascii=False)
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(line + "\n")
+            self._file.flush()
+            if self.sync:
+                os.fsync(self._file.fileno())
+
+    def truncate(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.truncate(0)
+            self._file.seek(0)
+
+    def remove(self):
+        """Close and delete the journal once everything in it is committed (clean shutdown)."""
+        with self._lock:
+            self._file.close()
+            os.remove(self.path)
+
+    def orphans(self) -> list:
+        """Journal files of processes that are no longer running, renamed so no other process replays them."""
+        claimed = []
+        for name in os.listdir(self.directory):
+            if not (name.startswith(JOURNAL_PREFIX) and name.endswith(".jsonl")):
+                continue
+            try:
+                pid = int(name[len(JOURNAL_PREFIX):-len(".jsonl")])
+            except ValueError:
+                continue
+            if pid == os.getpid() or _pid_alive(pid):
+                continue
+            path = os.path.join(self.directory, name)
+            target = f"{path}.replay-{os.getpid()}"
+            try:
+                os.rename(path, target)
+            except OSError:
+                continue  # claimed by another process first
+            claimed.append(target)
+        return claimed
+
+    @staticmethod
+    def read(path: str) -> list:
+        messages = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                    row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+                    messages.append(ChatMessage(**row))
+                except (ValueError, KeyError, TypeError):
+                    logger.warning(f"Skipping unreadable write-behind journal line in {path}")
+        return messages
+
+
+class WriteBehindQueue:
+    """
+    Bounded queue of unsaved ChatMessages persisted in batches by one background thread.
+    `write_batch(messages)` saves a list of unsaved messages in one transaction (sessions.record_messages);
+    `on_error(exc)` sees every exception the writer catches.
+    """
+
+    def __init__(self, write_batch, on_error=None, batch_size: int = WRITE_BEHIND_BATCH,
+                 interval: float = WRITE_BEHIND_INTERVAL, capacity: int = WRITE_BEHIND_QUEUE,
+                 block: float = WRITE_BEHIND_BLOCK, durability: str = WRITE_BEHIND_DURABILITY,
+                 journal_dir: str = WRITE_BEHIND_JOURNAL_DIR):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"GEMINI_WRITE_BEHIND_DURABILITY must be one of {', '.join(DURABILITY_MODES)}")
+        self.write_batch = write_batch
+        self.on_error = on_error
+        self.batch_size = batch_size
+        self.interval = interval
+        self.block = block
+        self.durability = durability
+        self.journal = _Journal(journal_dir, sync=durability == "fsync") if durability != "memory" else None
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.sync_writes = 0
+        self.failed = 0
+        self.replayed = 0
+        self.flush_timeouts = 0
+        self.last_batch_ms = None
+        self._queue = queue.Queue(maxsize=capacity)
+        self._in_flight = 0  # queued but not yet committed
+        self._thread = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    # -- request side --
+
+    def enqueue(self, user_id: str, session_id: str, sender: str, text: str) -> ChatMessage:
+        """Queue a message and return it unsaved (id None); writes it synchronously if the queue stays full."""
+        message = ChatMessage(user_id=user_id, session_id=session_id, sender=sender, text=text,
+                              timestamp=timezone.now())
+        if self._thread is None:
+            self.start()
+        if not self._closed:
+            with self._lock:
+                self._in_flight += 1
+            if self.journal:
+                self.journal.append(message)
+            try:
+                self._queue.put(message, timeout=self.block)
+                with self._lock:
+                    self.queued += 1
+                return message
+            except queue.Full:
+                with self._lock:
+                    self._in_flight -= 1
+                logger.warning(f"Write-behind queue full for {self.block}s; writing message synchronously")
+        with self._lock:
+            self.sync_writes += 1
+        return self.write_batch([message])[0]
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Wait until every message queued before this call is committed; False on timeout."""
+        if self._thread is None or self._closed:
+            return True
+        with self._lock:
+            if not self._in_flight:
+                return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+            flushed = done.wait(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        except queue.Full:
+            flushed = False
+        if not flushed:
+            with self._lock:
+                self.flush_timeouts += 1
+        return flushed
+
+    def close(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """Flush and stop accepting queued writes; later enqueue() calls write synchronously."""
+        if self._closed:
+            return
+        flushed = self.flush(timeout)
+        self._closed = True
+        if not flushed:
+            kept = f"; they remain in {self.journal.path}" if self.journal else ""
+            logger.error(f"Shutting down with {self._in_flight} chat messages not yet written{kept}")
+        elif self.journal:
+            self.journal.remove()
+
+    # -- writer thread --
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="chat-write-behind", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        if self.journal:
+            self.replay()
+        while True:
+            batch, barriers = self._collect()
+            if batch:
+                self._write(batch)
+            for done in barriers:
+                done.set()
+            connection.close_if_unusable_or_obsolete()
+
+    def _collect(self) -> tuple:
+        """Block for the first message, then gather more until batch_size, the interval or a flush barrier."""
+        batch, barriers = [], []
+        item = self._queue.get()
+        deadline = time.monotonic() + self.interval
+        while True:
+            if isinstance(item, threading.Event):
+                barriers.append(item)
+                break  # a flush is waiting; write what we have now
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                break
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+        return batch, barriers
+
+    def _write(self, batch: list):
+        started = time.monotonic()
+        delay = 0.1
+        while True:
+            try:
+                self.write_batch(batch)
+                written, failed = len(batch), 0
+                break
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(e)
+                connection.close_if_unusable_or_obsolete()
+                if not (is_connectivity_error(e) or is_lock_contention(e)):
+                    logger.exception(f"Write-behind batch of {len(batch)} messages failed; retrying one by one")
+                    written, failed = self._write_each(batch)
+                    break
+                # database unreachable or locked: keep the batch and retry; the full queue pushes back on callers meanwhile
+                logger.warning(f"Write-behind batch of {len(batch)} messages waiting for the database: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+        with self._lock:
+            self.written += written
+            self.failed += failed
+            self.batches += 1
+            self.last_batch_ms = round((time.monotonic() - started) * 1000, 1)
+            self._in_flight -= len(batch)
+            caught_up = not self._in_flight
+            # truncate under the lock so an enqueue cannot slip a journal line in between
+            if caught_up and self.journal:
+                self.journal.truncate()
+
+    def _write_each(self, batch: list) -> tuple:
+        written = 0
+        for message in batch:
+            try:
+                self.write_batch([message])
+                written += 1
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(e)
+                logger.error(f"Dropping chat message for session {message.session_id}: {e}")
+        return written, len(batch) - written
+
+    def replay(self):
+        """Write the messages in journals of dead processes that are not already in the table."""
+        for path in self.journal.orphans():
+            try:
+                pending = [m for m in _Journal.read(path) if not ChatMessage.objects.filter(
+                    user_id=m.user_id, session_id=m.session_id, sender=m.sender, timestamp=m.timestamp,
+                ).exists()]
+                for start in range(0, len(pending), self.batch_size):
+                    self.write_batch(pending[start:start + self.batch_size])
+                self.replayed += len(pending)
+                os.remove(path)
+                logger.info(f"Replayed {len(pending)} chat messages from {path}")
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(e)
+                logger.exception(f"Replaying write-behind journal {path} failed; it is kept for inspection")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "durability": self.durability,
+                "batch_size": self.batch_size,
+                "interval": self.interval,
+                "capacity": self._queue.maxsize,
+                "pending": self._in_flight,
+                "queued": self.queued,
+                "written": self.written,
+                "batches": self.batches,
+                "avg_batch": round(self.written / self.batches, 1) if self.batches else None,
+                "last_batch_ms": self.last_batch_ms,
+                "sync_writes": self.sync_writes,
+                "failed": self.failed,
+                "replayed": self.replayed,
+                "flush_timeouts": self.flush_timeouts,
+            }
+
+
+def build_write_behind(write_batch, on_error=None) -> WriteBehindQueue | None:
+    if not WRITE_BEHIND_ENABLED:
+        return None
+    writer = WriteBehindQueue(write_batch, on_error)
+    atexit.register(writer.close)
+    return writer
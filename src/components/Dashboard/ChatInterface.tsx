@@ -56,18 +56,28 @@ export default function ChatInterface() {
 
   const loadChatHistory = async () => {
     try {
-      const response = await fetch(`http://127.0.0.1:8000/api/history/?user_id=${user?.id || 'anonymous'}&session_id=${sessionId}`, {
-        method: 'GET',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-      });
+      // History comes back a page at a time, newest first; follow cursors.before back to the start of the session
+      const historyUrl = `http://127.0.0.1:8000/api/history/?user_id=${user?.id || 'anonymous'}&session_id=${sessionId}&limit=200`;
+      let history: ChatMessage[] = [];
+      let before: string | null = null;
+      let response: Response;
+      do {
+        response = await fetch(before ? `${historyUrl}&before=${encodeURIComponent(before)}` : historyUrl, {
+          method: 'GET',
+          headers: {
+            'Content-Type': 'application/json',
+          },
+        });
+        if (!response.ok) break;
+        const data = await response.json();
+        history = [...(data.messages || []), ...history];
+        before = data.has_more ? data.cursors.before : null;
+      } while (before);
 
       if (response.ok) {
-        const data = await response.json();
-        if (data.messages && data.messages.length > 0) {
-          console.log('Loaded chat history from database:', data.messages);
-          setMessages(data.messages);
+        if (history.length > 0) {
+          console.log('Loaded chat history from database:', history);
+          setMessages(history);
         } else {
           // Add welcome message if no history
           const welcomeMessage: ChatMessage = {
@@ -104,17 +114,23 @@ export default function ChatInterface() {
 
   const loadSessions = async () => {
     try {
-      const response = await fetch(`http://127.0.0.1:8000/api/sessions/?user_id=${user?.id || 'anonymous'}`, {
-        method: 'GET',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-      });
-
-      if (response.ok) {
+      // Sessions come back a page at a time, most recently active first; follow cursors.before for the rest
+      const sessionsUrl = `http://127.0.0.1:8000/api/sessions/?user_id=${user?.id || 'anonymous'}&limit=200`;
+      let allSessions: ChatSession[] = [];
+      let before: string | null = null;
+      do {
+        const response = await fetch(before ? `${sessionsUrl}&before=${encodeURIComponent(before)}` : sessionsUrl, {
+          method: 'GET',
+          headers: {
+            'Content-Type': 'application/json',
+          },
+        });
+        if (!response.ok) return;
         const data = await response.json();
-        setSessions(data.sessions || []);
-      }
+        allSessions = [...allSessions, ...(data.sessions || [])];
+        before = data.has_more ? data.cursors.before : null;
+      } while (before);
+      setSessions(allSessions);
     } catch (error) {
       console.error('Error loading sessions:', error);
     }